@@ -1,20 +1,24 @@
 #!/usr/bin/python3
 
-import os
 import argparse
-import subprocess
+import logging
 import sys
 
-from utilities.iso import mount, unmount
-from utilities.file_ops import make_directory, make_directories, delete_directory
 from utilities.logger import create_logger
-from utilities.extract import copy_original_iso_files, extract_squashfs
-from utilities.container import create_virtual_environment
-from utilities.create_scripts import add_sources_list, do_script 
-from utilities.metadata import modify_release_description, create_filesystem_manifest
-from utilities.image_iso import do_iso_image
-from utilities.util import remove_apt_proxy
-from utilities.parser import *
+from utilities.errors import BuildError
+from utilities.builder import Builder, BuildSpec
+from utilities.bmap import flash_image
+from utilities.backend import BACKENDS, BACKEND_HOST
+from utilities.benchmark import run_benchmarks, BENCH_COMPRESSORS
+from utilities.metrics import get_config_hash, get_stats
+from utilities.planner import show_build_plan
+from utilities.daemon import run_daemon, DAEMON_ADDRESS
+from utilities.cas import run_cache_server, CACHE_SERVER_ADDRESS
+from utilities.farm import run_coordinator, run_worker, COORDINATOR_ADDRESS, LEASE_TIMEOUT
+from utilities.mirror import create_mirror
+from utilities.inspector import inspect_image, INSPECT_ACTIONS
+from utilities.proxy import run_proxy, PROXY_ADDRESS
+from utilities.parser import load_config, get_cache_directory
 
 logger = create_logger(__name__)
 
@@ -54,161 +58,394 @@ def parser():
     keep = ap.add_argument('-k', '--keep-project', action='store_true',
             help="Keep the project files.")
 
+    backend = ap.add_argument('-b', '--backend', action='store', default=BACKEND_HOST,
+            choices=sorted(BACKENDS),
+            help="How mount, container and loop device are run. 'host' needs superuser privilege, "
+            "'userns' runs in a user namespace, 'fake' records the container commands. Default is 'host'")
+
+    trace = ap.add_argument('--trace', action='store_true',
+            help="Record the time, CPU and I/O of each stage and command. "
+            "Write build-report.json and build-trace.json (Chrome trace) to the project directory.")
+
+    plan = ap.add_argument('--plan', action='store_true',
+            help="Show the cache hits, estimated stage durations and peak disk usage, then exit "
+            "without building. Exit code is 1 if there is not enough free space.")
+
+    ignore_space = ap.add_argument('--ignore-space', action='store_true',
+            help="Start the build even if the estimated disk usage exceeds the free space.")
+
     return ap.parse_args()
 
 
-def do_cleanup(project_directory, output_image):
-    """
-    Remove all of the project files after
-    creating the custom image.
-    """
-    if project_directory in output_image:
-        temp_dir = os.path.join(os.path.dirname(project_directory), 'temp_dir')
-        os.rename(project_directory, temp_dir)
-        make_directory(project_directory)
+def flash_parser(argv):
+    description = """\
+            Flash the ISO or raw disk image to a device.
+            Only the mapped ranges in <image>.bmap are written.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py flash', description=description)
 
-        output_path = os.path.dirname(output_image)
-        files = os.listdir(temp_dir)
-        for f in files:
-            if f.endswith('.iso') or f.endswith('.md5sums'):
-                src = os.path.join(temp_dir, f)
-                dst = os.path.join(output_path, f)
-                os.rename(src, dst)
-        delete_directory(temp_dir)
+    ap.add_argument('image', action='store',
+            help='Path to the ISO or raw disk image')
 
-    else:
-        delete_directory(project_directory)
+    ap.add_argument('device', action='store',
+            help='Target device such as /dev/sdX')
 
+    ap.add_argument('-b', '--bmap', action='store', default=None, required=False,
+            help="Path to the block map. Default is '<image>.bmap'")
 
-def run():
-    project_name = None
-    project_directory = None
-    variant = None
-    proxy_path = None
-    configuration_path = None
-    output_iso_path = None
-    keep_project = None
+    ap.add_argument('--no-verify', action='store_true',
+            help="Do not verify the checksum of each range")
 
-    args = parser()
-    if args.debug:
-        logger.setLevel(logging.DEBUG)
-        logger.debug("Set logger level to DEBUG")
+    return ap.parse_args(argv)
+
+
+def run_flash(argv):
+    args = flash_parser(argv)
+    return flash_image(args.image, args.device, args.bmap, not args.no_verify)
+
+
+def stats_parser(argv):
+    description = """\
+            Compare the last build of each variant with the previous builds
+            and report the stages and artifacts which grew beyond the threshold.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py stats', description=description)
+
+    ap.add_argument('configuration', action='store',
+            help='Path to config.json')
 
-    if args.project_name:
-        project_name = args.project_name
-        logger.info("project name is %s", project_name)
+    ap.add_argument('-t', '--variant', action='append', default=None, required=False,
+            help="Variant to check. Can be repeated. Default is all recorded variants")
 
-    if args.project_directory:
-        project_directory = os.path.join(args.project_directory, project_name)
-        logger.info("project directory is %s", project_directory)
+    ap.add_argument('--history', action='store', type=int, default=5, required=False,
+            help="Number of previous builds to compare with. Default is 5")
 
-    if args.variant:
-        variant = args.variant
-        logger.info("variant is %s", variant)
+    ap.add_argument('--threshold', action='store', type=float, default=20, required=False,
+            help="Growth in percent reported as regression. Default is 20")
 
-    if args.configuration:
-        logger.info("configuration path is %s", args.configuration)
-        configuration_path = args.configuration
-    else:
-        configuration_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), args.configuration)
+    ap.add_argument('--same-config', action='store_true',
+            help="Only compare builds with the same configuration hash")
 
-    config = load_config(configuration_path)
+    return ap.parse_args(argv)
+
+
+def run_stats(argv):
+    args = stats_parser(argv)
+    config = load_config(args.configuration)
     if not config:
-        logger.error("Configuration file is not found at %s", configuration_path)
-        sys.exit(1)
-
-    # get path to ubuntu iso image
-    iso_file_path = get_base_image(config, variant)
-    if args.output_file:
-        if not '/' in args.output_file:
-            output_iso_path = os.path.join(project_directory, args.output_file)
-        else:
-            output_iso_path = args.output_file
-    else:
-        input_iso_image = os.path.basename(iso_file_path)
-        images_types = get_image_types(config, variant)
-        output_iso_image = None
-        for image_type in images_types.split(' '):
-            if 'iso' in image_type:
-                output_iso_image = input_iso_image.replace('.iso', '-custom.iso')
-                break
-        output_iso_path = os.path.join(project_directory, output_iso_image)
-
-    logger.info("Output image is %s", output_iso_path)
+        logger.error("Configuration file is not found at %s", args.configuration)
+        return 1
 
-    if args.proxy:
-        proxy_path = args.proxy
-        logger.info("proxy path: %s", proxy_path)
+    config_hash = None
+    if args.same_config:
+        if not args.variant or len(args.variant) != 1:
+            logger.error("--same-config needs exactly one --variant")
+            return 1
+        config_hash = get_config_hash(config, args.variant[0])
 
-    if args.keep_project:
-        keep_project = True
+    cache_directory = get_cache_directory(config, None)
+    regressions = get_stats(cache_directory, args.variant, config_hash, args.history, args.threshold)
+    return 1 if regressions else 0
 
-    iso_mount_point = os.path.join(project_directory, "source-disk")
-    custom_disk_directory = os.path.join(project_directory, "custom-disk")
-    custom_root_directory = os.path.join(project_directory, "custom-root")
 
-    logger.info("iso mount point: %s", iso_mount_point)
-    logger.info("custom disk directory: %s", custom_disk_directory)
-    logger.info("custom root directory: %s", custom_root_directory)
+def bench_parser(argv):
+    description = """\
+            Benchmark each build stage with a synthetic casper-style base ISO.
+            No download and no superuser privilege is needed.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py bench', description=description)
+
+    ap.add_argument('work_directory', action='store',
+            help='Where the synthetic ISO and the benchmark files are stored')
+
+    ap.add_argument('-s', '--size', action='store', type=int, default=256, required=False,
+            help="Size of the synthetic rootfs in MB. Default is 256")
+
+    ap.add_argument('-c', '--compressor', action='append', default=None, required=False,
+            help="squashfs compressor to benchmark. Can be repeated. Default is %s" % ' '.join(BENCH_COMPRESSORS))
 
-    kernel_version = get_kernel_version(config, variant)
+    ap.add_argument('-r', '--repeat', action='store', type=int, default=1, required=False,
+            help="Number of runs of each stage. Default is 1")
 
-    # create project path
-    make_directories(project_directory)
+    ap.add_argument('--seed', action='store', type=int, default=0, required=False,
+            help="Seed of the synthetic rootfs content. Default is 0")
 
-    # mount iso image, extract rootfs
-    ret = mount(iso_file_path, iso_mount_point)
-    if ret > 0:
-        logger.error("mount failed, ret: %s", ret)
-        sys.exit(2)
+    ap.add_argument('-o', '--results', action='store', default=None, required=False,
+            help="JSON lines file the results are appended to. Default is '<work_directory>/bench-results.jsonl'")
 
-    copy_original_iso_files(iso_mount_point, custom_disk_directory)
-    extract_squashfs(iso_mount_point, custom_root_directory)
+    return ap.parse_args(argv)
 
-    # unmount source-disk
-    unmount(iso_mount_point)
-    target_directory = project_directory
 
-    sources_list = get_sources_list(config, variant)
-    if sources_list:
-        add_sources_list(target_directory, sources_list)
+def run_bench(argv):
+    args = bench_parser(argv)
+    results = run_benchmarks(args.work_directory, args.size, args.compressor, args.repeat,
+            args.results, args.seed)
+    return 1 if any(result['status'] == 'failed' for result in results) else 0
 
-    # prepare script for installing kernel and userspace packages in chroot/container
-    packages_list = get_packages_list(config, variant)
-    urls = get_kernel_overlays(config, variant)
 
-    # generate installing packages, kernel scripts
-    do_script(target_directory, packages_list, urls, kernel_version, proxy_path)
+def daemon_parser(argv):
+    description = """\
+            Run the build daemon. Build requests are queued by priority and
+            the output images are served over a local HTTP API.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py daemon', description=description)
+
+    ap.add_argument('state_directory', action='store',
+            help='Where the jobs, logs and project directories are stored')
 
-    # spawn the chroot
-    create_virtual_environment(custom_root_directory)
+    ap.add_argument('-l', '--listen', action='store', default=DAEMON_ADDRESS, required=False,
+            help="host:port or path of a Unix socket to listen on. Default is %s" % DAEMON_ADDRESS)
 
-    # exit from chroot
-    remove_apt_proxy(custom_root_directory)
+    ap.add_argument('-j', '--jobs', action='store', type=int, default=1, required=False,
+            help="Number of builds run at the same time. Default is 1")
+
+    ap.add_argument('-b', '--backend', action='store', default=None, choices=sorted(BACKENDS),
+            help="Default backend of the builds. Default is the build default")
+
+    ap.add_argument('--apt-proxy', action='store', nargs='?', const=PROXY_ADDRESS, default=None,
+            help="Run the caching apt proxy on host:port for the builds. Default address is %s" % PROXY_ADDRESS)
+
+    return ap.parse_args(argv)
+
+
+def run_daemon_command(argv):
+    args = daemon_parser(argv)
+    return run_daemon(args.state_directory, args.listen, args.jobs, args.backend, args.apt_proxy)
+
+
+def proxy_parser(argv):
+    description = """\
+            Run the caching apt proxy shared by the builds with apt_cache_proxy
+            in the configuration.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py proxy', description=description)
+
+    ap.add_argument('cache_directory', action='store',
+            help='Where the downloaded packages are stored')
+
+    ap.add_argument('-l', '--listen', action='store', default=PROXY_ADDRESS, required=False,
+            help="host:port to listen on. Default is %s" % PROXY_ADDRESS)
+
+    return ap.parse_args(argv)
+
+
+def run_proxy_command(argv):
+    args = proxy_parser(argv)
+    return run_proxy(args.cache_directory, args.listen)
+
+
+def cache_server_parser(argv):
+    description = """\
+            Run the content-addressed artifact cache shared by the build farm.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py cache-server', description=description)
+
+    ap.add_argument('directory', action='store',
+            help='Where the blobs and refs are stored')
+
+    ap.add_argument('-l', '--listen', action='store', default=CACHE_SERVER_ADDRESS, required=False,
+            help="host:port or path of a Unix socket to listen on. Default is %s" % CACHE_SERVER_ADDRESS)
+
+    return ap.parse_args(argv)
+
+
+def run_cache_server_command(argv):
+    args = cache_server_parser(argv)
+    return run_cache_server(args.directory, args.listen)
+
+
+def coordinator_parser(argv):
+    description = """\
+            Hand out one build job per variant of the configuration to the workers.
+            Exit when all jobs are finished, with code 1 if any failed.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py coordinator', description=description)
+
+    ap.add_argument('configuration', action='store',
+            help='Path to config.json')
 
-    # modify metadata such as release description, manifest outside of chroot
-    modify_release_description(custom_root_directory)
-    create_filesystem_manifest(custom_root_directory, custom_disk_directory)
+    ap.add_argument('-t', '--variant', action='append', default=None, required=False,
+            help="Variant to build. Can be repeated. Default is all variants")
 
-    # create image
-    images_types = get_image_types(config, variant)
-    for image_type in images_types.split(' '):
-        if 'iso' in image_type:
-            # create image with iso format
-            do_iso_image(project_directory, iso_file_path, output_iso_path,
-                custom_root_directory, custom_disk_directory, kernel_version)
+    ap.add_argument('-l', '--listen', action='store', default=COORDINATOR_ADDRESS, required=False,
+            help="host:port to listen on. Default is %s" % COORDINATOR_ADDRESS)
 
-        else:
-            logger.error("Unknown image type %s", image_type)
+    ap.add_argument('--lease-timeout', action='store', type=int, default=LEASE_TIMEOUT, required=False,
+            help="Seconds without heartbeat before a job is given to another worker. Default is %s" % LEASE_TIMEOUT)
 
-    unmount(iso_mount_point)
+    ap.add_argument('-c', '--cache', action='store', default=None, required=False,
+            help="URL of the cache server, to download the outputs")
 
-    # clean up the project directory
-    if not keep_project:
-        do_cleanup(project_directory, output_iso_path)
+    ap.add_argument('-o', '--output-directory', action='store', default=None, required=False,
+            help="Where the outputs are downloaded to, in a directory per variant")
+
+    return ap.parse_args(argv)
+
+
+def run_coordinator_command(argv):
+    args = coordinator_parser(argv)
+    config = load_config(args.configuration)
+    if not config:
+        logger.error("Configuration file is not found at %s", args.configuration)
+        return 1
+    return run_coordinator(config, args.variant, args.listen, args.lease_timeout, args.cache,
+            args.output_directory)
+
+
+def worker_parser(argv):
+    description = """\
+            Pull build jobs from the coordinator until none is left.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py worker', description=description)
+
+    ap.add_argument('coordinator', action='store',
+            help='URL of the coordinator, e.g. http://%s' % COORDINATOR_ADDRESS)
+
+    ap.add_argument('work_directory', action='store',
+            help='Where the local cache and project directories of this worker are stored')
+
+    ap.add_argument('-c', '--cache', action='store', required=True,
+            help="URL of the cache server, e.g. http://%s" % CACHE_SERVER_ADDRESS)
+
+    ap.add_argument('-b', '--backend', action='store', default=BACKEND_HOST, choices=sorted(BACKENDS),
+            help="Backend of the builds. Default is 'host'")
+
+    ap.add_argument('-n', '--name', action='store', default=None, required=False,
+            help="Name of this worker. Default is <hostname>-<pid>")
+
+    ap.add_argument('--once', action='store_true',
+            help="Build at most one job and exit")
+
+    return ap.parse_args(argv)
+
+
+def run_worker_command(argv):
+    args = worker_parser(argv)
+    return run_worker(args.coordinator, args.cache, args.work_directory, args.backend, args.name,
+            args.once)
+
+
+def mirror_parser(argv):
+    description = """\
+            Write a local apt repository with the packages of the variants and
+            their dependencies, one suite per variant. Builds with the local_mirror
+            config install from it without network.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py mirror', description=description)
+
+    ap.add_argument('configuration', action='store',
+            help='Path to config.json')
+
+    ap.add_argument('mirror_directory', action='store',
+            help='Where the repository is written')
+
+    ap.add_argument('-t', '--variant', action='append', default=None, required=False,
+            help="Variant to include. Can be repeated. Default is all variants")
+
+    ap.add_argument('-k', '--key', action='store', default=None, required=False,
+            help="gpg key to sign the repository with. Default is an unsigned, trusted repository")
+
+    return ap.parse_args(argv)
+
+
+def run_mirror_command(argv):
+    args = mirror_parser(argv)
+    config = load_config(args.configuration)
+    if not config:
+        logger.error("Configuration file is not found at %s", args.configuration)
+        return 1
+    try:
+        return create_mirror(config, args.variant, args.mirror_directory, args.key)
+    except BuildError as exception:
+        logger.error("%s", exception)
+        return exception.exit_code
+
+
+def inspect_parser(argv):
+    description = """\
+            Inspect a base ISO or a squashfs without mounting or extracting it:
+            list and read paths, extract single paths, show the kernels and packages.
+            """
+    ap = argparse.ArgumentParser(prog='build_image.py inspect', description=description)
+
+    ap.add_argument('image', action='store',
+            help='Path to the ISO or the squashfs')
+
+    ap.add_argument('action', action='store', choices=INSPECT_ACTIONS,
+            help="What to show")
+
+    ap.add_argument('paths', action='store', nargs='*',
+            help="Paths in the rootfs for ls, cat and extract")
+
+    ap.add_argument('-o', '--output', action='store', default=None, required=False,
+            help="Directory the paths are extracted to. Default is the current directory")
+
+    return ap.parse_args(argv)
+
+
+def run_inspect_command(argv):
+    args = inspect_parser(argv)
+    if args.action in ('cat', 'extract') and not args.paths:
+        logger.error("%s needs at least one path", args.action)
+        return 1
+    return inspect_image(args.image, args.action, args.paths, args.output)
+
+
+# auxiliary commands, e.g. build_image.py flash <image> <device>
+COMMANDS = {
+    'flash': run_flash,
+    'stats': run_stats,
+    'bench': run_bench,
+    'daemon': run_daemon_command,
+    'cache-server': run_cache_server_command,
+    'coordinator': run_coordinator_command,
+    'worker': run_worker_command,
+    'mirror': run_mirror_command,
+    'proxy': run_proxy_command,
+    'inspect': run_inspect_command,
+}
+
+
+def run():
+    args = parser()
+
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Set logger level to DEBUG")
+
+    logger.info("project name is %s", args.project_name)
+    logger.info("configuration path is %s", args.configuration)
+    if args.proxy:
+        logger.info("proxy path: %s", args.proxy)
+
+    spec = BuildSpec(args.project_directory, args.configuration, variant=args.variant,
+            project_name=args.project_name, output_file=args.output_file, proxy=args.proxy,
+            keep_project=args.keep_project, backend=args.backend, trace=args.trace,
+            ignore_space=args.ignore_space)
+    builder = Builder()
+
+    try:
+        if args.plan:
+            plan = builder.plan(spec)
+            show_build_plan(plan)
+            for directory, needed, free in plan['insufficient']:
+                logger.error("Not enough free space in %s: need %.1fMB, free %.1fMB",
+                        directory, needed / 1024 / 1024, free / 1024 / 1024)
+            return 1 if plan['insufficient'] else 0
+
+        result = builder.build(spec)
+    except BuildError as exception:
+        logger.error("%s", exception)
+        return exception.exit_code
+
+    for output in result.outputs:
+        logger.info("Output %s", output)
+    return 0
 
 
 if __name__ == '__main__':
-    run()
-    sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
+    sys.exit(run())
 
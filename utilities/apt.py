@@ -0,0 +1,663 @@
+"""
+Host-side apt. Read the sources of the rootfs and the config, load the
+Packages indexes, resolve the dependency closure of the packages against
+the dpkg status of the rootfs and download the .deb files concurrently
+into the artifact cache before the container starts. apt in the container
+finds them in /var/cache/apt/archives and verifies them as usual.
+
+get_sources() - deb sources of the rootfs and the config
+load_indexes() - download and parse the Packages indexes
+resolve_packages() - dependency closure of the packages
+fetch_packages() - concurrent download of the .deb files
+prefetch_packages() - all of the above, linked into the apt cache of the rootfs
+"""
+
+import concurrent.futures
+import glob
+import gzip
+import hashlib
+import http.client
+import lzma
+import os
+import re
+import shutil
+import threading
+import urllib.parse
+
+from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
+from utilities.dpkg import iter_deb822, iter_dpkg_status, get_dpkg_directory, get_native_architecture
+from utilities.fastest_mirror import rewrite_sources
+
+logger = create_logger(__name__)
+
+APT_CACHE_DIRECTORY = "apt"
+APT_ARCHIVES_DIRECTORY = os.path.join('var', 'cache', 'apt', 'archives')
+FETCH_JOBS = 8
+CHUNK_SIZE = 1024 * 1024
+# index files in order of preference
+INDEX_COMPRESSIONS = [('.xz', lzma.decompress), ('.gz', gzip.decompress), ('', bytes)]
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+RELATION_PATTERN = re.compile(r'^([^\s(\[<]+)\s*(?:\(\s*([<>=]+)\s*([^)\s]+)\s*\))?')
+
+
+class FetchError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Persistent HTTP connections, one per host and thread
+    """
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get_connections(self):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        return self.local.connections
+
+    def get_connection(self, scheme, netloc):
+        connections = self.get_connections()
+        key = (scheme, netloc)
+        if key not in connections:
+            if scheme == 'https':
+                connections[key] = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connections[key] = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return connections[key]
+
+    def drop_connection(self, scheme, netloc):
+        connection = self.get_connections().pop((scheme, netloc), None)
+        if connection:
+            connection.close()
+
+    def open(self, url, headers=None, redirects=5):
+        """
+        Return the response of GET url. The body must be read before the next request
+        on the same connection. A stale keep-alive connection is reopened once.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        for attempt in range(2):
+            connection = self.get_connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers=headers or {})
+                response = connection.getresponse()
+                break
+            except (http.client.HTTPException, OSError):
+                self.drop_connection(parts.scheme, parts.netloc)
+                if attempt:
+                    raise
+
+        if response.status in REDIRECT_CODES and redirects:
+            location = urllib.parse.urljoin(url, response.getheader('Location'))
+            response.read()
+            return self.open(location, headers, redirects - 1)
+
+        return response
+
+
+def read_url(pool, url):
+    """
+    Return content of http(s) or file url, None if not found
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == 'file':
+        path = urllib.parse.unquote(parts.path)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    response = pool.open(url)
+    data = response.read()
+    if response.status == 404:
+        return None
+    if response.status != 200:
+        raise FetchError("GET %s: %s %s" % (url, response.status, response.reason))
+    return data
+
+
+def download_url(pool, url, file_path, sha256=None):
+    """
+    Download url to file_path and verify the sha256.
+    Return: number of bytes
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = "%s.%d.part" % (file_path, threading.get_ident())
+    digest = hashlib.sha256()
+    size = 0
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == 'file':
+        source = open(urllib.parse.unquote(parts.path), 'rb')
+    else:
+        # the pooled connection is kept open for the next request
+        source = pool.open(url)
+        if source.status != 200:
+            source.read()
+            raise FetchError("GET %s: %s %s" % (url, source.status, source.reason))
+
+    with open(temp_path, 'wb') as f:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    if parts.scheme == 'file':
+        source.close()
+
+    if sha256 and digest.hexdigest() != sha256:
+        os.remove(temp_path)
+        raise FetchError("Checksum mismatch of %s" % url)
+
+    os.replace(temp_path, file_path)
+    return size
+
+
+def parse_source_line(line):
+    """
+    Parse a one-line-style 'deb [options] uri suite [component...]'.
+    Return dictionary or None.
+    """
+    line = line.split('#', 1)[0].strip()
+    words = line.split()
+    if len(words) < 3 or words[0] != 'deb':
+        return None
+
+    options = {}
+    words = words[1:]
+    if words[0].startswith('['):
+        end = next(index for index, word in enumerate(words) if word.endswith(']'))
+        for option in ' '.join(words[:end + 1]).strip('[]').split():
+            key, _, value = option.partition('=')
+            options[key] = value
+        words = words[end + 1:]
+
+    if len(words) < 2 or words[0].startswith('cdrom:'):
+        return None
+    return {"uri": words[0].rstrip('/'), "suite": words[1], "components": words[2:], "options": options}
+
+
+def get_deb822_options(stanza):
+    """
+    Return the one-line style options arch and signed-by of a deb822 stanza.
+    A key embedded in Signed-By is kept as the armored key.
+    """
+    options = {}
+    if stanza.get('Architectures'):
+        options['arch'] = ','.join(stanza['Architectures'].split())
+
+    signed_by = stanza.get('Signed-By', '').strip()
+    if 'BEGIN PGP' in signed_by:
+        # an empty line of the key is written as a single dot
+        lines = ['' if line.strip() == '.' else line.strip() for line in signed_by.split('\n')]
+        options['signed-by'] = '\n'.join(lines).strip() + '\n'
+    elif signed_by:
+        options['signed-by'] = ','.join(signed_by.replace(',', ' ').split())
+    return options
+
+
+def get_sources(custom_root_directory, sources_list=None):
+    """
+    Return the deb sources of the rootfs sources.list, sources.list.d and
+    the source_list entries of the config, without duplicates
+    """
+    lines = []
+    apt_directory = os.path.join(custom_root_directory, 'etc', 'apt')
+    list_files = [os.path.join(apt_directory, 'sources.list')]
+    list_files += sorted(glob.glob(os.path.join(apt_directory, 'sources.list.d', '*.list')))
+    for list_file in list_files:
+        if os.path.isfile(list_file):
+            with open(list_file, 'r') as f:
+                lines += f.readlines()
+    lines += sources_list or []
+
+    sources = [source for source in map(parse_source_line, lines) if source]
+
+    # deb822 style sources
+    for sources_file in sorted(glob.glob(os.path.join(apt_directory, 'sources.list.d', '*.sources'))):
+        with open(sources_file, 'r') as f:
+            for stanza in iter_deb822(f):
+                if 'deb' not in stanza.get('Types', '').split() or stanza.get('Enabled') == 'no':
+                    continue
+                for uri in stanza.get('URIs', '').split():
+                    for suite in stanza.get('Suites', '').split():
+                        sources.append({"uri": uri.rstrip('/'), "suite": suite,
+                            "components": stanza.get('Components', '').split(),
+                            "options": get_deb822_options(stanza)})
+
+    unique = []
+    for source in sources:
+        if source not in unique:
+            unique.append(source)
+    return unique
+
+
+def get_release_hashes(pool, source):
+    """
+    Return dictionary of path to sha256 from InRelease or Release of the suite
+    """
+    if source['suite'].endswith('/'):
+        base = "%s/%s" % (source['uri'], source['suite'].rstrip('/'))
+    else:
+        base = "%s/dists/%s" % (source['uri'], source['suite'])
+
+    for name in ['InRelease', 'Release']:
+        data = read_url(pool, "%s/%s" % (base, name))
+        if data is None:
+            continue
+        hashes = {}
+        in_sha256 = False
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            if not line.startswith(' '):
+                in_sha256 = line.startswith('SHA256:')
+                continue
+            words = line.split()
+            if in_sha256 and len(words) == 3:
+                hashes[words[2]] = words[0]
+        return hashes
+
+    return {}
+
+
+def get_index_paths(source, architecture):
+    """
+    Return list of (base url, path of Packages relative to the Release file)
+    """
+    if source['suite'].endswith('/'):
+        # flat repository, deb uri ./
+        base = "%s/%s" % (source['uri'], source['suite'].rstrip('/'))
+        return [(base, 'Packages')]
+
+    base = "%s/dists/%s" % (source['uri'], source['suite'])
+    return [(base, "%s/binary-%s/Packages" % (component, architecture))
+            for component in source['components']]
+
+
+def load_index(pool, cache_directory, base, path, hashes):
+    """
+    Return the content of the Packages index, cached by its sha256 in the Release file
+    """
+    lists_directory = os.path.join(cache_directory, APT_CACHE_DIRECTORY, 'lists')
+    for extension, decompress in INDEX_COMPRESSIONS:
+        sha256 = hashes.get(path + extension)
+        if hashes and not sha256:
+            continue
+        cached = os.path.join(lists_directory, sha256) if sha256 else None
+        if cached and os.path.isfile(cached):
+            with open(cached, 'rb') as f:
+                return decompress(f.read())
+
+        data = read_url(pool, "%s/%s%s" % (base, path, extension))
+        if data is None:
+            continue
+        if sha256:
+            if hashlib.sha256(data).hexdigest() != sha256:
+                raise FetchError("Checksum mismatch of %s/%s%s" % (base, path, extension))
+            os.makedirs(lists_directory, exist_ok=True)
+            with open(cached, 'wb') as f:
+                f.write(data)
+        return decompress(data)
+
+    return None
+
+
+def load_indexes(sources, architecture, cache_directory, pool=None):
+    """
+    Return the package index: dictionary of name to list of stanzas,
+    each with the URL of its .deb in '_url'
+    """
+    pool = pool or ConnectionPool()
+    index = {}
+    for source in sources:
+        architectures = source['options'].get('arch', architecture).split(',')
+        if architecture not in architectures:
+            continue
+        try:
+            hashes = get_release_hashes(pool, source)
+        except (FetchError, OSError, http.client.HTTPException) as exception:
+            logger.warning("Cannot read the release of %s %s: %s", source['uri'], source['suite'], exception)
+            continue
+
+        for base, path in get_index_paths(source, architecture):
+            try:
+                data = load_index(pool, cache_directory, base, path, hashes)
+            except (FetchError, OSError, http.client.HTTPException, lzma.LZMAError) as exception:
+                logger.warning("Cannot load %s/%s: %s", base, path, exception)
+                continue
+            if data is None:
+                logger.warning("No index %s/%s", base, path)
+                continue
+            count = 0
+            for stanza in iter_deb822(data.decode('utf-8', errors='replace').splitlines()):
+                if 'Package' not in stanza or 'Filename' not in stanza:
+                    continue
+                stanza['_url'] = "%s/%s" % (source['uri'], urllib.parse.quote(stanza['Filename']))
+                index.setdefault(stanza['Package'], []).append(stanza)
+                count += 1
+            logger.info("Loaded %d packages from %s/%s", count, base, path)
+
+    return index
+
+
+def get_installed_packages(custom_root_directory):
+    """
+    Return dictionary of name to stanza of the installed packages in the rootfs
+    """
+    installed = {}
+    status_path = os.path.join(get_dpkg_directory(custom_root_directory), 'status')
+    if not os.path.isfile(status_path):
+        return installed
+    for stanza in iter_dpkg_status(status_path):
+        if stanza.get('Status', '').endswith(' installed') and 'Package' in stanza:
+            installed[stanza['Package']] = stanza
+    return installed
+
+
+def get_character_order(character):
+    # order of a character in a Debian version, ~ sorts before everything
+    if not character or character.isdigit():
+        return 0
+    if character.isalpha():
+        return ord(character)
+    if character == '~':
+        return -1
+    return ord(character) + 256
+
+
+def compare_version_part(a, b):
+    """
+    Compare upstream versions or revisions with the dpkg algorithm
+    """
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = get_character_order(a[i] if i < len(a) else '')
+            bc = get_character_order(b[j] if j < len(b) else '')
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+
+        start = i
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        a_number = int(a[start:i] or 0)
+        start = j
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        b_number = int(b[start:j] or 0)
+        if a_number != b_number:
+            return a_number - b_number
+
+    return 0
+
+
+def split_version(version):
+    epoch, _, rest = version.partition(':') if ':' in version else ('0', '', version)
+    upstream, _, revision = rest.rpartition('-') if '-' in rest else (rest, '', '')
+    return int(epoch or 0), upstream, revision
+
+
+def compare_versions(a, b):
+    """
+    Return negative, zero or positive like dpkg --compare-versions
+    """
+    a_epoch, a_upstream, a_revision = split_version(a)
+    b_epoch, b_upstream, b_revision = split_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return compare_version_part(a_upstream, b_upstream) or compare_version_part(a_revision, b_revision)
+
+
+def check_relation(version, operator, required):
+    if not operator:
+        return True
+    if version is None:
+        return False
+    result = compare_versions(version, required)
+    return {
+        '<<': result < 0,
+        '<=': result <= 0,
+        '<': result <= 0,
+        '=': result == 0,
+        '>=': result >= 0,
+        '>': result >= 0,
+        '>>': result > 0,
+    }.get(operator, False)
+
+
+def parse_relations(value):
+    """
+    Parse Depends-like field. Return list of groups of alternatives (name, operator, version).
+    """
+    groups = []
+    for group in value.split(','):
+        alternatives = []
+        for alternative in group.split('|'):
+            match = RELATION_PATTERN.match(alternative.strip())
+            if not match:
+                continue
+            name = match.group(1).split(':')[0]
+            alternatives.append((name, match.group(2), match.group(3)))
+        if alternatives:
+            groups.append(alternatives)
+    return groups
+
+
+def get_provides(stanza):
+    """
+    Return list of (virtual package, version) provided by the stanza
+    """
+    return [(name, version if operator == '=' else None)
+            for group in parse_relations(stanza.get('Provides', '')) for name, operator, version in group]
+
+
+class Resolver:
+    """
+    Dependency closure of packages over a package index and the installed packages
+    """
+    def __init__(self, index, installed, architecture, recommends=True):
+        self.index = index
+        self.installed = installed
+        self.architectures = (architecture, 'all')
+        self.recommends = recommends
+        self.selected = {}
+        self.unresolved = []
+        self.providers = {}
+        self.installed_providers = {}
+        for stanzas in index.values():
+            for stanza in stanzas:
+                for name, version in get_provides(stanza):
+                    self.providers.setdefault(name, []).append((stanza, version))
+        for stanza in installed.values():
+            for name, version in get_provides(stanza):
+                self.installed_providers.setdefault(name, []).append(version)
+
+    def is_satisfied_by(self, packages, providers, name, operator, version):
+        if name in packages and check_relation(packages[name].get('Version'), operator, version):
+            return True
+        return any(check_relation(provided, operator, version) for provided in providers.get(name, []))
+
+    def is_satisfied(self, name, operator, version):
+        selected_providers = {}
+        for stanza in self.selected.values():
+            for provided, provided_version in get_provides(stanza):
+                selected_providers.setdefault(provided, []).append(provided_version)
+        return (self.is_satisfied_by(self.installed, self.installed_providers, name, operator, version)
+                or self.is_satisfied_by(self.selected, selected_providers, name, operator, version))
+
+    def find_candidate(self, name, operator=None, version=None):
+        """
+        Return the stanza of the highest version which satisfies the relation
+        """
+        candidates = [stanza for stanza in self.index.get(name, [])
+                if stanza.get('Architecture') in self.architectures
+                and check_relation(stanza.get('Version'), operator, version)]
+        if not candidates:
+            candidates = [stanza for stanza, provided in self.providers.get(name, [])
+                    if stanza.get('Architecture') in self.architectures
+                    and check_relation(provided, operator, version)]
+        if not candidates:
+            return None
+
+        best = candidates[0]
+        for stanza in candidates[1:]:
+            if compare_versions(stanza['Version'], best['Version']) > 0:
+                best = stanza
+        return best
+
+    def resolve(self, packages):
+        """
+        Return dictionary of name to stanza of the packages to download
+        """
+        pending = []
+        for package in packages:
+            candidate = self.find_candidate(package)
+            if not candidate:
+                self.unresolved.append((package, package))
+                continue
+            installed = self.installed.get(candidate['Package'])
+            # apt-get install upgrades an installed package to the candidate
+            if installed and compare_versions(candidate['Version'], installed.get('Version', '0')) <= 0:
+                continue
+            pending.append(candidate)
+
+        fields = ['Pre-Depends', 'Depends'] + (['Recommends'] if self.recommends else [])
+        while pending:
+            stanza = pending.pop(0)
+            if stanza['Package'] in self.selected:
+                continue
+            self.selected[stanza['Package']] = stanza
+            for field in fields:
+                for group in parse_relations(stanza.get(field, '')):
+                    if any(self.is_satisfied(*alternative) for alternative in group):
+                        continue
+                    for alternative in group:
+                        candidate = self.find_candidate(*alternative)
+                        if candidate:
+                            pending.append(candidate)
+                            break
+                    else:
+                        if field != 'Recommends':
+                            self.unresolved.append((stanza['Package'], group))
+
+        return self.selected
+
+
+def resolve_packages(packages, index, installed, architecture, recommends=True):
+    """
+    Return dictionary of name to stanza of the packages to download and
+    list of unresolved dependencies
+    """
+    resolver = Resolver(index, installed, architecture, recommends)
+    selected = resolver.resolve(packages)
+    for package, group in resolver.unresolved:
+        logger.warning("Cannot resolve %s of %s", group, package)
+    return selected, resolver.unresolved
+
+
+def get_archive_name(stanza):
+    """
+    Return file name of the .deb as apt stores it in /var/cache/apt/archives
+    """
+    version = stanza['Version'].replace(':', '%3a')
+    return "%s_%s_%s.deb" % (stanza['Package'], version, stanza['Architecture'])
+
+
+def get_archives_directory(cache_directory):
+    return os.path.join(cache_directory, APT_CACHE_DIRECTORY, 'archives')
+
+
+def fetch_packages(stanzas, cache_directory, jobs=FETCH_JOBS, pool=None):
+    """
+    Download the .deb files into the artifact cache with a pool of threads.
+    Return list of paths of the .deb files.
+    """
+    pool = pool or ConnectionPool()
+    archives_directory = get_archives_directory(cache_directory)
+    os.makedirs(archives_directory, exist_ok=True)
+
+    def fetch(stanza):
+        file_path = os.path.join(archives_directory, get_archive_name(stanza))
+        if os.path.isfile(file_path):
+            return file_path, 0
+        return file_path, download_url(pool, stanza['_url'], file_path, stanza.get('SHA256'))
+
+    paths = []
+    total = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(fetch, stanza): stanza for stanza in stanzas}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                file_path, size = future.result()
+            except (FetchError, OSError, http.client.HTTPException) as exception:
+                logger.warning("Cannot fetch %s: %s", futures[future]['Package'], exception)
+                continue
+            paths.append(file_path)
+            total += size
+
+    logger.info("Fetched %d packages, %d bytes downloaded", len(paths), total)
+    return paths
+
+
+def link_archives(paths, custom_root_directory):
+    """
+    Hard link the .deb files into the apt cache of the rootfs, copy if on another file system.
+    Return list of linked paths.
+    """
+    archives_directory = os.path.join(custom_root_directory, APT_ARCHIVES_DIRECTORY)
+    os.makedirs(archives_directory, exist_ok=True)
+    linked = []
+    for path in paths:
+        target = os.path.join(archives_directory, os.path.basename(path))
+        if os.path.exists(target):
+            continue
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+        linked.append(target)
+    return linked
+
+
+def remove_archives(paths):
+    """
+    Remove the linked .deb files from the rootfs after the installation
+    """
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@trace_stage
+def prefetch_packages(custom_root_directory, packages, sources_list, cache_directory, jobs=FETCH_JOBS,
+        mirrors=None):
+    """
+    Resolve and download the packages before the container starts, from the
+    best mirror of each source if it has mirrors.
+    Failures are not fatal, apt in the container downloads what is missing.
+    Return list of .deb files linked into the rootfs.
+    """
+    if not packages:
+        return []
+
+    installed = get_installed_packages(custom_root_directory)
+    architecture = get_native_architecture(custom_root_directory,
+            {name: {"architecture": stanza.get('Architecture')} for name, stanza in installed.items()})
+    if not architecture:
+        logger.warning("Unknown architecture of %s, skip prefetch", custom_root_directory)
+        return []
+
+    pool = ConnectionPool()
+    sources = rewrite_sources(mirrors, get_sources(custom_root_directory, sources_list), cache_directory)
+    index = load_indexes(sources, architecture, cache_directory, pool)
+    selected, _ = resolve_packages(packages, index, installed, architecture)
+    logger.info("Resolved %d packages to download for %s", len(selected), ' '.join(packages))
+
+    paths = fetch_packages(list(selected.values()), cache_directory, jobs)
+    return link_archives(paths, custom_root_directory)
@@ -0,0 +1,346 @@
+"""
+Execution backends for the privileged operations: mount, container run,
+loop device and the commands reading the rootfs with its owners. The
+backend is selected once with set_backend() and the operations are looked
+up with get_operation().
+
+host   - mount, systemd-nspawn and losetup on the host. Need superuser privilege.
+userns - no superuser privilege. The ISO is extracted instead of mounted and the
+         container runs in a user namespace with bwrap or unshare.
+         Loop devices are not supported, use the rootless img builder.
+fake   - record the commands instead of running the container, for tests and
+         benchmarks of the pipeline. The ISO is extracted and the commands
+         reading the rootfs are run as in userns.
+"""
+
+import os
+import pwd
+import shlex
+import shutil
+import tempfile
+
+from utilities.logger import create_logger
+from utilities.util import run_cmd, call_cmd
+
+logger = create_logger(__name__)
+
+BACKEND_HOST = "host"
+BACKEND_USERNS = "userns"
+BACKEND_FAKE = "fake"
+
+SHM_DIRECTORY = "/dev/shm"
+
+_backend = BACKEND_HOST
+_recorded_commands = []
+
+
+def host_mount_iso(iso_file_path, iso_mount_point):
+    user_id = 1000
+    group_id = 1000
+    cmd = ("mount --options loop,uid={user_id},gid={group_id} {iso_file_path} {iso_mount_point}").format(
+        user_id=user_id,
+        group_id=group_id,
+        iso_file_path=iso_file_path,
+        iso_mount_point=iso_mount_point
+            )
+    logger.debug(cmd)
+    return call_cmd(cmd)
+
+
+def host_mount_device(device, mount_point):
+    cmd = "mount %s %s" % (device, mount_point)
+    logger.debug("cmd: %s", cmd)
+    return call_cmd(cmd)
+
+
+def host_unmount(mount_point):
+    if os.path.ismount(mount_point):
+        logger.info("Unmount %s", mount_point)
+        cmd = "umount %s" % mount_point
+        logger.debug("cmd: %s", cmd)
+        return call_cmd(cmd)
+    return None
+
+
+def host_run_container(custom_root_directory, script_directory, root_path, script_file,
+        bind_path, machine_name, ro_binds=()):
+    cmd = (
+        'sudo systemd-nspawn'
+        ' --quiet'
+        ' --notify-ready=yes'
+        ' --register=yes'
+        ' --bind-ro="{bind_path}"'
+        ' --bind={script_directory}:{root_path}'
+        '{ro_binds}'
+        ' --machine="{machine_name}"'
+        ' --directory="{directory_path}"'
+        ' /bin/bash "{script_file}"'
+        ).format(
+            bind_path=bind_path,
+            script_directory=script_directory,
+            root_path=root_path,
+            ro_binds=''.join(' --bind-ro=%s:%s' % (source, target) for source, target in ro_binds),
+            machine_name=machine_name,
+            directory_path=custom_root_directory,
+            script_file=script_file,
+        )
+
+    logger.debug("cmd: %s", cmd)
+    return call_cmd(cmd)
+
+
+def host_run_rootfs_cmd(cmd):
+    """
+    Run cmd reading the rootfs without privilege. The files have the owners
+    set in the container on the host, so they are copied as they are.
+    """
+    logger.debug("cmd: %s", cmd)
+    return call_cmd(cmd)
+
+
+def host_attach_loop(disk_path):
+    """
+    Attach the disk image to a free loop device.
+    Return: loop device
+    """
+    cmd = "losetup -fP --show %s" % disk_path
+    logger.debug("cmd: %s", cmd)
+    ret, output = run_cmd(cmd)
+    if ret:
+        logger.error(output)
+        return None
+    return output.strip()
+
+
+def host_detach_loop(loop_device):
+    cmd = "losetup -d %s" % loop_device
+    logger.debug("cmd: %s", cmd)
+    return call_cmd(cmd)
+
+
+def host_mount_tmpfs(mount_point, size):
+    """
+    Mount tmpfs limited to size bytes on mount_point.
+    Return: mount point or None
+    """
+    os.makedirs(mount_point, exist_ok=True)
+    cmd = "mount -t tmpfs -o size=%dM,mode=0755 tmpfs %s" % (-(-size // (1024 * 1024)), mount_point)
+    logger.debug("cmd: %s", cmd)
+    if call_cmd(cmd):
+        return None
+    return mount_point
+
+
+def extract_iso(iso_file_path, iso_mount_point):
+    """
+    Extract the ISO to iso_mount_point with xorriso.
+    This replaces the loop mount when running without superuser privilege.
+    """
+    logger.info("Extract %s to %s", iso_file_path, iso_mount_point)
+    if os.path.isdir(iso_mount_point) and os.listdir(iso_mount_point):
+        logger.info("%s is already extracted", iso_file_path)
+        return 0
+
+    cmd = "xorriso -osirrox on -indev %s -extract / %s" % (iso_file_path, iso_mount_point)
+    logger.debug("cmd: %s", cmd)
+    ret, output = run_cmd(cmd)
+    if ret:
+        logger.error(output)
+        return ret
+
+    # the files in ISO are read only
+    return call_cmd("chmod -R u+w %s" % iso_mount_point)
+
+
+def userns_unmount(mount_point):
+    # the extracted ISO is not a mount point. It is removed with the project directory.
+    return host_unmount(mount_point)
+
+
+def get_userns_container_cmd(custom_root_directory, script_directory, root_path, script_file,
+        bind_path, machine_name, ro_binds=()):
+    """
+    Return command to run the script as root in a user namespace.
+    bwrap is used if installed, else unshare and chroot.
+    """
+    if shutil.which('bwrap'):
+        return (
+            'bwrap'
+            ' --unshare-user --uid 0 --gid 0'
+            ' --unshare-pid --unshare-ipc --unshare-uts'
+            ' --hostname {machine_name}'
+            ' --bind {directory_path} /'
+            ' --dev /dev'
+            ' --proc /proc'
+            ' --ro-bind {bind_path} {bind_path}'
+            ' --bind {script_directory} {root_path}'
+            '{ro_binds}'
+            ' /bin/bash {script_file}'
+            ).format(
+                machine_name=shlex.quote(machine_name),
+                directory_path=shlex.quote(custom_root_directory),
+                bind_path=shlex.quote(bind_path),
+                script_directory=shlex.quote(script_directory),
+                root_path=shlex.quote(root_path),
+                ro_binds=''.join(' --ro-bind %s %s' % (shlex.quote(source), shlex.quote(target))
+                    for source, target in ro_binds),
+                script_file=shlex.quote(script_file),
+            )
+
+    root = shlex.quote(custom_root_directory)
+    script = '; '.join([
+        'mount --rbind /dev {root}/dev',
+        'mount -t proc proc {root}/proc',
+        'mount --bind {script_directory} {root}{root_path}',
+        'mount --bind -o ro {bind_path} {root}{bind_path} 2>/dev/null',
+        ] + [
+        # a read only bind mount needs a remount
+        'mount --bind %s {root}%s && mount -o remount,bind,ro {root}%s' % (
+            shlex.quote(source), shlex.quote(target), shlex.quote(target))
+        for source, target in ro_binds
+        ] + [
+        'exec chroot {root} /bin/bash {script_file}',
+        ]).format(
+            root=root,
+            script_directory=shlex.quote(script_directory),
+            root_path=shlex.quote(root_path),
+            bind_path=shlex.quote(bind_path),
+            script_file=shlex.quote(script_file),
+        )
+    # --map-auto maps the subordinate ids, so dpkg can chown to system users
+    map_auto = " --map-auto" if has_subordinate_ids() else ""
+    return "unshare --user --map-root-user%s --mount --pid --uts --fork sh -c %s" % (
+            map_auto, shlex.quote(script))
+
+
+def userns_run_rootfs_cmd(cmd):
+    """
+    Run cmd reading the rootfs as root of a user namespace with the ids of
+    the container, so the files have the owners set in the container.
+    No superuser privilege is needed.
+    """
+    map_auto = " --map-auto" if has_subordinate_ids() else ""
+    cmd = "unshare --user --map-root-user%s sh -c %s" % (map_auto, shlex.quote(cmd))
+    logger.debug("cmd: %s", cmd)
+    return call_cmd(cmd)
+
+
+def has_subordinate_ids():
+    """
+    Return True if the user has subordinate uids in /etc/subuid
+    """
+    user = pwd.getpwuid(os.getuid()).pw_name
+    try:
+        with open('/etc/subuid', 'r') as f:
+            for line in f:
+                if line.split(':')[0] in (user, str(os.getuid())):
+                    return True
+    except OSError:
+        pass
+    return False
+
+
+def userns_run_container(custom_root_directory, script_directory, root_path, script_file,
+        bind_path, machine_name, ro_binds=()):
+    os.makedirs(os.path.join(custom_root_directory, root_path.lstrip('/')), exist_ok=True)
+    cmd = get_userns_container_cmd(custom_root_directory, script_directory, root_path,
+            script_file, bind_path, machine_name, ro_binds)
+    logger.debug("cmd: %s", cmd)
+    return call_cmd(cmd)
+
+
+def shm_mount_tmpfs(mount_point, size):
+    """
+    tmpfs cannot be mounted without superuser privilege.
+    Use a directory in /dev/shm instead if it has enough free space.
+    Return: directory or None
+    """
+    if not os.path.isdir(SHM_DIRECTORY) or shutil.disk_usage(SHM_DIRECTORY).free < size:
+        logger.warning("Not enough free space in %s", SHM_DIRECTORY)
+        return None
+    return tempfile.mkdtemp(prefix="ubuntu-image-", dir=SHM_DIRECTORY)
+
+
+def unsupported_loop(*args):
+    logger.error("Loop device is not supported by %s backend. Use the img image type", _backend)
+    return None
+
+
+def fake_run_container(custom_root_directory, script_directory, root_path, script_file,
+        bind_path, machine_name, ro_binds=()):
+    cmd = get_userns_container_cmd(custom_root_directory, script_directory, root_path,
+            script_file, bind_path, machine_name, ro_binds)
+    return record_command(cmd)
+
+
+def fake_mount_device(device, mount_point):
+    return record_command("mount %s %s" % (device, mount_point))
+
+
+def fake_attach_loop(disk_path):
+    record_command("losetup -fP --show %s" % disk_path)
+    return "/dev/loop-fake"
+
+
+def fake_detach_loop(loop_device):
+    return record_command("losetup -d %s" % loop_device)
+
+
+def record_command(cmd):
+    logger.info("Record command: %s", cmd)
+    _recorded_commands.append(cmd)
+    return 0
+
+
+def get_recorded_commands():
+    return list(_recorded_commands)
+
+
+BACKENDS = {
+    BACKEND_HOST: {
+        "mount_iso": host_mount_iso,
+        "mount_device": host_mount_device,
+        "unmount": host_unmount,
+        "run_container": host_run_container,
+        "run_rootfs_cmd": host_run_rootfs_cmd,
+        "attach_loop": host_attach_loop,
+        "detach_loop": host_detach_loop,
+        "mount_tmpfs": host_mount_tmpfs,
+    },
+    BACKEND_USERNS: {
+        "mount_iso": extract_iso,
+        "mount_device": unsupported_loop,
+        "unmount": userns_unmount,
+        "run_container": userns_run_container,
+        "run_rootfs_cmd": userns_run_rootfs_cmd,
+        "attach_loop": unsupported_loop,
+        "detach_loop": unsupported_loop,
+        "mount_tmpfs": shm_mount_tmpfs,
+    },
+    BACKEND_FAKE: {
+        "mount_iso": extract_iso,
+        "mount_device": fake_mount_device,
+        "unmount": userns_unmount,
+        "run_container": fake_run_container,
+        "run_rootfs_cmd": userns_run_rootfs_cmd,
+        "attach_loop": fake_attach_loop,
+        "detach_loop": fake_detach_loop,
+        "mount_tmpfs": shm_mount_tmpfs,
+    },
+}
+
+
+def set_backend(name):
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend %s" % name)
+    logger.info("Use %s backend", name)
+    _backend = name
+
+
+def get_backend():
+    return _backend
+
+
+def get_operation(operation):
+    return BACKENDS[_backend][operation]
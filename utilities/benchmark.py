@@ -0,0 +1,415 @@
+"""
+Benchmark the build stages with a synthetic casper-style base ISO.
+No download of the Ubuntu ISO and no superuser privilege is needed.
+Start with run_benchmarks() as entry point.
+
+create_synthetic_rootfs() - deterministic fake rootfs of a given size
+create_synthetic_iso() - casper layout, grub.cfg, vmlinuz/initrd and hybrid EFI boot
+run_benchmarks() - time each stage and append the results to a JSON lines file
+"""
+
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import time
+
+from utilities.logger import create_logger
+from utilities.file_ops import make_directories, delete_directory
+from utilities.telemetry import enable_telemetry, get_spans, trace_span
+from utilities.extract import copy_original_iso_files, extract_squashfs
+from utilities.metadata import create_filesystem_manifest
+from utilities.image_iso import create_squashfs, update_filesystem_size, update_checksums, create_iso_image
+from utilities.util import run_cmd
+
+logger = create_logger(__name__)
+
+BENCH_RESULTS = "bench-results.jsonl"
+BENCH_COMPRESSORS = ['gzip', 'xz', 'lz4', 'zstd']
+SYNTHETIC_KERNEL_VERSION = "5.10.0-1-generic"
+SYNTHETIC_ISO_NAME = "synthetic-casper.iso"
+# tools needed by each stage
+STAGE_TOOLS = {
+    "synthetic_iso": ['mksquashfs', 'xorriso'],
+    "copy_original_iso_files": ['rsync'],
+    "extract_squashfs": ['unsquashfs'],
+    "create_squashfs": ['mksquashfs'],
+    "update_checksums": ['md5sum'],
+    "create_iso_image": ['xorriso'],
+}
+
+GRUB_CFG = """\
+set timeout=5
+menuentry "Try or Install Ubuntu" {
+	set gfxpayload=keep
+	linux	/casper/vmlinuz  file=/cdrom/preseed/ubuntu.seed maybe-ubiquity quiet splash ---
+	initrd	/casper/initrd
+}
+"""
+
+
+def get_missing_tools(stage):
+    return [tool for tool in STAGE_TOOLS.get(stage, []) if not shutil.which(tool)]
+
+
+def get_text_block(rng, size):
+    """
+    Return compressible text made of a small vocabulary
+    """
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 10)))
+            for _ in range(2000)]
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(rng.choices(words, k=12)) + '\n'
+        lines.append(line)
+        length += len(line)
+
+    return ''.join(lines).encode('utf-8')
+
+
+def create_fake_kernel(file_path, version):
+    """
+    Create a vmlinuz placeholder with a valid bzImage setup header,
+    so the kernel version can be read from it
+    """
+    version_string = "%s (buildd@synthetic) #1 SMP" % version
+    setup = bytearray(0x400)
+    setup[0x1f1] = 1
+    setup[0x1fe:0x200] = b'\x55\xaa'
+    setup[0x202:0x206] = b'HdrS'
+    struct.pack_into('<H', setup, 0x206, 0x020f)
+    # kernel_version is an offset from 0x200
+    struct.pack_into('<H', setup, 0x20e, len(setup) - 0x200)
+    data = bytes(setup) + version_string.encode('ascii') + b'\0'
+    with open(file_path, 'wb') as f:
+        f.write(data.ljust(64 * 1024, b'\0'))
+
+
+def get_cpio_newc(files):
+    """
+    Return cpio archive (newc format) of dictionary of name to content
+    """
+    data = b''
+    entries = list(files.items()) + [('TRAILER!!!', None)]
+    for number, (name, content) in enumerate(entries):
+        content = content or b''
+        mode = 0o100644 if name != 'TRAILER!!!' else 0
+        encoded_name = name.encode('utf-8') + b'\0'
+        header = "070701%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X%08X" % (
+                number + 1, mode, 0, 0, 1, 0, len(content), 0, 0, 0, 0, len(encoded_name), 0)
+        data += header.encode('ascii') + encoded_name
+        data += b'\0' * (-len(data) % 4)
+        data += content
+        data += b'\0' * (-len(data) % 4)
+
+    return data
+
+
+def create_fake_initrd(file_path, version):
+    files = {
+        "init": b"#!/bin/sh\nexec /sbin/init\n",
+        "conf/initramfs.conf": b"COMPRESS=gzip\n",
+        "usr/lib/modules/%s/modules.dep" % version: b"",
+    }
+    with open(file_path, 'wb') as f:
+        f.write(gzip.compress(get_cpio_newc(files), mtime=0))
+
+
+def create_dpkg_database(rootfs_directory, package_files):
+    """
+    Create var/lib/dpkg/status and info/<package>.list
+    for dictionary of package name to list of files
+    """
+    dpkg_directory = os.path.join(rootfs_directory, 'var', 'lib', 'dpkg')
+    info_directory = os.path.join(dpkg_directory, 'info')
+    make_directories(info_directory)
+
+    with open(os.path.join(dpkg_directory, 'status'), 'w') as status:
+        for name, files in package_files.items():
+            size = sum(os.path.getsize(os.path.join(rootfs_directory, f.lstrip('/'))) for f in files)
+            status.write("Package: %s\n" % name)
+            status.write("Status: install ok installed\n")
+            status.write("Priority: optional\n")
+            status.write("Installed-Size: %s\n" % (size // 1024 + 1))
+            status.write("Maintainer: Synthetic <synthetic@localhost>\n")
+            status.write("Architecture: amd64\n")
+            status.write("Version: 1.0-%s\n" % len(files))
+            status.write("Description: synthetic package\n\n")
+
+            with open(os.path.join(info_directory, "%s.list" % name), 'w') as f:
+                for file_name in files:
+                    f.write("%s\n" % file_name)
+
+    with open(os.path.join(dpkg_directory, 'arch'), 'w') as f:
+        f.write("amd64\n")
+
+
+def create_synthetic_rootfs(rootfs_directory, size_mb, seed=0, packages=500):
+    """
+    Create a deterministic fake rootfs of about size_mb.
+    About half of the data is compressible text and half is random binary.
+    """
+    logger.info("Create synthetic rootfs of %sMB in %s", size_mb, rootfs_directory)
+    rng = random.Random(seed)
+    text = get_text_block(rng, 4 * 1024 * 1024)
+    directories = ['usr/bin', 'usr/lib/x86_64-linux-gnu', 'usr/share/doc', 'usr/share/locale',
+            'etc', 'opt/synthetic']
+    for directory in directories + ['boot', 'proc', 'run', 'tmp', 'var/crash']:
+        make_directories(os.path.join(rootfs_directory, directory))
+
+    with open(os.path.join(rootfs_directory, 'etc', 'os-release'), 'w') as f:
+        f.write('NAME="Ubuntu"\nPRETTY_NAME="Ubuntu 20.04.3 LTS"\nVERSION_ID="20.04"\n')
+    with open(os.path.join(rootfs_directory, 'etc', 'lsb-release'), 'w') as f:
+        f.write('DISTRIB_ID=Ubuntu\nDISTRIB_DESCRIPTION="Ubuntu 20.04.3 LTS"\n')
+
+    boot_directory = os.path.join(rootfs_directory, 'boot')
+    create_fake_kernel(os.path.join(boot_directory, 'vmlinuz-%s' % SYNTHETIC_KERNEL_VERSION),
+            SYNTHETIC_KERNEL_VERSION)
+    create_fake_initrd(os.path.join(boot_directory, 'initrd.img-%s' % SYNTHETIC_KERNEL_VERSION),
+            SYNTHETIC_KERNEL_VERSION)
+
+    package_files = {"synthetic-%04d" % number: [] for number in range(packages)}
+    package_names = list(package_files)
+    remaining = size_mb * 1024 * 1024
+    number = 0
+    while remaining > 0:
+        size = min(remaining, int(rng.paretovariate(1.2) * 4096), len(text))
+        directory = directories[number % len(directories)]
+        if number % 2:
+            data = rng.randbytes(size)
+            name = "lib%05d.so" % number
+        else:
+            offset = rng.randint(0, len(text) - 1)
+            data = (text[offset:] + text)[:size]
+            name = "file%05d.txt" % number
+        relative_path = os.path.join(directory, name)
+        with open(os.path.join(rootfs_directory, relative_path), 'wb') as f:
+            f.write(data)
+        package_files[package_names[number % packages]].append('/' + relative_path)
+        remaining -= size
+        number += 1
+
+    create_dpkg_database(rootfs_directory, package_files)
+    logger.info("Synthetic rootfs has %s files", number)
+    return number
+
+
+def create_synthetic_iso(work_directory, rootfs_directory):
+    """
+    Create the synthetic base ISO in work_directory from rootfs_directory.
+    Return path to the ISO and to its tree, which can be used as the
+    mount point of the ISO without mounting it.
+    """
+    tree_directory = os.path.join(work_directory, 'synthetic-disk')
+    iso_path = os.path.join(work_directory, SYNTHETIC_ISO_NAME)
+    delete_directory(tree_directory)
+
+    casper_directory = os.path.join(tree_directory, 'casper')
+    grub_directory = os.path.join(tree_directory, 'boot', 'grub')
+    make_directories(casper_directory)
+    make_directories(grub_directory)
+    make_directories(os.path.join(tree_directory, '.disk'))
+
+    with open(os.path.join(tree_directory, '.disk', 'info'), 'w') as f:
+        f.write('Ubuntu 20.04.3 LTS "Synthetic" - Release amd64')
+    with open(os.path.join(grub_directory, 'grub.cfg'), 'w') as f:
+        f.write(GRUB_CFG)
+    with open(os.path.join(casper_directory, 'filesystem.manifest-remove'), 'w') as f:
+        f.write("synthetic-0000\n")
+
+    boot_directory = os.path.join(rootfs_directory, 'boot')
+    shutil.copy(os.path.join(boot_directory, 'vmlinuz-%s' % SYNTHETIC_KERNEL_VERSION),
+            os.path.join(casper_directory, 'vmlinuz'))
+    shutil.copy(os.path.join(boot_directory, 'initrd.img-%s' % SYNTHETIC_KERNEL_VERSION),
+            os.path.join(casper_directory, 'initrd'))
+
+    # EFI boot image for the hybrid layout
+    efi_image = os.path.join(grub_directory, 'efi.img')
+    with open(efi_image, 'wb') as f:
+        f.truncate(4 * 1024 * 1024)
+    if shutil.which('mformat'):
+        run_cmd("mformat -i %s ::" % efi_image)
+
+    cmd = "mksquashfs %s %s -noappend -comp gzip" % (
+            rootfs_directory, os.path.join(casper_directory, 'filesystem.squashfs'))
+    ret, output = run_cmd(cmd)
+    if ret:
+        logger.error(output)
+        return None, tree_directory
+
+    cmd = (
+            'xorriso -as mkisofs'
+            ' -r -J -joliet-long -l -iso-level 3'
+            ' -V "Ubuntu 20.04.3 LTS amd64"'
+            ' -e boot/grub/efi.img -no-emul-boot'
+            ' -append_partition 2 0xef {efi_image}'
+            ' -isohybrid-gpt-basdat'
+            ' -o {iso_path} {tree_directory}'
+        ).format(efi_image=efi_image, iso_path=iso_path, tree_directory=tree_directory)
+    ret, output = run_cmd(cmd)
+    if ret:
+        logger.error(output)
+        return None, tree_directory
+
+    return iso_path, tree_directory
+
+
+def check_exit_code(value):
+    """
+    Return the error of a stage returning the exit code of its command, or None
+    """
+    return "exit code %s" % value if value else None
+
+
+def check_synthetic_iso(value):
+    return "the synthetic ISO is not created" if value[0] is None else None
+
+
+def measure(name, function, *args, outputs=(), check=None):
+    """
+    Run one stage and return its span with the nested commands.
+    The stage failed if it raises, if check returns an error for its
+    return value or if one of the outputs is not created.
+    """
+    missing_tools = get_missing_tools(name)
+    if missing_tools:
+        logger.warning("Skip %s, missing %s", name, ' '.join(missing_tools))
+        return {"stage": name, "status": "skipped", "missing": missing_tools}
+
+    # the outputs of a previous run do not count
+    for output in outputs:
+        if os.path.exists(output):
+            os.remove(output)
+
+    first = len(get_spans())
+    status = "ok"
+    try:
+        with trace_span("bench_%s" % name, "bench"):
+            value = function(*args)
+        error = check(value) if check else None
+        missing = [output for output in outputs if not os.path.exists(output)]
+        if not error and missing:
+            error = "%s is not created" % ', '.join(missing)
+        if error:
+            logger.error("%s failed: %s", name, error)
+            status = "failed"
+    except Exception as exception:
+        logger.error("%s failed: %s", name, exception)
+        status = "failed"
+
+    spans = get_spans()[first:]
+    result = dict(spans[-1])
+    result.update({
+        "stage": name,
+        "status": status,
+        "commands": [span['name'] for span in spans[:-1] if span['category'] == 'command'],
+    })
+    for key in ['name', 'category', 'depth', 'start']:
+        result.pop(key, None)
+
+    return result
+
+
+def get_git_commit():
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    ret, output = run_cmd("git -C %s rev-parse --short HEAD" % directory)
+    return output.strip() if ret == 0 else None
+
+
+def run_benchmarks(work_directory, size_mb=256, compressors=None, repeat=1,
+        results_path=None, seed=0):
+    """
+    Benchmark each stage of the pipeline with the synthetic ISO.
+    The results are appended to results_path as JSON lines.
+    Return list of results.
+    """
+    enable_telemetry()
+    compressors = compressors or BENCH_COMPRESSORS
+    work_directory = os.path.abspath(work_directory)
+    results_path = results_path or os.path.join(work_directory, BENCH_RESULTS)
+    make_directories(work_directory)
+
+    common = {
+        "timestamp": time.time(),
+        "commit": get_git_commit(),
+        "hostname": platform.node(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "rootfs_size_mb": size_mb,
+        "seed": seed,
+    }
+
+    rootfs_directory = os.path.join(work_directory, 'synthetic-rootfs')
+    delete_directory(rootfs_directory)
+
+    results = []
+    iso_path, tree_directory = None, None
+    results.append(measure("synthetic_rootfs", create_synthetic_rootfs, rootfs_directory, size_mb, seed))
+    synthetic_iso_path = os.path.join(work_directory, SYNTHETIC_ISO_NAME)
+    result = measure("synthetic_iso", create_synthetic_iso, work_directory, rootfs_directory,
+            outputs=[synthetic_iso_path], check=check_synthetic_iso)
+    results.append(result)
+    if result['status'] == 'ok':
+        iso_path = synthetic_iso_path
+        tree_directory = os.path.join(work_directory, 'synthetic-disk')
+
+    custom_root_directory = os.path.join(work_directory, 'custom-root')
+    custom_disk_directory = os.path.join(work_directory, 'custom-disk')
+    output_iso_path = os.path.join(work_directory, 'synthetic-custom.iso')
+
+    squashfs = os.path.join(custom_disk_directory, 'casper', 'filesystem.squashfs')
+
+    for run in range(repeat):
+        # (name, function, args, compressor, outputs, check)
+        stages = []
+        if tree_directory:
+            stages.append(("copy_original_iso_files", copy_original_iso_files,
+                (tree_directory, custom_disk_directory), None, (), check_exit_code))
+            stages.append(("extract_squashfs", extract_squashfs,
+                (tree_directory, custom_root_directory), None, (), check_exit_code))
+        else:
+            # without the synthetic ISO, benchmark the rootfs directly
+            custom_root_directory = rootfs_directory
+            make_directories(os.path.join(custom_disk_directory, 'casper'))
+
+        stages.append(("create_filesystem_manifest", create_filesystem_manifest,
+            (custom_root_directory, custom_disk_directory), None, (), None))
+        stages.append(("update_filesystem_size", update_filesystem_size,
+            (custom_root_directory, custom_disk_directory), None, (), None))
+        for compressor in compressors:
+            stages.append(("create_squashfs", create_squashfs,
+                (custom_root_directory, custom_disk_directory, None, compressor), compressor,
+                [squashfs], check_exit_code))
+        stages.append(("update_checksums", update_checksums, (custom_disk_directory,), None, (), None))
+        if iso_path:
+            stages.append(("create_iso_image", create_iso_image,
+                (work_directory, custom_disk_directory, iso_path, output_iso_path), None,
+                [output_iso_path], check_exit_code))
+
+        for name, function, args, compressor, outputs, check in stages:
+            result = measure(name, function, *args, outputs=outputs, check=check)
+            result['run'] = run
+            if compressor:
+                result['compressor'] = compressor
+            if result['status'] == 'ok' and outputs:
+                result['output_size'] = os.path.getsize(outputs[0])
+            results.append(result)
+
+    with open(results_path, 'a') as f:
+        for result in results:
+            record = dict(common)
+            record.update(result)
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    for result in results:
+        if result['status'] == 'ok':
+            logger.info("%-28s %-6s %8.2fs", result['stage'], result.get('compressor', ''), result['wall'])
+        else:
+            logger.info("%-28s %-6s %s", result['stage'], result.get('compressor', ''), result['status'])
+
+    logger.info("Benchmark results appended to %s", results_path)
+    return results
@@ -0,0 +1,313 @@
+"""
+Block map of the output images and sparse aware flashing.
+The block map uses the bmaptool XML format (version 2.0), so the
+generated <image>.bmap can also be used with bmaptool.
+
+create_bmap() - write <image>.bmap with mapped ranges and sha256 per range
+load_bmap() - read the block map
+flash_image() - write only the mapped ranges to a device and verify them
+                by reading them back from the device
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+
+from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
+
+logger = create_logger(__name__)
+
+BMAP_BLOCK_SIZE = 4096
+BMAP_VERSION = "2.0"
+BMAP_CHECKSUM_TYPE = "sha256"
+# data read and written per I/O, must be multiple of the block size
+FLASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def get_mapped_ranges(image_path, block_size=BMAP_BLOCK_SIZE):
+    """
+    Return list of (first_block, last_block) which contain data.
+    Holes of the sparse file are not mapped.
+    """
+    ranges = []
+    fd = os.open(image_path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                # no more data after offset
+                break
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            first = start // block_size
+            last = (end - 1) // block_size
+            if ranges and ranges[-1][1] >= first - 1:
+                ranges[-1] = (ranges[-1][0], max(last, ranges[-1][1]))
+            else:
+                ranges.append((first, last))
+            offset = end
+    finally:
+        os.close(fd)
+
+    return ranges
+
+
+def get_range_checksum(f, first, last, block_size=BMAP_BLOCK_SIZE):
+    checksum = hashlib.sha256()
+    f.seek(first * block_size)
+    remaining = (last - first + 1) * block_size
+    while remaining > 0:
+        data = f.read(min(remaining, FLASH_CHUNK_SIZE))
+        if not data:
+            break
+        checksum.update(data)
+        remaining -= len(data)
+
+    return checksum.hexdigest()
+
+
+@trace_stage
+def create_bmap(image_path, block_size=BMAP_BLOCK_SIZE):
+    """
+    Create <image_path>.bmap next to the image.
+    Return path to the bmap file.
+    """
+    bmap_path = image_path + '.bmap'
+    logger.info("Create block map %s", bmap_path)
+    image_size = os.path.getsize(image_path)
+    blocks_count = -(-image_size // block_size)
+    ranges = get_mapped_ranges(image_path, block_size)
+    mapped_blocks = sum(last - first + 1 for first, last in ranges)
+
+    lines = []
+    with open(image_path, 'rb') as f:
+        for first, last in ranges:
+            checksum = get_range_checksum(f, first, last, block_size)
+            block_range = "%s-%s" % (first, last) if first != last else "%s" % first
+            lines.append('        <Range chksum="%s"> %s </Range>' % (checksum, block_range))
+
+    # the checksum of bmap file is calculated with the checksum field set to zeros
+    zero_checksum = '0' * hashlib.sha256().digest_size * 2
+    content = '\n'.join([
+        '<?xml version="1.0" ?>',
+        '<bmap version="%s">' % BMAP_VERSION,
+        '    <ImageSize> %s </ImageSize>' % image_size,
+        '    <BlockSize> %s </BlockSize>' % block_size,
+        '    <BlocksCount> %s </BlocksCount>' % blocks_count,
+        '    <MappedBlocksCount> %s </MappedBlocksCount>' % mapped_blocks,
+        '    <ChecksumType> %s </ChecksumType>' % BMAP_CHECKSUM_TYPE,
+        '    <BmapFileChecksum> %s </BmapFileChecksum>' % zero_checksum,
+        '    <BlockMap>',
+        ] + lines + [
+        '    </BlockMap>',
+        '</bmap>',
+        ''])
+    bmap_checksum = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    content = content.replace(zero_checksum, bmap_checksum, 1)
+
+    with open(bmap_path, 'w') as f:
+        f.write(content)
+
+    logger.info("Mapped %s of %s blocks (%.1f%%)", mapped_blocks, blocks_count,
+            100.0 * mapped_blocks / blocks_count if blocks_count else 0)
+    return bmap_path
+
+
+def load_bmap(bmap_path):
+    """
+    Return dictionary of image_size, block_size and
+    ranges as list of (first_block, last_block, checksum)
+    """
+    logger.info("Load block map %s", bmap_path)
+    with open(bmap_path, 'r') as f:
+        content = f.read()
+
+    root = ElementTree.fromstring(content)
+    bmap_checksum = root.findtext('BmapFileChecksum', '').strip()
+    if bmap_checksum:
+        zero_checksum = '0' * len(bmap_checksum)
+        expected = hashlib.sha256(content.replace(bmap_checksum, zero_checksum, 1).encode('utf-8')).hexdigest()
+        if expected != bmap_checksum:
+            raise ValueError("Block map %s is corrupted" % bmap_path)
+
+    ranges = []
+    for item in root.find('BlockMap'):
+        result = re.match(r'\s*(\d+)(?:-(\d+))?\s*', item.text)
+        first = int(result.group(1))
+        last = int(result.group(2)) if result.group(2) else first
+        ranges.append((first, last, item.get('chksum')))
+
+    return {
+        "image_size": int(root.findtext('ImageSize')),
+        "block_size": int(root.findtext('BlockSize')),
+        "ranges": ranges,
+    }
+
+
+def open_target(device_path, image_size):
+    """
+    Open the target with O_DIRECT if possible.
+    A regular file target is truncated to the image size so it stays sparse.
+    Return file descriptor and True if O_DIRECT is used.
+    """
+    flags = os.O_WRONLY
+    if not os.path.exists(device_path) or os.path.isfile(device_path):
+        flags |= os.O_CREAT
+        with open(device_path, 'wb') as f:
+            f.truncate(image_size)
+
+    direct = hasattr(os, 'O_DIRECT')
+    if direct:
+        try:
+            return os.open(device_path, flags | os.O_DIRECT), True
+        except OSError:
+            logger.warning("O_DIRECT is not supported for %s", device_path)
+
+    return os.open(device_path, flags), False
+
+
+def open_readback(device_path):
+    """
+    Open the target to read the written data back from the device, with
+    O_DIRECT if possible, else after dropping its cached pages.
+    Return file descriptor and True if O_DIRECT is used.
+    """
+    if hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(device_path, os.O_RDONLY | os.O_DIRECT), True
+        except OSError:
+            pass
+
+    fd = os.open(device_path, os.O_RDONLY)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    return fd, False
+
+
+def read_range_checksum(fd, view, offset, end, direct):
+    """
+    Return sha256 of the bytes offset to end read from fd into view
+    """
+    checksum = hashlib.sha256()
+    while offset < end:
+        length = min(FLASH_CHUNK_SIZE, end - offset)
+        # O_DIRECT reads whole sectors, the bytes after end are not hashed
+        read_length = -(-length // 512) * 512 if direct else length
+        count = os.preadv(fd, [view[:read_length]], offset)
+        if count <= 0:
+            break
+        count = min(count, length)
+        checksum.update(view[:count])
+        offset += count
+    return checksum.hexdigest()
+
+
+def verify_target(device_path, ranges, block_size, image_size, view):
+    """
+    Read the written ranges back from the device and compare them with
+    (first, last, checksum) of ranges. Return True if all match.
+    """
+    fd, direct = open_readback(device_path)
+    try:
+        for first, last, expected in ranges:
+            offset = first * block_size
+            end = min((last + 1) * block_size, image_size)
+            if read_range_checksum(fd, view, offset, end, direct) != expected:
+                logger.error("Blocks %s-%s read back from %s do not match", first, last, device_path)
+                return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def flash_image(image_path, device_path, bmap_path=None, verify=True):
+    """
+    Write the mapped ranges of image_path to device_path.
+    With verify, the ranges are read back from the device and compared with
+    the checksums of the block map, or of the image without block map.
+    Return 0 on success.
+    """
+    if not bmap_path:
+        bmap_path = image_path + '.bmap'
+
+    if os.path.exists(bmap_path):
+        bmap = load_bmap(bmap_path)
+    else:
+        logger.warning("Block map %s is not exists. Map the image now", bmap_path)
+        image_size = os.path.getsize(image_path)
+        bmap = {
+            "image_size": image_size,
+            "block_size": BMAP_BLOCK_SIZE,
+            "ranges": [(first, last, None) for first, last in get_mapped_ranges(image_path)],
+        }
+
+    image_size = bmap['image_size']
+    block_size = bmap['block_size']
+    logger.info("Flash %s to %s", image_path, device_path)
+
+    src = os.open(image_path, os.O_RDONLY)
+    dst, direct = open_target(device_path, image_size)
+    # page aligned buffer, needed by O_DIRECT
+    buf = mmap.mmap(-1, FLASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    written = 0
+    written_ranges = []
+    start_time = time.monotonic()
+
+    try:
+        os.posix_fadvise(src, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for first, last, expected in bmap['ranges']:
+            offset = first * block_size
+            end = min((last + 1) * block_size, image_size)
+            checksum = hashlib.sha256()
+
+            while offset < end:
+                length = os.preadv(src, [view[:min(FLASH_CHUNK_SIZE, end - offset)]], offset)
+                if length <= 0:
+                    break
+                checksum.update(view[:length])
+                # O_DIRECT needs aligned length. Only the tail of the image may be unaligned.
+                aligned = length - length % 512 if direct else length
+                if aligned:
+                    os.pwrite(dst, view[:aligned], offset)
+                if aligned < length:
+                    write_unaligned(device_path, bytes(view[aligned:length]), offset + aligned)
+                offset += length
+                written += length
+
+            if expected and checksum.hexdigest() != expected:
+                logger.error("Blocks %s-%s of %s do not match the block map", first, last, image_path)
+                return 1
+            written_ranges.append((first, last, expected or checksum.hexdigest()))
+
+        os.fsync(dst)
+        elapsed = time.monotonic() - start_time
+        throughput = written / elapsed / (1024 * 1024) if elapsed else 0
+        logger.info("Wrote %s of %s bytes in %.1fs (%.1f MB/s)", written, image_size, elapsed, throughput)
+
+        if verify:
+            logger.info("Verify %s", device_path)
+            if not verify_target(device_path, written_ranges, block_size, image_size, view):
+                return 1
+            logger.info("Verified %d ranges", len(written_ranges))
+    finally:
+        view.release()
+        buf.close()
+        os.close(src)
+        os.close(dst)
+
+    return 0
+
+
+def write_unaligned(device_path, data, offset):
+    fd = os.open(device_path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, offset)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,128 @@
+"""
+Order the files in filesystem.squashfs by boot access.
+Files read during boot are placed at the beginning of the squashfs,
+so the boot reads are sequential instead of scattered across the image.
+
+load_boot_trace() - read a list of files accessed during boot
+create_sort_file() - create the -sort priority file for mksquashfs
+"""
+
+import os
+
+from utilities.logger import create_logger
+
+logger = create_logger(__name__)
+
+# shipped boot traces in utilities/boot-traces/<name>.list
+BOOT_TRACES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'boot-traces')
+SORT_FILE_NAME = "squashfs.sort"
+# mksquashfs priority range is -32768 to 32767. Files not listed get 0.
+MAX_PRIORITY = 32767
+MAX_SYMLINKS = 40
+
+
+def get_boot_trace_path(boot_trace):
+    """
+    Return path to the boot trace. boot_trace is either a path
+    or the name of a shipped trace such as 'casper'.
+    """
+    if os.path.isfile(boot_trace):
+        return boot_trace
+
+    shipped_trace = os.path.join(BOOT_TRACES_DIRECTORY, "%s.list" % boot_trace)
+    if os.path.isfile(shipped_trace):
+        return shipped_trace
+
+    return None
+
+
+def load_boot_trace(trace_path):
+    """
+    Return list of absolute paths in the order of first access.
+    Each line contains one path. The path is the last field of the line,
+    so the output of fatrace (process(pid): O /path) or a plain list is accepted.
+    Lines starting with # are comments.
+    """
+    logger.info("Load boot trace %s", trace_path)
+    paths = []
+    seen = set()
+    with open(trace_path, 'r', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            path = line.split()[-1]
+            if not path.startswith('/') or path in seen:
+                continue
+
+            seen.add(path)
+            paths.append(path)
+
+    logger.info("%s files in boot trace", len(paths))
+    return paths
+
+
+def resolve_in_root(custom_root_directory, path):
+    """
+    Resolve the symlinks of path inside custom_root_directory.
+    Return path relative to custom_root_directory or None if not exists.
+    """
+    parts = [part for part in path.split('/') if part]
+    resolved = []
+    hops = 0
+    while parts:
+        part = parts.pop(0)
+        if part == '.':
+            continue
+        if part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+
+        current = os.path.join(custom_root_directory, *resolved, part)
+        if os.path.islink(current):
+            hops += 1
+            if hops > MAX_SYMLINKS:
+                return None
+            target = os.readlink(current)
+            if target.startswith('/'):
+                resolved = []
+            parts = [p for p in target.split('/') if p] + parts
+            continue
+
+        if not os.path.lexists(current):
+            return None
+        resolved.append(part)
+
+    return '/'.join(resolved)
+
+
+def create_sort_file(custom_root_directory, trace_path, sort_file_path):
+    """
+    Create the mksquashfs sort file. The first accessed file gets the
+    highest priority. Return the number of files in the sort file.
+    """
+    logger.info("Create squashfs sort file %s", sort_file_path)
+    entries = []
+    seen = set()
+    for path in load_boot_trace(trace_path):
+        relative_path = resolve_in_root(custom_root_directory, path)
+        if not relative_path or relative_path in seen:
+            continue
+        # mksquashfs sort file does not support white space in file name
+        if any(c.isspace() for c in relative_path):
+            continue
+        if not os.path.isfile(os.path.join(custom_root_directory, relative_path)):
+            continue
+
+        seen.add(relative_path)
+        entries.append(relative_path)
+
+    with open(sort_file_path, 'w') as f:
+        for number, relative_path in enumerate(entries):
+            priority = max(MAX_PRIORITY - number, 1)
+            f.write("%s %s\n" % (relative_path, priority))
+
+    logger.info("%s files are placed first in the squashfs", len(entries))
+    return len(entries)
@@ -0,0 +1,425 @@
+"""
+Programmatic build API. The command line in build_image.py is a thin
+wrapper around it.
+
+    builder = Builder()
+    result = builder.build(BuildSpec('/tmp/ubuntu-image', 'config.json', variant='default'))
+    print(result.outputs)
+
+Errors are raised as BuildError instead of exiting. The loaded
+configurations are kept by the Builder and reused by the next builds.
+The pipeline uses process-wide state (backend, telemetry), so the builds
+of one process run one at a time.
+"""
+
+import os
+import threading
+import time
+
+from utilities.logger import create_logger
+from utilities.errors import BuildError, check_return_code
+from utilities.iso import mount, unmount
+from utilities.file_ops import make_directory, make_directories
+from utilities.extract import copy_original_iso_files, extract_squashfs
+from utilities.container import create_virtual_environment
+from utilities.create_scripts import add_sources_list, do_script
+from utilities.metadata import modify_release_description, create_filesystem_manifest
+from utilities.image_iso import do_iso_image
+from utilities.image_raw import do_raw_image
+from utilities.util import add_apt_proxy, remove_apt_proxy
+from utilities.backend import set_backend, BACKEND_HOST
+from utilities.telemetry import enable_telemetry, reset_telemetry, write_telemetry, trace_stage, get_spans
+from utilities.metrics import get_config_hash, collect_artifacts, record_build
+from utilities.planner import get_build_plan, check_disk_space
+from utilities.staging import prepare_staging, release_staging
+from utilities.apt import get_sources, prefetch_packages, remove_archives
+from utilities.mirror import set_mirror_sources, remove_mirror_sources, MIRROR_MOUNT_POINT
+from utilities.proxy import start_proxy, PROXY_ADDRESS
+from utilities.fastest_mirror import set_apt_mirrors, remove_apt_mirrors
+from utilities.initramfs import set_initramfs_compression, generate_initramfs
+from utilities.slim import set_dpkg_excludes, slim_rootfs
+from utilities.size_report import get_base_report, report_sizes
+from utilities.squashfs import snapshot_tree
+from utilities.reaper import reap_directory, move_to_trash, spawn_reaper, collect_trash
+from utilities.parser import load_config, get_apt_cache_proxy, get_base_image, get_base_image_path, \
+        get_boot_trace, get_cache_directory, get_defer_initramfs, get_image_headroom, get_image_types, \
+        get_initramfs_compression, get_kernel_overlays, get_kernel_version, get_local_mirror, \
+        get_memory_budget, get_mirrors, get_packages_list, get_prefetch_packages, get_purge_kernels, \
+        get_reuse_squashfs_blocks, \
+        get_size_report, get_slim_locales, get_slim_profiles, get_sources_list, get_squashfs_compression
+
+logger = create_logger(__name__)
+
+OUTPUT_EXTENSIONS = ('.iso', '.img', '.md5sums', '.bmap', '.json', '.html')
+
+
+class BuildSpec:
+    """
+    What to build. config is a path to config.json or the loaded configuration.
+    The build stops before its next stage when the cancel event is set.
+    """
+    def __init__(self, project_directory, config, variant='default', project_name='my_project',
+            output_file='', proxy=None, keep_project=False, backend=BACKEND_HOST, trace=False,
+            ignore_space=False, cancel=None):
+        self.project_directory = project_directory
+        self.config = config
+        self.variant = variant
+        self.project_name = project_name
+        self.output_file = output_file
+        self.proxy = proxy
+        self.keep_project = keep_project
+        self.backend = backend
+        self.trace = trace
+        self.ignore_space = ignore_space
+        self.cancel = cancel
+
+    def check_cancelled(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise BuildError("Build of %s is cancelled" % self.project_name)
+
+
+class BuildResult:
+    """
+    Outcome of a build: output paths, artifact sizes, timings and the plan
+    """
+    def __init__(self, spec, plan):
+        self.spec = spec
+        self.plan = plan
+        self.outputs = []
+        self.artifacts = {}
+        self.package_count = 0
+        self.duration = None
+        self.build_id = None
+        self.spans = []
+        self.report_paths = None
+
+
+class BuildContext:
+    """
+    Resolved paths of one build
+    """
+    def __init__(self, spec, config):
+        self.config = config
+        self.variant = spec.variant
+        self.project_directory = os.path.join(spec.project_directory, spec.project_name)
+
+        # path to ubuntu iso image, it is downloaded after the plan is checked
+        self.iso_file_path = get_base_image_path(config, spec.variant)
+        if spec.output_file:
+            if not '/' in spec.output_file:
+                self.output_iso_path = os.path.join(self.project_directory, spec.output_file)
+            else:
+                self.output_iso_path = spec.output_file
+        else:
+            input_iso_image = os.path.basename(self.iso_file_path)
+            output_iso_image = input_iso_image.replace('.iso', '-custom.iso')
+            self.output_iso_path = os.path.join(self.project_directory, output_iso_image)
+
+        # raw disk image is stored next to the iso image
+        self.output_img_path = os.path.splitext(self.output_iso_path)[0] + '.img'
+        self.memory_budget = get_memory_budget(config, spec.variant)
+
+
+@trace_stage
+def do_cleanup(project_directory, output_image):
+    """
+    Remove all of the project files after
+    creating the custom image.
+    """
+    if project_directory in output_image:
+        # the output images are moved back from the trash before it is deleted
+        temp_dir = move_to_trash(project_directory)
+        if not temp_dir:
+            logger.error("Cannot clean up %s", project_directory)
+            return
+        make_directory(project_directory)
+
+        output_path = os.path.dirname(output_image)
+        files = os.listdir(temp_dir)
+        for f in files:
+            if f.endswith(OUTPUT_EXTENSIONS):
+                src = os.path.join(temp_dir, f)
+                dst = os.path.join(output_path, f)
+                os.rename(src, dst)
+        spawn_reaper(temp_dir)
+
+    else:
+        reap_directory(project_directory)
+
+
+class Builder:
+    """
+    Run builds in this process
+    """
+    def __init__(self):
+        self.configs = {}
+        self.lock = threading.Lock()
+
+    def load_config(self, config):
+        """
+        Return the configuration. A config.json is loaded again only when it changed.
+        """
+        if isinstance(config, dict):
+            return config
+
+        if not os.path.exists(config):
+            raise BuildError("Configuration file is not found at %s" % config)
+
+        mtime = os.path.getmtime(config)
+        cached = self.configs.get(config)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        loaded = load_config(config)
+        if not loaded:
+            raise BuildError("Configuration file is not found at %s" % config)
+        self.configs[config] = (mtime, loaded)
+        return loaded
+
+    def resolve(self, spec):
+        config = self.load_config(spec.config)
+        if spec.variant not in config.get('variant', {}):
+            raise BuildError("Unknown variant %s" % spec.variant)
+        return BuildContext(spec, config)
+
+    def plan(self, spec):
+        """
+        Return the build plan of the spec. The directories without enough
+        free space are listed in plan['insufficient'].
+        """
+        context = self.resolve(spec)
+        return self.get_plan(context)
+
+    def get_plan(self, context):
+        plan = get_build_plan(context.config, context.variant, context.project_directory,
+                context.output_iso_path, context.memory_budget)
+        plan['insufficient'] = check_disk_space(plan)
+        return plan
+
+    def build(self, spec):
+        """
+        Build the images of the spec. Return BuildResult.
+        """
+        with self.lock:
+            return self.run_build(spec)
+
+    def run_build(self, spec):
+        started = time.time()
+        context = self.resolve(spec)
+        config = context.config
+        variant = context.variant
+        project_directory = context.project_directory
+
+        # the stage timings are always recorded to the build metrics
+        reset_telemetry()
+        enable_telemetry()
+        set_backend(spec.backend)
+
+        logger.info("project directory is %s", project_directory)
+        logger.info("variant is %s", variant)
+        logger.info("Output image is %s", context.output_iso_path)
+
+        plan = self.get_plan(context)
+        for directory, needed, free in plan['insufficient']:
+            logger.error("Not enough free space in %s: need %.1fMB, free %.1fMB",
+                    directory, needed / 1024 / 1024, free / 1024 / 1024)
+        if plan['insufficient'] and not spec.ignore_space:
+            raise BuildError("Not enough free space. Use --ignore-space to build anyway")
+
+        result = BuildResult(spec, plan)
+        iso_file_path = get_base_image(config, variant)
+        kernel_version = get_kernel_version(config, variant)
+
+        # create project path
+        make_directories(project_directory)
+
+        # delete the trash left by interrupted builds in background
+        collect_trash(spec.project_directory)
+        collect_trash(project_directory)
+
+        # custom-root, custom-disk and the partition images are staged on tmpfs if they fit
+        staging_directory = prepare_staging(project_directory, plan['staging_footprint'],
+                context.memory_budget if plan['tmpfs'] else 0)
+
+        iso_mount_point = os.path.join(project_directory, "source-disk")
+        custom_disk_directory = os.path.join(staging_directory, "custom-disk")
+        custom_root_directory = os.path.join(staging_directory, "custom-root")
+
+        logger.info("iso mount point: %s", iso_mount_point)
+        logger.info("custom disk directory: %s", custom_disk_directory)
+        logger.info("custom root directory: %s", custom_root_directory)
+
+        try:
+            package_index = self.run_stages(context, spec, iso_file_path, iso_mount_point,
+                    staging_directory, custom_disk_directory, custom_root_directory, kernel_version)
+
+            # sizes are collected before the staging and the project directory are removed
+            result.artifacts = collect_artifacts(custom_disk_directory,
+                    [context.output_iso_path, context.output_img_path])
+            result.package_count = len(package_index)
+        finally:
+            unmount(iso_mount_point)
+            # the tmpfs is freed when the build fails too, the daemon runs many builds
+            if not spec.keep_project:
+                release_staging(project_directory, staging_directory)
+
+        # clean up the project directory
+        if not spec.keep_project:
+            do_cleanup(project_directory, context.output_iso_path)
+        elif staging_directory != project_directory:
+            logger.info("The staged files are kept in %s until it is unmounted", staging_directory)
+
+        result.spans = get_spans()
+        result.build_id = record_build(get_cache_directory(config, variant), variant,
+                get_config_hash(config, variant), started, result.spans, result.artifacts,
+                {'packages': result.package_count})
+
+        if spec.trace:
+            make_directories(project_directory)
+            result.report_paths = write_telemetry(project_directory)
+
+        output_directory = os.path.dirname(context.output_iso_path)
+        base_name = os.path.splitext(os.path.basename(context.output_iso_path))[0]
+        if os.path.isdir(output_directory):
+            result.outputs = sorted(os.path.join(output_directory, name)
+                    for name in os.listdir(output_directory)
+                    if name.startswith(base_name) and name.endswith(OUTPUT_EXTENSIONS))
+        result.duration = time.time() - started
+        return result
+
+    def run_stages(self, context, spec, iso_file_path, iso_mount_point, staging_directory,
+            custom_disk_directory, custom_root_directory, kernel_version):
+        """
+        Extract, customize and pack the image. Return the package index.
+        """
+        config = context.config
+        variant = context.variant
+
+        # mount iso image, extract rootfs
+        ret = mount(iso_file_path, iso_mount_point)
+        if ret > 0:
+            raise BuildError("mount failed, ret: %s" % ret, 2)
+
+        check_return_code(copy_original_iso_files(iso_mount_point, custom_disk_directory),
+                "copy_original_iso_files")
+        check_return_code(extract_squashfs(iso_mount_point, custom_root_directory),
+                "extract_squashfs")
+        # the files which are not modified after this keep the blocks of the base squashfs
+        snapshot = None
+        if get_reuse_squashfs_blocks(config, variant):
+            snapshot = snapshot_tree(custom_root_directory)
+
+        # unmount source-disk
+        unmount(iso_mount_point)
+        spec.check_cancelled()
+
+        # the sizes of the base image, to find what the customization added
+        size_report = get_size_report(config, variant)
+        compression = get_squashfs_compression(config, variant)
+        cache_directory = get_cache_directory(config, variant)
+        base_report = None
+        if size_report:
+            base_report = get_base_report(custom_root_directory, iso_file_path, compression,
+                    cache_directory)
+
+        # the scripts are next to custom-root, where the container looks for them
+        target_directory = staging_directory
+
+        sources_list = get_sources_list(config, variant)
+        if sources_list:
+            add_sources_list(target_directory, sources_list)
+
+        # prepare script for installing kernel and userspace packages in chroot/container
+        packages_list = get_packages_list(config, variant)
+        urls = get_kernel_overlays(config, variant)
+
+        # update-initramfs runs once, for the selected kernel, after the packages are installed
+        defer_initramfs = bool(kernel_version) and get_defer_initramfs(config, variant)
+        initramfs_compression = get_initramfs_compression(config, variant)
+        set_initramfs_compression(custom_root_directory, initramfs_compression)
+
+        # the excluded files of the installed packages are never unpacked
+        slim_profiles = get_slim_profiles(config, variant)
+        slim_locales = get_slim_locales(config, variant)
+        set_dpkg_excludes(custom_root_directory, slim_profiles, slim_locales)
+
+        # generate installing packages, kernel scripts
+        do_script(target_directory, packages_list, urls, kernel_version, spec.proxy,
+                defer_initramfs, get_purge_kernels(config, variant))
+
+        # apt in the container reads only the local repository if there is one,
+        # else the packages are downloaded on the host and found in its cache
+        prefetched = []
+        ro_binds = []
+        mirror_directory = get_local_mirror(config, variant)
+        mirrors = get_mirrors(config)
+        if mirror_directory:
+            set_mirror_sources(custom_root_directory, mirror_directory, variant)
+            ro_binds.append((mirror_directory, MIRROR_MOUNT_POINT))
+        else:
+            if get_prefetch_packages(config, variant):
+                prefetched = prefetch_packages(custom_root_directory, packages_list, sources_list,
+                        cache_directory, mirrors=mirrors)
+            # apt in the container fails over between the ranked mirrors of a source
+            if mirrors:
+                set_apt_mirrors(mirrors, get_sources(custom_root_directory, sources_list),
+                        custom_root_directory, cache_directory)
+
+        # what apt downloads in the container is cached for the other builds
+        proxy_address = get_apt_cache_proxy(config, variant, PROXY_ADDRESS)
+        if proxy_address and not mirror_directory:
+            add_apt_proxy(start_proxy(cache_directory, proxy_address), custom_root_directory)
+
+        # spawn the chroot
+        spec.check_cancelled()
+        try:
+            ret = create_virtual_environment(custom_root_directory, ro_binds)
+        finally:
+            remove_archives(prefetched)
+            if mirror_directory:
+                remove_mirror_sources(custom_root_directory)
+            elif mirrors:
+                remove_apt_mirrors(custom_root_directory)
+
+        # exit from chroot
+        remove_apt_proxy(custom_root_directory)
+        check_return_code(ret, "create_virtual_environment")
+        spec.check_cancelled()
+
+        if defer_initramfs:
+            generate_initramfs(custom_root_directory, kernel_version, initramfs_compression,
+                    cache_directory)
+
+        if slim_profiles:
+            slim_rootfs(custom_root_directory, slim_profiles, slim_locales, compression,
+                    os.path.splitext(context.output_iso_path)[0] + '.slim.json')
+
+        if size_report:
+            report_sizes(custom_root_directory, compression, base_report, cache_directory, variant,
+                    context.output_iso_path)
+
+        # modify metadata such as release description, manifest outside of chroot
+        modify_release_description(custom_root_directory)
+        package_index = create_filesystem_manifest(custom_root_directory, custom_disk_directory)
+
+        # create image
+        images_types = get_image_types(config, variant)
+        for image_type in images_types.split(' '):
+            spec.check_cancelled()
+            if 'iso' in image_type:
+                # create image with iso format
+                boot_trace = get_boot_trace(config, variant)
+                do_iso_image(staging_directory, iso_file_path, context.output_iso_path,
+                    custom_root_directory, custom_disk_directory, kernel_version, boot_trace,
+                    compression, snapshot)
+
+            elif 'img' in image_type:
+                # create raw disk image without loop device
+                image_headroom = get_image_headroom(config, variant)
+                do_raw_image(staging_directory, context.output_img_path, custom_root_directory,
+                    custom_disk_directory, kernel_version, image_headroom)
+
+            else:
+                logger.error("Unknown image type %s", image_type)
+
+        return package_index
@@ -0,0 +1,284 @@
+"""
+Content-addressed artifact cache shared by the build nodes.
+Blobs are stored by sha256 and names such as the URL of a base image
+are mapped to a digest with refs. Start the server with run_cache_server().
+
+API:
+  HEAD /cas/<sha256>     check a blob
+  GET  /cas/<sha256>     download a blob
+  PUT  /cas/<sha256>     upload a blob, rejected if the content does not match the digest
+  GET  /refs/<name>      digest of the name
+  PUT  /refs/<name>      set the digest of the name, the body is the digest
+"""
+
+import hashlib
+import http.server
+import os
+import re
+import shutil
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from utilities.logger import create_logger
+from utilities.file_ops import make_directories
+from utilities.daemon import create_server
+
+logger = create_logger(__name__)
+
+CACHE_SERVER_ADDRESS = "127.0.0.1:8471"
+BLOBS_DIRECTORY = "cas"
+REFS_DIRECTORY = "refs"
+CHUNK_SIZE = 1024 * 1024
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def get_file_digest(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class CacheStore:
+    """
+    Blobs in <directory>/cas/<2 chars>/<digest>, refs in <directory>/refs/<sha256 of the name>
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.blobs_directory = os.path.join(self.directory, BLOBS_DIRECTORY)
+        self.refs_directory = os.path.join(self.directory, REFS_DIRECTORY)
+        make_directories(self.blobs_directory)
+        make_directories(self.refs_directory)
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.blobs_directory, digest[:2], digest)
+
+    def get_ref_path(self, name):
+        # names such as URLs can be longer than a file name
+        digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.refs_directory, digest)
+
+    def write_blob(self, digest, stream, length):
+        """
+        Store length bytes of stream as digest. Return False if the content does not match.
+        """
+        blob_path = self.get_blob_path(digest)
+        make_directories(os.path.dirname(blob_path))
+        sha256 = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = stream.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining or sha256.hexdigest() != digest:
+                return False
+            os.replace(temp_path, blob_path)
+            return True
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def read_ref(self, name):
+        ref_path = self.get_ref_path(name)
+        if not os.path.isfile(ref_path):
+            return None
+        with open(ref_path, 'r') as f:
+            return f.read().strip()
+
+    def write_ref(self, name, digest):
+        ref_path = self.get_ref_path(name)
+        with open(ref_path + '.tmp', 'w') as f:
+            f.write(digest)
+        os.replace(ref_path + '.tmp', ref_path)
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    store = None
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def send_text(self, text, status=200):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def get_route(self):
+        path = urllib.parse.urlsplit(self.path).path
+        parts = path.strip('/').split('/', 1)
+        if len(parts) != 2:
+            return None, None
+        kind, key = parts[0], urllib.parse.unquote(parts[1])
+        if kind == BLOBS_DIRECTORY and not DIGEST_PATTERN.match(key):
+            return None, None
+        return kind, key
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        kind, key = self.get_route()
+        if kind == BLOBS_DIRECTORY:
+            blob_path = self.store.get_blob_path(key)
+            if not os.path.isfile(blob_path):
+                return self.send_text("Not found\n", 404)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(blob_path)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                with open(blob_path, 'rb') as f:
+                    shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+        elif kind == REFS_DIRECTORY:
+            digest = self.store.read_ref(key)
+            if not digest:
+                return self.send_text("Not found\n", 404)
+            self.send_text(digest)
+        else:
+            self.send_text("Not found\n", 404)
+
+    def do_PUT(self):
+        kind, key = self.get_route()
+        length = int(self.headers.get('Content-Length', 0))
+        if kind == BLOBS_DIRECTORY:
+            if os.path.isfile(self.store.get_blob_path(key)):
+                # content addressed, an existing blob is the same
+                self.rfile.read(length)
+                return self.send_text("Exists\n", 200)
+            if not self.store.write_blob(key, self.rfile, length):
+                return self.send_text("Digest mismatch\n", 400)
+            self.send_text("Created\n", 201)
+        elif kind == REFS_DIRECTORY:
+            digest = self.rfile.read(length).decode('utf-8').strip()
+            if not DIGEST_PATTERN.match(digest):
+                return self.send_text("Invalid digest\n", 400)
+            self.store.write_ref(key, digest)
+            self.send_text("Created\n", 201)
+        else:
+            self.send_text("Not found\n", 404)
+
+
+class CacheClient:
+    """
+    Client of the cache server
+    """
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, data=None, headers=None):
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers=headers or {})
+        return urllib.request.urlopen(request)
+
+    def has(self, digest):
+        try:
+            with self.request('HEAD', '/cas/%s' % digest):
+                return True
+        except urllib.error.HTTPError as exception:
+            if exception.code == 404:
+                return False
+            raise
+
+    def get_blob_url(self, digest):
+        return "%s/cas/%s" % (self.url, digest)
+
+    def download(self, digest, file_path):
+        """
+        Download the blob to file_path. The content is verified before it is renamed in place.
+        Return False if the blob is not in the cache.
+        """
+        make_directories(os.path.dirname(os.path.abspath(file_path)))
+        try:
+            response = self.request('GET', '/cas/%s' % digest)
+        except urllib.error.HTTPError as exception:
+            if exception.code == 404:
+                return False
+            raise
+
+        sha256 = hashlib.sha256()
+        temp_path = file_path + '.part'
+        with response, open(temp_path, 'wb') as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                f.write(chunk)
+
+        if sha256.hexdigest() != digest:
+            os.remove(temp_path)
+            raise ValueError("Digest mismatch of %s" % digest)
+        os.replace(temp_path, file_path)
+        return True
+
+    def upload(self, file_path):
+        """
+        Upload the file. Return its digest.
+        """
+        digest = get_file_digest(file_path)
+        if self.has(digest):
+            return digest
+
+        with open(file_path, 'rb') as f:
+            self.request('PUT', '/cas/%s' % digest, data=f,
+                    headers={'Content-Length': str(os.path.getsize(file_path))}).close()
+        logger.info("Uploaded %s as %s", file_path, digest)
+        return digest
+
+    def get_ref(self, name):
+        try:
+            with self.request('GET', '/refs/%s' % urllib.parse.quote(name, safe='')) as response:
+                return response.read().decode('utf-8').strip()
+        except urllib.error.HTTPError as exception:
+            if exception.code == 404:
+                return None
+            raise
+
+    def set_ref(self, name, digest):
+        self.request('PUT', '/refs/%s' % urllib.parse.quote(name, safe=''),
+                data=digest.encode('utf-8')).close()
+
+    def fetch(self, name, file_path):
+        """
+        Download the blob named name to file_path.
+        Return False if the name is not in the cache.
+        """
+        digest = self.get_ref(name)
+        if not digest:
+            return False
+        return self.download(digest, file_path)
+
+    def publish(self, name, file_path):
+        """
+        Upload the file and name it. Return the digest.
+        """
+        digest = self.upload(file_path)
+        self.set_ref(name, digest)
+        return digest
+
+
+def run_cache_server(directory, address=CACHE_SERVER_ADDRESS):
+    store = CacheStore(directory)
+    handler = type('Handler', (CacheRequestHandler,), {'store': store})
+    server = create_server(address, handler)
+    logger.info("Cache server listening on %s, storing in %s", address, store.directory)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
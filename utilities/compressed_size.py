@@ -0,0 +1,62 @@
+"""
+Estimate what files add to filesystem.squashfs. mksquashfs compresses each
+file in blocks of SQUASHFS_BLOCK_SIZE and stores a block uncompressed if it
+does not shrink, the estimate compresses the blocks the same way in process.
+
+get_block_compressor() - function returning the compressed size of a block
+estimate_compressed_size() - estimated size of a file in the squashfs
+"""
+
+import lzma
+import os
+import zlib
+
+from utilities.logger import create_logger
+
+logger = create_logger(__name__)
+
+try:
+    # Python 3.14
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+SQUASHFS_BLOCK_SIZE = 128 * 1024
+# compression levels of mksquashfs
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 15
+
+
+def get_block_compressor(compression):
+    """
+    Return function of a block to its compressed size for the squashfs
+    compressor. lz4, lzo and zstd without Python support are estimated with gzip.
+    """
+    if compression in ('xz', 'lzma'):
+        return lambda block: len(lzma.compress(block, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE))
+    if compression == 'zstd' and zstd:
+        return lambda block: len(zstd.compress(block, level=ZSTD_LEVEL))
+    if compression != 'gzip':
+        logger.debug("No %s compressor in Python, the sizes are estimated with gzip", compression)
+    return lambda block: len(zlib.compress(block, GZIP_LEVEL))
+
+
+def estimate_compressed_size(file_path, compressor, limit=None, block_size=SQUASHFS_BLOCK_SIZE):
+    """
+    Return the estimated compressed size of the file. Only the first limit
+    bytes are compressed if limit is set and the ratio is applied to the rest.
+    """
+    size = os.path.getsize(file_path)
+    read_size = 0
+    compressed_size = 0
+    with open(file_path, 'rb') as f:
+        while limit is None or read_size < limit:
+            block = f.read(block_size)
+            if not block:
+                break
+            read_size += len(block)
+            compressed_size += min(compressor(block), len(block))
+
+    if read_size and read_size < size:
+        return compressed_size * size // read_size
+    return compressed_size
@@ -5,6 +5,9 @@ SCRIPT_PACKAGES = "install_packages.sh"
 SCRIPT_KERNEL = "install_kernel.sh"
 SCRIPT_ENTRYPOINT = "entrypoint.sh"
 SCRIPT_SOURCESLIST = "updatesrcslist.sh"
+SCRIPT_DEFER_INITRAMFS = "defer_initramfs.sh"
+SCRIPT_RESTORE_INITRAMFS = "restore_initramfs.sh"
+SCRIPT_INITRAMFS = "initramfs.sh"
 
 # Directory
 ENTRYPOINT_DIRECTORY = "entrypoint.d"
@@ -22,3 +25,43 @@ SYMLINK_VMLINUZ = "vmlinuz"
 # initrd
 INITRD = "initrd"
 SYMLINK_INITRD = "initrd.img"
+UPDATE_INITRAMFS = "/usr/sbin/update-initramfs"
+# packages of the kernels, purged except kernel.version with purge_kernels
+KERNEL_PACKAGE_PATTERNS = ["linux-image-[0-9]*", "linux-image-unsigned-[0-9]*",
+        "linux-modules-[0-9]*", "linux-modules-extra-[0-9]*"]
+
+# raw disk image, sizes in MB
+EFI_PARTITION_SIZE = 500
+SWAP_PARTITION_SIZE = 1024
+IMAGE_HEADROOM = 1024
+EXT4_OVERHEAD_PERCENT = 10
+
+# squashfs
+SQUASHFS_COMPRESSION = "gzip"
+
+# tmpfs staging, memory budget in MB. 0 disables the staging
+MEMORY_BUDGET = 0
+
+# resolve and download the packages on the host before the container starts
+PREFETCH_PACKAGES = True
+
+# caching apt proxy shared by the builds, True or host:port. False disables it
+APT_CACHE_PROXY = False
+
+# update-initramfs runs once at the end of the build, for kernel.version only
+DEFER_INITRAMFS = True
+# compressor of the initramfs such as zstd or lz4. None keeps the one of initramfs.conf
+INITRAMFS_COMPRESSION = None
+# purge the kernels other than kernel.version
+PURGE_KERNELS = False
+
+# slimming profiles of the rootfs such as docs, man, locales, apt, caches. Empty disables it
+SLIM_PROFILES = []
+# languages kept by the locales profile
+SLIM_LOCALES = ["en"]
+
+# per-package and per-directory size report of the rootfs, next to the output image
+SIZE_REPORT = False
+
+# filesystem.squashfs is written in process, copying the blocks of the unchanged files of the base image
+REUSE_SQUASHFS_BLOCKS = False
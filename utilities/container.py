@@ -1,14 +1,30 @@
+import hashlib
 import os
-import subprocess
 
 from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
 from utilities.file_ops import copy_to
 from utilities.iso import unmount 
 from utilities.constant import *
-from utilities.util import run_cmd
+from utilities.util import run_cmd, call_cmd
+from utilities.backend import get_operation
 
 logger = create_logger(__name__)
 
+MACHINE_NAME = "custom-ubuntu"
+
+
+def get_machine_name(custom_root_directory):
+    """
+    Return the container name of a build. nspawn registers the machines by
+    name, the concurrent builds of the daemon and the farm workers must not
+    share one.
+    """
+    project_directory = os.path.dirname(os.path.abspath(custom_root_directory))
+    digest = hashlib.sha256(project_directory.encode('utf-8')).hexdigest()[:12]
+    return "%s-%s" % (MACHINE_NAME, digest)
+
+
 def prepare_customize_script(custom_root_directory):
     """
     Copy script to custom_root_directory to be invoked
@@ -23,44 +39,24 @@ def prepare_customize_script(custom_root_directory):
     copy_to(source_path, dest_path)
 
 
-def create_virtual_environment(custom_root_directory):
+@trace_stage
+def create_virtual_environment(custom_root_directory, ro_binds=(), script_name=SCRIPT_ENTRYPOINT):
     """
-    Spawn a container to host rootfs. This operation require
-    superuser privilege.
+    Spawn a container to host rootfs and run script_name of entrypoint.d.
+    With the host backend this operation require superuser privilege.
     Bind the host's resolv.conf file to the container's resolv.conf as 
-    read only.
+    read only, and the (host path, container path) of ro_binds.
     """
     #prepare_customize_script(custom_root_directory)
     logger.info("Create virtual environment")
-    machine_name = "custom-ubuntu"
+    machine_name = get_machine_name(custom_root_directory)
     bind_path = RESOLV_FILE
     script_directory = os.path.join(os.path.dirname(custom_root_directory), ENTRYPOINT_DIRECTORY)
     root_path = os.path.join(ROOT_USER_DIRECTORY, ENTRYPOINT_DIRECTORY)
-    script_file = os.path.join(root_path, SCRIPT_ENTRYPOINT)
-
-    cmd = (
-        'sudo systemd-nspawn'
-        ' --quiet'
-        ' --notify-ready=yes'
-        ' --register=yes'
-        ' --bind-ro="{bind_path}"'
-        ' --bind={script_directory}:{root_path}'
-        ' --machine="{machine_name}"'
-        ' --directory="{directory_path}"'
-        ' /bin/bash "{script_file}"'
-        ).format(
-            bind_path=bind_path,
-            script_directory=script_directory,
-            root_path=root_path,
-            machine_name=machine_name,
-            directory_path=custom_root_directory,
-            script_file=script_file,
-        )
-
-    logger.debug("cmd: %s", cmd)
-
-    ret = subprocess.run(cmd, shell=True)
-    ret = ret.returncode
+    script_file = os.path.join(root_path, script_name)
+
+    ret = get_operation("run_container")(custom_root_directory, script_directory, root_path,
+            script_file, bind_path, machine_name, ro_binds)
     return ret
 
 
@@ -72,11 +68,11 @@ def prepare_chroot(custom_root_directory):
     
     # mount /proc /dev /sys
     cmd = "mount -o bind /proc %s/proc" % custom_root_directory
-    subprocess.run(cmd, shell=True)
+    call_cmd(cmd)
     cmd = "mount -o bind /sys %s/sys" % custom_root_directory
-    subprocess.run(cmd, shell=True)
+    call_cmd(cmd)
     cmd = "mount -o bind /dev %s/dev" % custom_root_directory
-    subprocess.run(cmd, shell=True)
+    call_cmd(cmd)
 
     # chroot in
     #TODO: find a way to supply command to chroot
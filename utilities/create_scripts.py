@@ -5,24 +5,30 @@ userspace packages as follows
 1. Download and install kernel overlay
 2. Add PPA to /etc/apt/sources.list
 3. Install userspace packages using apt
+update-initramfs is deferred while the kernel and the packages are installed
+and runs once for the selected kernel afterwards, see utilities/initramfs.py
 """
 
 import os
 import subprocess
 
 from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
 from utilities.file_ops import make_directory, copy_to
 from utilities.constant import *
 from utilities.util import get_proxy, set_apt_proxy
 
 logger = create_logger(__name__)
 
-def do_script(target_directory, packages_list, kernel_urls, kernel_version, proxy_path=None):
+@trace_stage
+def do_script(target_directory, packages_list, kernel_urls, kernel_version, proxy_path=None,
+        defer_initramfs=False, purge_kernels=False):
     """
     Wrapper function for generate install packages, kernel scripts
     """
     create_install_packages_script(packages_list, target_directory, proxy_path)
     create_install_kernel_script(kernel_urls, target_directory, kernel_version, proxy_path)
+    create_defer_initramfs_scripts(target_directory, kernel_version, defer_initramfs, purge_kernels)
     create_entrypoint_script(target_directory)
 
 
@@ -130,6 +136,79 @@ def create_install_kernel_script(urls, target_directory, kernel_version, proxy_p
     os.chmod(kernel_script, 0o755)
 
 
+def create_defer_initramfs_scripts(target_directory, kernel_version, defer_initramfs,
+        purge_kernels=False):
+    """
+    Generate the scripts which replace update-initramfs with a no-op while
+    the packages are installed and restore it, purging the kernels other than
+    kernel_version if purge_kernels, in
+    <target_directory>/entrypoint.d/defer_initramfs.sh and restore_initramfs.sh
+    """
+    target_directory = os.path.join(target_directory, ENTRYPOINT_DIRECTORY)
+    make_directory(target_directory)
+    defer_script = os.path.join(target_directory, SCRIPT_DEFER_INITRAMFS)
+    restore_script = os.path.join(target_directory, SCRIPT_RESTORE_INITRAMFS)
+
+    if not defer_initramfs:
+        # the scripts of a previous build in the kept project directory
+        for script in [defer_script, restore_script]:
+            if os.path.exists(script):
+                os.remove(script)
+        return None
+
+    logger.info("Create scripts deferring update-initramfs")
+    with open(defer_script, "w") as d:
+        d.write("#!/bin/bash\n")
+        d.write("\ndpkg-divert --local --rename --add %s\n" % UPDATE_INITRAMFS)
+        d.write("cat << 'EOF' > %s\n" % UPDATE_INITRAMFS)
+        d.write("#!/bin/sh\n")
+        d.write("echo \"update-initramfs is deferred to the end of the build\"\n")
+        d.write("EOF\n")
+        d.write("chmod 755 %s\n" % UPDATE_INITRAMFS)
+
+    with open(restore_script, "w") as r:
+        r.write("#!/bin/bash\n")
+        if purge_kernels and kernel_version:
+            logger.info("Kernels other than %s are purged", kernel_version)
+            r.write("\nfor package in $(dpkg-query -W -f='${Package}\\n' %s 2>/dev/null); do\n"
+                    % ' '.join("'%s'" % pattern for pattern in KERNEL_PACKAGE_PATTERNS))
+            r.write("    case \"$package\" in\n")
+            r.write("        *%s*) ;;\n" % kernel_version)
+            r.write("        *) apt-get purge -y \"$package\" ;;\n")
+            r.write("    esac\n")
+            r.write("done\n")
+        r.write("\nrm -f %s\n" % UPDATE_INITRAMFS)
+        r.write("dpkg-divert --local --rename --remove %s\n" % UPDATE_INITRAMFS)
+
+    os.chmod(defer_script, 0o755)
+    os.chmod(restore_script, 0o755)
+
+
+def create_initramfs_script(target_directory, kernel_version):
+    """
+    Generate a script running update-initramfs for the kernel release
+    kernel_version, or for all the kernels if it is None, in
+    <target_directory>/entrypoint.d/initramfs.sh
+    """
+    target_directory = os.path.join(target_directory, ENTRYPOINT_DIRECTORY)
+    make_directory(target_directory)
+    initramfs_script = os.path.join(target_directory, SCRIPT_INITRAMFS)
+    logger.info("initramfs script in %s", initramfs_script)
+
+    with open(initramfs_script, "w") as i:
+        i.write("#!/bin/bash\n")
+        if kernel_version:
+            i.write("\nif [ -e /boot/%s.img-%s ]; then\n" % (INITRD, kernel_version))
+            i.write("    update-initramfs -u -k %s\n" % kernel_version)
+            i.write("else\n")
+            i.write("    update-initramfs -c -k %s\n" % kernel_version)
+            i.write("fi\n")
+        else:
+            i.write("\nupdate-initramfs -u -k all\n")
+
+    os.chmod(initramfs_script, 0o755)
+
+
 def create_entrypoint_script(target_directory):
     """
     Create a wrapper script for installing kernel overlay,
@@ -144,15 +223,31 @@ def create_entrypoint_script(target_directory):
     srcslist_script = os.path.join(target_directory, SCRIPT_SOURCESLIST)
     kernel_script = os.path.join(target_directory, SCRIPT_KERNEL)
     packages_script = os.path.join(target_directory, SCRIPT_PACKAGES)
+    defer_script = os.path.join(target_directory, SCRIPT_DEFER_INITRAMFS)
+    restore_script = os.path.join(target_directory, SCRIPT_RESTORE_INITRAMFS)
 
     # Relative directory in container or chroot
     rel_entry_path = os.path.join(ROOT_USER_DIRECTORY, ENTRYPOINT_DIRECTORY)
     rel_srcslist_script = os.path.join(rel_entry_path, SCRIPT_SOURCESLIST)
     rel_kernel_script = os.path.join(rel_entry_path, SCRIPT_KERNEL)
     rel_packages_script = os.path.join(rel_entry_path, SCRIPT_PACKAGES)
+    rel_defer_script = os.path.join(rel_entry_path, SCRIPT_DEFER_INITRAMFS)
+    rel_restore_script = os.path.join(rel_entry_path, SCRIPT_RESTORE_INITRAMFS)
 
     with open(entrypoint_script, "w") as e:
         e.write("#!/bin/bash\n")
+        # a failed step fails the container
+        e.write("set -e\n")
+
+        # update-initramfs is a no-op until the packages are installed
+        if os.path.exists(defer_script):
+            e.write("\nbash %s" % rel_defer_script)
+            logger.debug("Add defer_initramfs.sh script")
+        # the initramfs is generated after the container exits. The diversion
+        # is removed on exit, also after a failed step, keeping its status
+        if os.path.exists(restore_script):
+            e.write("\ntrap 'bash %s' EXIT" % rel_restore_script)
+            logger.debug("Add restore_initramfs.sh script")
 
         # Add sourceslist script
         if os.path.exists(srcslist_script):
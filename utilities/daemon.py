@@ -0,0 +1,481 @@
+"""
+Build daemon. Accept build requests over a local HTTP API on a TCP port
+or a Unix socket, queue them by priority and run a limited number of
+builds at once. Start with run_daemon() as entry point.
+
+The daemon keeps the loaded configurations and resolves the base images
+once for all of the jobs, so concurrent builds of the same base image do
+not download it twice. Each job runs build_image.py in its own process,
+as the build pipeline keeps process-wide state.
+
+API, all responses are JSON except the log and the artifacts:
+  GET    /health                           daemon status
+  POST   /jobs                             {"config": path or object, "variant", "priority", "backend"}
+  GET    /jobs                             list of jobs
+  GET    /jobs/<id>                        job status and progress
+  GET    /jobs/<id>/log?offset=N&follow=1  build log, follow streams until the job ends
+  GET    /jobs/<id>/artifacts/<name>       output image, checksums or block map
+  DELETE /jobs/<id>                        cancel a queued or running job
+"""
+
+import heapq
+import http.server
+import itertools
+import json
+import os
+import shutil
+import signal
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+from utilities.logger import create_logger
+from utilities.file_ops import make_directories
+from utilities.errors import BuildError
+from utilities.builder import Builder, BuildSpec
+from utilities.proxy import start_proxy
+from utilities.parser import get_base_image, get_base_image_path
+from utilities.reaper import collect_trash
+
+logger = create_logger(__name__)
+
+DAEMON_ADDRESS = "127.0.0.1:8470"
+JOBS_DIRECTORY = "jobs"
+PROJECTS_DIRECTORY = "projects"
+JOB_FILE_NAME = "job.json"
+LOG_FILE_NAME = "build.log"
+CONFIG_FILE_NAME = "config.json"
+ARTIFACT_EXTENSIONS = ('.iso', '.img', '.md5sums', '.bmap')
+LOG_CHUNK_SIZE = 64 * 1024
+BUILD_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'build_image.py')
+FOLLOW_INTERVAL = 0.5
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobError(Exception):
+    """
+    Invalid build request or unknown job
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class BuildDaemon:
+    """
+    Job queue with a fixed number of worker threads
+    """
+    def __init__(self, state_directory, max_jobs=1, backend=None):
+        self.state_directory = os.path.abspath(state_directory)
+        self.jobs_directory = os.path.join(self.state_directory, JOBS_DIRECTORY)
+        self.projects_directory = os.path.join(self.state_directory, PROJECTS_DIRECTORY)
+        self.max_jobs = max_jobs
+        self.backend = backend
+        self.started = time.time()
+        self.jobs = {}
+        self.queue = []
+        self.sequence = itertools.count()
+        self.processes = {}
+        self.builder = Builder()
+        self.base_image_locks = {}
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.workers = []
+
+        make_directories(self.jobs_directory)
+        make_directories(self.projects_directory)
+        collect_trash(self.projects_directory)
+        self.load_jobs()
+
+    def load_jobs(self):
+        """
+        Load the jobs of the previous daemon. Queued jobs are queued again,
+        running jobs were interrupted.
+        """
+        for job_id in os.listdir(self.jobs_directory):
+            job_file = os.path.join(self.jobs_directory, job_id, JOB_FILE_NAME)
+            if not os.path.isfile(job_file):
+                continue
+            with open(job_file, 'r') as f:
+                job = json.load(f)
+            if job['state'] == RUNNING:
+                job['state'] = FAILED
+                job['error'] = "interrupted by daemon restart"
+                self.save_job(job)
+            self.jobs[job_id] = job
+            if job['state'] == QUEUED:
+                heapq.heappush(self.queue, (-job['priority'], next(self.sequence), job_id))
+
+    def get_job_directory(self, job_id):
+        return os.path.join(self.jobs_directory, job_id)
+
+    def save_job(self, job):
+        job_file = os.path.join(self.get_job_directory(job['id']), JOB_FILE_NAME)
+        with open(job_file + '.tmp', 'w') as f:
+            json.dump(job, f, indent=4)
+        os.replace(job_file + '.tmp', job_file)
+
+    def submit(self, request):
+        """
+        Queue a build request. Return the job.
+        """
+        variant = request.get('variant', 'default')
+        job_id = uuid.uuid4().hex[:12]
+        job_directory = self.get_job_directory(job_id)
+
+        config = request.get('config')
+        if isinstance(config, dict):
+            make_directories(job_directory)
+            config_path = os.path.join(job_directory, CONFIG_FILE_NAME)
+            with open(config_path, 'w') as f:
+                json.dump(config, f, indent=4)
+        elif isinstance(config, str) and os.path.isfile(config):
+            config_path = os.path.abspath(config)
+        else:
+            raise JobError("config must be a path to config.json or a configuration object")
+
+        try:
+            self.builder.resolve(BuildSpec(self.projects_directory, config_path, variant))
+        except BuildError as exception:
+            raise JobError(str(exception))
+
+        make_directories(job_directory)
+        job = {
+            "id": job_id,
+            "variant": variant,
+            "config": config_path,
+            "priority": int(request.get('priority', 0)),
+            "backend": request.get('backend', self.backend),
+            "trace": bool(request.get('trace', False)),
+            "state": QUEUED,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "returncode": None,
+            "error": None,
+            "estimate": None,
+            "project_directory": os.path.join(self.projects_directory, job_id),
+        }
+        with self.condition:
+            self.jobs[job_id] = job
+            self.save_job(job)
+            heapq.heappush(self.queue, (-job['priority'], next(self.sequence), job_id))
+            self.condition.notify()
+
+        logger.info("Queued job %s for variant %s", job_id, variant)
+        return job
+
+    def cancel(self, job_id):
+        job = self.get_job(job_id)
+        with self.condition:
+            if job['state'] == QUEUED:
+                job['state'] = CANCELLED
+                job['finished'] = time.time()
+                self.save_job(job)
+            elif job['state'] == RUNNING:
+                # the build runs in its own process group with its commands.
+                # Before it is spawned, run_job checks the state instead.
+                if job_id in self.processes:
+                    os.killpg(self.processes[job_id].pid, signal.SIGTERM)
+                job['state'] = CANCELLED
+        return job
+
+    def get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job:
+            raise JobError("Unknown job %s" % job_id, 404)
+        return job
+
+    def get_artifacts(self, job):
+        project_directory = job['project_directory']
+        if not os.path.isdir(project_directory):
+            return []
+        return sorted(name for name in os.listdir(project_directory)
+                if name.endswith(ARTIFACT_EXTENSIONS))
+
+    def get_job_status(self, job):
+        """
+        Return the job with its progress and artifact URLs
+        """
+        status = dict(job)
+        status['queue_position'] = None
+        if job['state'] == QUEUED:
+            queued = [job_id for _, _, job_id in sorted(self.queue) if self.jobs[job_id]['state'] == QUEUED]
+            status['queue_position'] = queued.index(job['id']) if job['id'] in queued else None
+        if job['state'] == RUNNING and job['started']:
+            elapsed = time.time() - job['started']
+            status['elapsed'] = elapsed
+            if job['estimate']:
+                status['progress'] = min(99.0, elapsed * 100.0 / job['estimate'])
+        elif job['state'] == SUCCEEDED:
+            status['progress'] = 100.0
+        status['artifacts'] = ["/jobs/%s/artifacts/%s" % (job['id'], name)
+                for name in self.get_artifacts(job)]
+        return status
+
+    def prepare_base_image(self, config, variant):
+        """
+        Download the base image once, even if several jobs need it at the same time
+        """
+        base_image = get_base_image_path(config, variant)
+        with self.condition:
+            lock = self.base_image_locks.setdefault(base_image, threading.Lock())
+        with lock:
+            get_base_image(config, variant)
+
+    def get_build_cmd(self, job):
+        cmd = [sys.executable, BUILD_SCRIPT, self.projects_directory, job['config'], '-p', job['id'], '-t', job['variant']]
+        if job['backend']:
+            cmd += ['-b', job['backend']]
+        if job['trace']:
+            cmd += ['--trace']
+        return cmd
+
+    def run_job(self, job):
+        log_path = os.path.join(self.get_job_directory(job['id']), LOG_FILE_NAME)
+        with open(log_path, 'ab') as log:
+            try:
+                spec = BuildSpec(self.projects_directory, job['config'], job['variant'],
+                        project_name=job['id'])
+                plan = self.builder.plan(spec)
+                job['estimate'] = sum(seconds for _, seconds, _ in plan['stages'])
+                self.prepare_base_image(self.builder.load_config(job['config']), job['variant'])
+            except Exception as exception:
+                log.write(("ERROR: %s\n" % exception).encode('utf-8'))
+                return 1, str(exception)
+
+            with self.condition:
+                # cancelled while the plan was made or the base image downloaded
+                if job['state'] == CANCELLED:
+                    return 1, "cancelled before the build started"
+                process = subprocess.Popen(self.get_build_cmd(job), stdout=log,
+                        stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+                self.processes[job['id']] = process
+            returncode = process.wait()
+            with self.condition:
+                del self.processes[job['id']]
+
+        return returncode, None if returncode == 0 else "build exited with %s" % returncode
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not self.queue:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                _, _, job_id = heapq.heappop(self.queue)
+                job = self.jobs[job_id]
+                if job['state'] != QUEUED:
+                    continue
+                job['state'] = RUNNING
+                job['started'] = time.time()
+                self.save_job(job)
+
+            logger.info("Start job %s", job_id)
+            returncode, error = self.run_job(job)
+
+            with self.condition:
+                if job['state'] != CANCELLED:
+                    job['state'] = SUCCEEDED if returncode == 0 else FAILED
+                job['returncode'] = returncode
+                job['error'] = error
+                job['finished'] = time.time()
+                self.save_job(job)
+            logger.info("Job %s %s", job_id, job['state'])
+
+    def start(self):
+        for _ in range(self.max_jobs):
+            worker = threading.Thread(target=self.worker, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+            for process in self.processes.values():
+                os.killpg(process.pid, signal.SIGTERM)
+
+
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+    daemon = None
+
+    def address_string(self):
+        # client address of a Unix socket is empty
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, indent=4).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_route(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(part) for part in url.path.split('/') if part]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        return parts, query
+
+    def handle_errors(self, handler):
+        try:
+            handler()
+        except JobError as exception:
+            self.send_json({"error": str(exception)}, exception.status)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        self.handle_errors(self.get)
+
+    def do_POST(self):
+        self.handle_errors(self.post)
+
+    def do_DELETE(self):
+        self.handle_errors(self.delete)
+
+    def get(self):
+        parts, query = self.get_route()
+        daemon = self.daemon
+        if parts == ['health']:
+            states = [job['state'] for job in daemon.jobs.values()]
+            self.send_json({
+                "uptime": time.time() - daemon.started,
+                "max_jobs": daemon.max_jobs,
+                "queued": states.count(QUEUED),
+                "running": states.count(RUNNING),
+            })
+        elif parts == ['jobs']:
+            jobs = sorted(daemon.jobs.values(), key=lambda job: job['created'])
+            self.send_json([daemon.get_job_status(job) for job in jobs])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            self.send_json(daemon.get_job_status(daemon.get_job(parts[1])))
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'log':
+            self.send_log(daemon.get_job(parts[1]), int(query.get('offset', 0)), query.get('follow') == '1')
+        elif len(parts) == 4 and parts[0] == 'jobs' and parts[2] == 'artifacts':
+            self.send_artifact(daemon.get_job(parts[1]), parts[3])
+        else:
+            raise JobError("Not found", 404)
+
+    def post(self):
+        parts, _ = self.get_route()
+        if parts != ['jobs']:
+            raise JobError("Not found", 404)
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            raise JobError("Invalid JSON")
+        job = self.daemon.submit(request)
+        self.send_json(self.daemon.get_job_status(job), 201)
+
+    def delete(self):
+        parts, _ = self.get_route()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            raise JobError("Not found", 404)
+        self.send_json(self.daemon.get_job_status(self.daemon.cancel(parts[1])))
+
+    def send_log(self, job, offset, follow):
+        """
+        Send the log from offset. With follow, the log is streamed with
+        chunked transfer encoding until the job is finished.
+        """
+        log_path = os.path.join(self.daemon.get_job_directory(job['id']), LOG_FILE_NAME)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        if follow:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+            self.send_header('Content-Length', str(max(0, size - offset)))
+        self.end_headers()
+
+        while True:
+            finished = job['state'] in FINISHED_STATES
+            if os.path.exists(log_path):
+                with open(log_path, 'rb') as f:
+                    f.seek(offset)
+                    while True:
+                        data = f.read(LOG_CHUNK_SIZE)
+                        if not data:
+                            break
+                        offset += len(data)
+                        if follow:
+                            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                        else:
+                            self.wfile.write(data)
+            if not follow:
+                return
+            if finished:
+                break
+            self.wfile.flush()
+            time.sleep(FOLLOW_INTERVAL)
+
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_artifact(self, job, name):
+        if name not in self.daemon.get_artifacts(job):
+            raise JobError("Unknown artifact %s" % name, 404)
+        path = os.path.join(job['project_directory'], name)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, LOG_CHUNK_SIZE * 16)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(address, handler):
+    """
+    Return HTTP server on host:port or on a Unix socket path
+    """
+    if address.startswith('/') or address.startswith('unix:'):
+        path = address[len('unix:'):] if address.startswith('unix:') else address
+        if os.path.exists(path):
+            os.remove(path)
+        server = ThreadingUnixHTTPServer(path, handler)
+        os.chmod(path, 0o660)
+        return server
+
+    host, _, port = address.rpartition(':')
+    return http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+
+
+def run_daemon(state_directory, address=DAEMON_ADDRESS, max_jobs=1, backend=None, apt_proxy=None):
+    daemon = BuildDaemon(state_directory, max_jobs, backend)
+    handler = type('Handler', (DaemonRequestHandler,), {'daemon': daemon})
+    server = create_server(address, handler)
+    if apt_proxy:
+        # the builds with apt_cache_proxy attach to it, it lives as long as the daemon
+        start_proxy(os.path.join(daemon.state_directory, 'apt-cache'), apt_proxy, detached=False)
+    daemon.start()
+    logger.info("Build daemon listening on %s with %d concurrent jobs", address, max_jobs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        server.server_close()
+
+    return 0
@@ -0,0 +1,197 @@
+"""
+Read the dpkg database of a rootfs without dpkg on the host.
+
+iter_deb822() - stream the stanzas of deb822 lines
+iter_dpkg_status() - stream the stanzas of var/lib/dpkg/status
+get_package_index() - structured index of installed packages
+index_packages() - the same index of status stanzas, e.g. read from a squashfs
+get_manifest_lines() - lines of filesystem.manifest
+check_manifest_remove() - verify filesystem.manifest-remove against the index
+"""
+
+import os
+
+from utilities.logger import create_logger
+
+logger = create_logger(__name__)
+
+DPKG_DIRECTORY = os.path.join('var', 'lib', 'dpkg')
+
+
+def get_dpkg_directory(custom_root_directory):
+    return os.path.join(custom_root_directory, DPKG_DIRECTORY)
+
+
+def iter_deb822(lines):
+    """
+    Parse deb822 lines one stanza at a time.
+    Yield a dictionary of field name to value for each stanza.
+    Continuation lines are joined with a newline as dpkg does.
+    """
+    stanza = {}
+    field = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            if stanza:
+                yield stanza
+            stanza = {}
+            field = None
+            continue
+
+        if line[0] in ' \t':
+            # continuation of the previous field
+            if field:
+                stanza[field] += '\n' + line[1:]
+            continue
+
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        field = key.strip()
+        stanza[field] = value.strip()
+
+    if stanza:
+        yield stanza
+
+
+def iter_dpkg_status(status_path):
+    """
+    Parse a deb822 status file one stanza at a time
+    """
+    with open(status_path, 'r', encoding='utf-8', errors='replace') as f:
+        yield from iter_deb822(f)
+
+
+def get_native_architecture(custom_root_directory, packages=None):
+    """
+    Return the native architecture of the rootfs.
+    Read var/lib/dpkg/arch if exists, else use the architecture of dpkg itself.
+    """
+    arch_file = os.path.join(get_dpkg_directory(custom_root_directory), 'arch')
+    if os.path.isfile(arch_file):
+        with open(arch_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    return line.strip()
+
+    if packages and 'dpkg' in packages:
+        return packages['dpkg']['architecture']
+
+    return None
+
+
+def get_binary_package_name(package, native_architecture):
+    """
+    Same as ${binary:Package} of dpkg-query. The architecture is appended
+    for Multi-Arch: same packages and foreign architecture packages.
+    """
+    name = package['name']
+    architecture = package['architecture']
+    if architecture in ('', 'all'):
+        return name
+
+    if package['multi_arch'] == 'same' or architecture != native_architecture:
+        return "%s:%s" % (name, architecture)
+
+    return name
+
+
+def get_package_index(custom_root_directory):
+    """
+    Return dictionary of binary package name to package details:
+    name, version, architecture, installed_size (KiB), multi_arch and status.
+    Packages marked as not-installed are skipped, as dpkg-query --show does.
+    """
+    status_path = os.path.join(get_dpkg_directory(custom_root_directory), 'status')
+    logger.info("Read dpkg status in %s", status_path)
+
+    index = index_packages(iter_dpkg_status(status_path), get_native_architecture(custom_root_directory))
+    logger.info("Found %s packages in dpkg status", len(index))
+    return index
+
+
+def index_packages(stanzas, native_architecture=None):
+    """
+    Return the package index of get_package_index() of dpkg status stanzas.
+    Without native_architecture the architecture of dpkg itself is used.
+    """
+    packages = []
+    for stanza in stanzas:
+        if 'Package' not in stanza:
+            continue
+
+        status = stanza.get('Status', '')
+        if status.endswith('not-installed'):
+            continue
+
+        installed_size = stanza.get('Installed-Size', '0')
+        packages.append({
+            'name': stanza['Package'],
+            'version': stanza.get('Version', ''),
+            'architecture': stanza.get('Architecture', ''),
+            'installed_size': int(installed_size) if installed_size.isdigit() else 0,
+            'multi_arch': stanza.get('Multi-Arch', ''),
+            'status': status,
+        })
+
+    by_name = {package['name']: package for package in packages}
+    if not native_architecture and 'dpkg' in by_name:
+        native_architecture = by_name['dpkg']['architecture']
+
+    index = {}
+    for package in packages:
+        index[get_binary_package_name(package, native_architecture)] = package
+
+    return index
+
+
+def is_installed(package):
+    """
+    Return True if the package of the index is installed, not only its
+    configuration files are kept (rc)
+    """
+    return package['status'].endswith(' installed')
+
+
+def get_manifest_lines(package_index):
+    """
+    Return the lines of filesystem.manifest sorted by package name
+    """
+    lines = []
+    for name in sorted(package_index):
+        lines.append("%s\t%s" % (name, package_index[name]['version']))
+
+    return lines
+
+
+def check_manifest_remove(package_index, manifest_remove_path):
+    """
+    Packages in filesystem.manifest-remove are removed by the installer.
+    Return the list of packages in manifest-remove which are not installed.
+    """
+    missing = []
+    if not os.path.isfile(manifest_remove_path):
+        return missing
+
+    installed = set(package_index)
+    installed.update(package['name'] for package in package_index.values())
+
+    with open(manifest_remove_path, 'r') as f:
+        for line in f:
+            name = line.split()[0] if line.strip() else ''
+            if name and name not in installed:
+                missing.append(name)
+
+    if missing:
+        logger.warning("%s packages in %s are not installed: %s",
+                len(missing), manifest_remove_path, ' '.join(missing))
+
+    return missing
+
+
+def get_installed_size_bytes(package_index):
+    """
+    Return the sum of Installed-Size of all packages in bytes
+    """
+    return sum(package['installed_size'] for package in package_index.values()) * 1024
@@ -0,0 +1,20 @@
+"""
+Exceptions of the build pipeline
+"""
+
+
+class BuildError(Exception):
+    """
+    The build cannot continue. exit_code is used by the command line.
+    """
+    def __init__(self, message, exit_code=1):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+def check_return_code(ret, name):
+    """
+    Raise BuildError if the command of a stage failed, with its return code as exit code
+    """
+    if ret:
+        raise BuildError("%s failed, ret: %s" % (name, ret), ret if 0 < ret < 256 else 1)
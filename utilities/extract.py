@@ -1,11 +1,12 @@
 #!/usr/bin/python3
 
 import os
-import subprocess
-import shutil
 
 from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
 from utilities.file_ops import get_directory_for_file
+from utilities.util import call_cmd
+from utilities.reaper import reap_directory
 
 logger = create_logger(__name__)
 
@@ -35,6 +36,7 @@ def get_casper_directory(iso_mount_point, custom_disk_directory):
     return casper_directory
 
 
+@trace_stage
 def copy_original_iso_files(iso_mount_point, custom_disk_directory):
     logger.info("Copy original disk image")
     source_path = os.path.join(iso_mount_point, '')
@@ -94,10 +96,11 @@ def copy_original_iso_files(iso_mount_point, custom_disk_directory):
             target_path=target_path,
             casper_directory=casper_directory)
     logger.debug(cmd)
-    ret = subprocess.run(cmd, shell=True)
-    return ret.returncode
+    ret = call_cmd(cmd)
+    return ret
 
 
+@trace_stage
 def extract_squashfs(iso_mount_point, custom_root_directory):
     logger.info("Extract the compressed Linux file system")
     target_path = custom_root_directory
@@ -109,11 +112,10 @@ def extract_squashfs(iso_mount_point, custom_root_directory):
 
     if os.path.exists(source_path):
         if os.path.exists(target_path):
-            shutil.rmtree(target_path)
+            reap_directory(target_path)
 
         cmd = "unsquashfs -dest %s %s" % (target_path, source_path)
-        ret = subprocess.run(cmd, shell=True)
-        ret = ret.returncode
+        ret = call_cmd(cmd)
     else:
         logger.error("Source path %s is not exists", source_path)
         ret = 1
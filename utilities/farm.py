@@ -0,0 +1,386 @@
+"""
+Distributed build farm. A coordinator hands out one job per variant of
+a config to the workers, which pull jobs, build them with the Builder and
+share base images, kernel overlays and output images through the cache
+server in utilities/cas.py. Coordinator, workers and cache server can
+run on one machine as separate processes.
+
+Coordinator API:
+  POST /lease                 {"worker"} -> job and config, 204 if none is free, 410 when all are done
+  POST /jobs/<id>/heartbeat   {"worker"} keep the lease, 409 if it was lost
+  POST /jobs/<id>/complete    {"worker", "state", "outputs": {name: digest}, "error"}
+  GET  /jobs                  state of the jobs
+"""
+
+import copy
+import http.server
+import json
+import os
+import re
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from utilities.logger import create_logger
+from utilities.errors import BuildError
+from utilities.builder import Builder, BuildSpec
+from utilities.cas import CacheClient
+from utilities.daemon import create_server
+from utilities.file_ops import make_directories
+from utilities.parser import get_base_image_url, get_base_image_path, get_kernel_overlays
+from utilities.util import run_cmd
+
+logger = create_logger(__name__)
+
+COORDINATOR_ADDRESS = "127.0.0.1:8472"
+# a leased job is given to another worker without heartbeat for this long
+LEASE_TIMEOUT = 300
+HEARTBEAT_INTERVAL = 30
+POLL_INTERVAL = 5
+MAX_ATTEMPTS = 2
+# the coordinator keeps answering 410 for a while so the workers can stop
+LINGER = 10
+
+# job states
+QUEUED = "queued"
+LEASED = "leased"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+def get_url_ref(url):
+    return "url:%s" % url
+
+
+class Coordinator:
+    """
+    One job per variant, leased to the workers
+    """
+    def __init__(self, config, variants, lease_timeout=LEASE_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        self.config = config
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.jobs = {}
+        for variant in variants:
+            self.jobs[variant] = {
+                "id": variant,
+                "variant": variant,
+                "state": QUEUED,
+                "worker": None,
+                "heartbeat": None,
+                "attempts": 0,
+                "outputs": {},
+                "error": None,
+                "duration": None,
+            }
+
+    def expire_leases(self):
+        now = time.time()
+        for job in self.jobs.values():
+            if job['state'] == LEASED and now - job['heartbeat'] > self.lease_timeout:
+                logger.warning("Lease of %s by %s expired", job['id'], job['worker'])
+                job['state'] = QUEUED if job['attempts'] < self.max_attempts else FAILED
+                job['error'] = "lease expired"
+
+    def is_finished(self):
+        with self.lock:
+            return all(job['state'] in (SUCCEEDED, FAILED) for job in self.jobs.values())
+
+    def lease(self, worker):
+        """
+        Return a queued job or None
+        """
+        with self.lock:
+            self.expire_leases()
+            for job in self.jobs.values():
+                if job['state'] == QUEUED:
+                    job['state'] = LEASED
+                    job['worker'] = worker
+                    job['heartbeat'] = time.time()
+                    job['attempts'] += 1
+                    logger.info("Job %s leased to %s", job['id'], worker)
+                    return dict(job)
+        return None
+
+    def get_leased_job(self, job_id, worker):
+        job = self.jobs.get(job_id)
+        if not job or job['state'] != LEASED or job['worker'] != worker:
+            return None
+        return job
+
+    def heartbeat(self, job_id, worker):
+        with self.lock:
+            job = self.get_leased_job(job_id, worker)
+            if job:
+                job['heartbeat'] = time.time()
+            return job is not None
+
+    def complete(self, job_id, worker, result):
+        with self.lock:
+            job = self.get_leased_job(job_id, worker)
+            if not job:
+                return False
+            job['outputs'] = result.get('outputs', {})
+            job['error'] = result.get('error')
+            job['duration'] = result.get('duration')
+            if result.get('state') == SUCCEEDED:
+                job['state'] = SUCCEEDED
+            else:
+                job['state'] = QUEUED if job['attempts'] < self.max_attempts else FAILED
+            logger.info("Job %s %s on %s", job_id, job['state'], worker)
+            return True
+
+    def get_jobs(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+
+class CoordinatorRequestHandler(http.server.BaseHTTPRequestHandler):
+    coordinator = None
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, indent=4).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return {}
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path.rstrip('/') == '/jobs':
+            self.send_json(self.coordinator.get_jobs())
+        else:
+            self.send_json({"error": "Not found"}, 404)
+
+    def do_POST(self):
+        parts = [part for part in urllib.parse.urlsplit(self.path).path.split('/') if part]
+        request = self.read_json()
+        worker = request.get('worker', self.address_string())
+        coordinator = self.coordinator
+
+        if parts == ['lease']:
+            job = coordinator.lease(worker)
+            if job:
+                self.send_json({"job": job, "config": coordinator.config})
+            elif coordinator.is_finished():
+                self.send_json({"error": "All jobs are finished"}, 410)
+            else:
+                self.send_response(204)
+                self.end_headers()
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'heartbeat':
+            ok = coordinator.heartbeat(parts[1], worker)
+            self.send_json({"ok": ok}, 200 if ok else 409)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'complete':
+            ok = coordinator.complete(parts[1], worker, request)
+            self.send_json({"ok": ok}, 200 if ok else 409)
+        else:
+            self.send_json({"error": "Not found"}, 404)
+
+
+def download_outputs(jobs, cache_url, output_directory):
+    """
+    Download the output images of the succeeded jobs to output_directory/<variant>/
+    """
+    cache = CacheClient(cache_url)
+    for job in jobs:
+        for name, digest in job['outputs'].items():
+            file_path = os.path.join(output_directory, job['variant'], name)
+            cache.download(digest, file_path)
+            logger.info("Downloaded %s", file_path)
+
+
+def run_coordinator(config, variants, address=COORDINATOR_ADDRESS, lease_timeout=LEASE_TIMEOUT,
+        cache_url=None, output_directory=None):
+    """
+    Serve the jobs until all are finished.
+    Return: 0 if all jobs succeeded
+    """
+    variants = variants or sorted(config['variant'])
+    coordinator = Coordinator(config, variants, lease_timeout)
+    handler = type('Handler', (CoordinatorRequestHandler,), {'coordinator': coordinator})
+    server = create_server(address, handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info("Coordinator listening on %s with %d jobs", address, len(variants))
+
+    try:
+        while not coordinator.is_finished():
+            time.sleep(1)
+        time.sleep(LINGER)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    jobs = coordinator.get_jobs()
+    for job in jobs:
+        logger.info("%s: %s %s", job['variant'], job['state'], job['error'] or '')
+    if cache_url and output_directory:
+        download_outputs([job for job in jobs if job['state'] == SUCCEEDED], cache_url, output_directory)
+
+    return 0 if all(job['state'] == SUCCEEDED for job in jobs) else 1
+
+
+class Worker:
+    """
+    Pull jobs from the coordinator and build them
+    """
+    def __init__(self, coordinator_url, cache_url, work_directory, backend=None, name=None):
+        self.coordinator_url = coordinator_url.rstrip('/')
+        self.cache = CacheClient(cache_url)
+        self.work_directory = os.path.abspath(work_directory)
+        self.backend = backend
+        self.name = name or "%s-%d" % (socket.gethostname(), os.getpid())
+        self.builder = Builder()
+
+    def post(self, path, data):
+        """
+        Return: status code and JSON response
+        """
+        body = json.dumps(dict(data, worker=self.name)).encode('utf-8')
+        request = urllib.request.Request(self.coordinator_url + path, data=body, method='POST',
+                headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                content = response.read()
+                return response.status, json.loads(content) if content else {}
+        except urllib.error.HTTPError as exception:
+            return exception.code, {}
+
+    def fetch_url(self, url, file_path):
+        """
+        Fetch url from the cache server, or download it and publish it to the cache
+        """
+        if os.path.exists(file_path):
+            return
+        if self.cache.fetch(get_url_ref(url), file_path):
+            logger.info("Fetched %s from cache", url)
+            return
+
+        make_directories(os.path.dirname(file_path))
+        cmd = "wget --no-check-certificate --output-document=%s %s" % (file_path + '.part', url)
+        ret, output = run_cmd(cmd)
+        if ret:
+            raise BuildError("Failed to download %s: %s" % (url, output))
+        os.replace(file_path + '.part', file_path)
+        self.cache.publish(get_url_ref(url), file_path)
+
+    def prepare_config(self, config, variant):
+        """
+        Return the config with the local cache of this worker and
+        the kernel overlays fetched through the cache server
+        """
+        config = copy.deepcopy(config)
+        config['cache'] = os.path.join(self.work_directory, 'cache')
+        config['variant'][variant].pop('cache', None)
+
+        base_image_url = get_base_image_url(config, variant)
+        self.fetch_url(base_image_url, get_base_image_path(config, variant))
+
+        overlays = get_kernel_overlays(config, variant) or []
+        for index, url in enumerate(overlays):
+            if url.startswith('http'):
+                file_path = os.path.join(config['cache'], 'overlays', os.path.basename(url))
+                self.fetch_url(url, file_path)
+                overlays[index] = file_path
+
+        return config
+
+    def keep_lease(self, job_id, stop, lost):
+        """
+        Send heartbeats until stop is set. The lease of an expired job is
+        given to another worker, then lost is set and the build stops.
+        """
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            status, _ = self.post('/jobs/%s/heartbeat' % job_id, {})
+            if status == 409:
+                logger.warning("Lease of job %s is lost, stop the build", job_id)
+                lost.set()
+                return
+
+    def get_project_name(self, job):
+        """
+        Return the project name of a job on this worker. The job id is the
+        variant, the workers of one machine, also of other coordinators,
+        must not share the project directory and its container name.
+        """
+        return re.sub(r'[^A-Za-z0-9._-]', '_', "%s-%s" % (job['id'], self.name))
+
+    def run_job(self, job, config):
+        started = time.time()
+        stop = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(target=self.keep_lease, args=(job['id'], stop, lost), daemon=True)
+        heartbeat.start()
+        try:
+            config = self.prepare_config(config, job['variant'])
+            spec = BuildSpec(os.path.join(self.work_directory, 'projects'), config, job['variant'],
+                    project_name=self.get_project_name(job), backend=self.backend, cancel=lost)
+            result = self.builder.build(spec)
+            spec.check_cancelled()
+            outputs = {os.path.basename(path): self.cache.upload(path) for path in result.outputs}
+            report = {"state": SUCCEEDED, "outputs": outputs}
+        except Exception as exception:
+            # the worker keeps pulling jobs whatever failed in the build
+            logger.error("Job %s failed: %s", job['id'], exception)
+            report = {"state": FAILED, "error": str(exception)}
+        finally:
+            stop.set()
+
+        if lost.is_set():
+            # the job belongs to another worker now
+            logger.warning("Drop the result of job %s", job['id'])
+            return
+        report['duration'] = time.time() - started
+        self.post('/jobs/%s/complete' % job['id'], report)
+
+    def run(self, once=False):
+        """
+        Build the jobs until the coordinator has none left.
+        Return: 0
+        """
+        logger.info("Worker %s pulls jobs from %s", self.name, self.coordinator_url)
+        while True:
+            try:
+                status, response = self.post('/lease', {})
+            except urllib.error.URLError as exception:
+                logger.warning("Coordinator is not reachable: %s", exception.reason)
+                if once:
+                    return 1
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            if status == 410:
+                logger.info("No job left")
+                return 0
+            if status != 200:
+                if once:
+                    return 0
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            self.run_job(response['job'], response['config'])
+            if once:
+                return 0
+
+
+def run_worker(coordinator_url, cache_url, work_directory, backend=None, name=None, once=False):
+    return Worker(coordinator_url, cache_url, work_directory, backend, name).run(once)
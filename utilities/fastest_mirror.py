@@ -0,0 +1,284 @@
+"""
+Fastest-mirror selection. The mirrors of a source are listed in config.json
+by the URL prefix of the source, with the same layout below the prefix:
+
+    "mirrors": {
+        "http://archive.ubuntu.com/ubuntu": ["http://de.archive.ubuntu.com/ubuntu", ...],
+        "https://releases.ubuntu.com": ["https://mirror.example.org/ubuntu-releases"]
+    }
+
+The source and its mirrors are probed in parallel with a small ranged
+request for latency and throughput, and the ranking is cached in
+<cache>/mirrors.json for MIRROR_RANKING_TTL seconds. Downloads go to the
+best mirror and fail over to the next one, resuming where the transfer
+stopped, if a mirror stalls. apt in the container gets the ranked mirrors
+as a mirror+file: source, so it fails over by itself.
+
+get_ranked_urls() - URLs of a file on the mirrors, best first
+download_file() - download with failover
+set_apt_mirrors() - sources of the rootfs with the ranked mirrors
+rewrite_sources() - sources with the best mirror, for apt on the host
+"""
+
+import concurrent.futures
+import http.client
+import json
+import os
+import shutil
+import time
+import urllib.request
+
+from utilities.logger import create_logger
+from utilities.util import set_apt_sources, remove_apt_sources
+
+logger = create_logger(__name__)
+
+MIRROR_RANKING_FILE = "mirrors.json"
+MIRROR_RANKING_TTL = 6 * 3600
+PROBE_SIZE = 256 * 1024
+PROBE_TIMEOUT = 10
+# size of a typical download to weigh latency against throughput
+REFERENCE_SIZE = 8 * 1024 * 1024
+# seconds without data before the download fails over to the next mirror
+STALL_TIMEOUT = 20
+CHUNK_SIZE = 1024 * 1024
+APT_MIRRORS_DIRECTORY = "etc/apt/mirrors"
+
+
+def find_mirrors(mirrors, url):
+    """
+    Return the prefix of url in mirrors and the list of the prefix and its mirrors,
+    or None if url has no mirrors
+    """
+    matches = [prefix for prefix in mirrors
+            if url == prefix.rstrip('/') or url.startswith(prefix.rstrip('/') + '/')]
+    if not matches:
+        return None, None
+
+    prefix = max(matches, key=len)
+    candidates = [prefix.rstrip('/')] + [mirror.rstrip('/') for mirror in mirrors[prefix]]
+    return prefix.rstrip('/'), candidates
+
+
+def probe_mirror(url, size=PROBE_SIZE, timeout=PROBE_TIMEOUT):
+    """
+    Read the first size bytes of url.
+    Return (latency in seconds, throughput in bytes per second) or None if it failed.
+    """
+    request = urllib.request.Request(url, headers={'Range': 'bytes=0-%d' % (size - 1)})
+    started = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            received = len(response.read(1))
+            latency = time.monotonic() - started
+            # a mirror which ignores the range sends the whole file, it is not read
+            received += len(response.read(size - 1))
+    except (OSError, http.client.HTTPException, ValueError) as exception:
+        logger.debug("Probe of %s failed: %s", url, exception)
+        return None
+
+    elapsed = max(time.monotonic() - started - latency, 0.001)
+    return latency, received / elapsed
+
+
+def get_score(latency, throughput):
+    """
+    Estimated seconds to download REFERENCE_SIZE bytes
+    """
+    return latency + REFERENCE_SIZE / max(throughput, 1)
+
+
+def load_rankings(cache_directory):
+    ranking_path = os.path.join(cache_directory, MIRROR_RANKING_FILE)
+    if not os.path.isfile(ranking_path):
+        return {}
+    try:
+        with open(ranking_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_rankings(cache_directory, rankings):
+    os.makedirs(cache_directory, exist_ok=True)
+    ranking_path = os.path.join(cache_directory, MIRROR_RANKING_FILE)
+    with open(ranking_path + '.tmp', 'w') as f:
+        json.dump(rankings, f, indent=4)
+    os.replace(ranking_path + '.tmp', ranking_path)
+
+
+def rank_mirrors(prefix, candidates, relative_path, cache_directory):
+    """
+    Return the candidates, fastest first. The candidates which failed the probe are last.
+    The ranking is cached by prefix.
+    """
+    rankings = load_rankings(cache_directory) if cache_directory else {}
+    cached = rankings.get(prefix)
+    if cached and cached['candidates'] == candidates and time.time() - cached['time'] < MIRROR_RANKING_TTL:
+        return cached['ranking']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        results = list(executor.map(lambda candidate: probe_mirror(candidate + relative_path), candidates))
+
+    scores = {}
+    for candidate, result in zip(candidates, results):
+        if result:
+            scores[candidate] = get_score(*result)
+            logger.info("Mirror %s: latency %.0fms, %.1fMB/s", candidate, result[0] * 1000,
+                    result[1] / 1024 / 1024)
+        else:
+            logger.warning("Mirror %s is not reachable", candidate)
+    ranking = sorted(candidates, key=lambda candidate: scores.get(candidate, float('inf')))
+
+    if cache_directory:
+        rankings[prefix] = {"time": time.time(), "candidates": candidates, "ranking": ranking}
+        save_rankings(cache_directory, rankings)
+    return ranking
+
+
+def get_ranked_urls(mirrors, url, cache_directory, probe_path=None):
+    """
+    Return the URLs of url on its mirrors, best first. probe_path is the
+    path below the prefix which is probed, default is the path of url.
+    """
+    prefix, candidates = find_mirrors(mirrors or {}, url)
+    if not prefix:
+        return [url]
+
+    relative_path = url[len(prefix):]
+    ranking = rank_mirrors(prefix, candidates, probe_path or relative_path, cache_directory)
+    return [candidate + relative_path for candidate in ranking]
+
+
+def get_total_size(response, offset):
+    """
+    Return the size of the whole file from the response or None if unknown
+    """
+    content_range = response.getheader('Content-Range')
+    if response.status == 206 and content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    length = response.getheader('Content-Length')
+    return int(length) + offset if length and length.isdigit() else None
+
+
+def download_file(urls, file_path, stall_timeout=STALL_TIMEOUT):
+    """
+    Download the file from the first URL and fail over to the next one when
+    a mirror stalls or fails, resuming at the received size.
+    Return: True if the file is downloaded
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = file_path + '.part'
+    offset = 0
+    with open(temp_path, 'wb') as f:
+        for url in urls:
+            headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+            request = urllib.request.Request(url, headers=headers)
+            try:
+                with urllib.request.urlopen(request, timeout=stall_timeout) as response:
+                    if offset and response.status != 206:
+                        # the mirror does not resume, start again
+                        f.seek(0)
+                        f.truncate()
+                        offset = 0
+                    total = get_total_size(response, offset)
+                    logger.info("Download %s from %d", url, offset)
+                    # read1 returns what arrived, the data received before a stall is kept
+                    for chunk in iter(lambda: response.read1(CHUNK_SIZE), b''):
+                        f.write(chunk)
+                        offset += len(chunk)
+                if total is not None and offset != total:
+                    raise OSError("Received %d of %d bytes" % (offset, total))
+            except (OSError, http.client.HTTPException) as exception:
+                # a stall is a read timeout
+                logger.warning("Download from %s failed at %d bytes: %s", url, offset, exception)
+                continue
+
+            os.replace(temp_path, file_path)
+            return True
+
+    os.remove(temp_path)
+    logger.error("Cannot download %s", os.path.basename(file_path))
+    return False
+
+
+def get_probe_path(source):
+    """
+    Return path of the Release file of the apt source below its URI
+    """
+    if source['suite'].endswith('/'):
+        return "/%s/Release" % source['suite'].rstrip('/')
+    return "/dists/%s/Release" % source['suite']
+
+
+def get_source_line(source, uri):
+    options = ' '.join("%s=%s" % (key, value) for key, value in source['options'].items())
+    words = ['deb'] + (["[%s]" % options] if options else []) + [uri, source['suite']] + source['components']
+    return ' '.join(words)
+
+
+def write_embedded_key(source, number, mirrors_directory):
+    """
+    Return the source with the key embedded in its deb822 Signed-By written
+    to a keyring in mirrors_directory, a one-line source names it by path
+    """
+    key = source['options'].get('signed-by', '')
+    if '\n' not in key:
+        return source
+
+    os.makedirs(mirrors_directory, exist_ok=True)
+    key_name = "%d.asc" % number
+    with open(os.path.join(mirrors_directory, key_name), 'w') as f:
+        f.write(key)
+    options = dict(source['options'])
+    options['signed-by'] = "/%s/%s" % (APT_MIRRORS_DIRECTORY, key_name)
+    return dict(source, options=options)
+
+
+def set_apt_mirrors(mirrors, sources, custom_root_directory, cache_directory):
+    """
+    Make apt in the rootfs use the ranked mirrors of the sources, in a
+    mirror+file: list per source.
+    Return: True if any source has mirrors
+    """
+    mirrors_directory = os.path.join(custom_root_directory, APT_MIRRORS_DIRECTORY)
+    lines = []
+    found = False
+    for number, source in enumerate(sources):
+        source = write_embedded_key(source, number, mirrors_directory)
+        prefix, _ = find_mirrors(mirrors or {}, source['uri'])
+        if not prefix:
+            lines.append(get_source_line(source, source['uri']))
+            continue
+
+        urls = get_ranked_urls(mirrors, source['uri'], cache_directory, get_probe_path(source))
+        os.makedirs(mirrors_directory, exist_ok=True)
+        list_name = "%d.list" % number
+        # apt contacts the mirrors without a priority in random order, 1 is tried first
+        with open(os.path.join(mirrors_directory, list_name), 'w') as f:
+            f.write(''.join("%s\tpriority:%d\n" % (url, rank) for rank, url in enumerate(urls, 1)))
+        lines.append(get_source_line(source, "mirror+file:/%s/%s" % (APT_MIRRORS_DIRECTORY, list_name)))
+        found = True
+
+    if found:
+        set_apt_sources(lines, custom_root_directory)
+    return found
+
+
+def remove_apt_mirrors(custom_root_directory):
+    remove_apt_sources(custom_root_directory)
+    mirrors_directory = os.path.join(custom_root_directory, APT_MIRRORS_DIRECTORY)
+    if os.path.isdir(mirrors_directory):
+        shutil.rmtree(mirrors_directory)
+
+
+def rewrite_sources(mirrors, sources, cache_directory):
+    """
+    Return the sources with the URI of the best mirror
+    """
+    rewritten = []
+    for source in sources:
+        urls = get_ranked_urls(mirrors, source['uri'], cache_directory, get_probe_path(source))
+        rewritten.append(dict(source, uri=urls[0]))
+    return rewritten
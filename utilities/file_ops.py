@@ -2,9 +2,9 @@
 
 import os
 import shutil
-import sys
 
 from utilities.logger import create_logger
+from utilities.errors import BuildError
 
 logger = create_logger(__name__)
 
@@ -84,5 +84,4 @@ def copy_to(source_path, dest_path):
         else:
             shutil.copytree(source_path, dest_path)
     else:
-        logger.error("Source file %s is not exists", source_path)
-        sys.exit(1)
+        raise BuildError("Source file %s is not exists" % source_path)
@@ -5,27 +5,30 @@ Start with do_image() as entry point.
 
 import os
 import subprocess
-import sys
 import time
 
 from utilities.logger import create_logger
+from utilities.errors import BuildError
+from utilities.telemetry import trace_stage
 from utilities.file_ops import copy_to, make_directory, make_directories
 from utilities.iso import unmount
 from utilities.container import unmount_chroot
-from utilities.constant import DISK_NAME
+from utilities.constant import DISK_NAME, EFI_PARTITION_SIZE, SWAP_PARTITION_SIZE, IMAGE_HEADROOM, EXT4_OVERHEAD_PERCENT
 from utilities.kernel import get_vmlinuz_list, get_initrd_list, copy_kernel, copy_initrd, select_kernel_initrd
-from utilities.util import run_cmd, get_rootfs_size_bytes
+from utilities.util import run_cmd, call_cmd, get_rootfs_size_bytes
+from utilities.backend import get_operation
 
 logger = create_logger(__name__)
 
+@trace_stage
 def do_image(target_disk_directory, project_directory, custom_root_directory,
-        custom_disk_directory, kernel_version):
+        custom_disk_directory, kernel_version, image_headroom=IMAGE_HEADROOM):
     """
     Step to build the image.
 
     """
     # image size in MB
-    image_size = 10240
+    image_size = get_image_size(custom_root_directory, image_headroom)
     disk_path = os.path.join(target_disk_directory, DISK_NAME)
     loop_device = prepare_image(disk_path, image_size)
     logger.debug("%s is mounted on loop device %s", DISK_NAME, loop_device)
@@ -38,54 +41,81 @@ def do_image(target_disk_directory, project_directory, custom_root_directory,
     cleanup(loop_device, project_directory)
 
 
+def get_image_size(custom_root_directory, image_headroom=IMAGE_HEADROOM):
+    """
+    Calculate the image size in MB from the measured rootfs.
+    image size = efi + rootfs + ext4 overhead + headroom + swap
+    """
+    rootfs_size = int(get_rootfs_size_bytes(custom_root_directory))
+    rootfs_size = -(-rootfs_size // (1024 * 1024))
+    rootfs_size += rootfs_size * EXT4_OVERHEAD_PERCENT // 100
+    image_size = 2 + EFI_PARTITION_SIZE + rootfs_size + image_headroom + SWAP_PARTITION_SIZE
+    logger.info("The image size is %sMB (rootfs %sMB, headroom %sMB)",
+            image_size, rootfs_size, image_headroom)
+    return image_size
+
+
+def create_sparse_image(disk_path, image_size):
+    """
+    Create a blank sparse image of image_size MB. No data is written,
+    the blocks are allocated when the partitions are populated.
+    """
+    logger.info("Creating sparse raw disk image %s of %sMB", disk_path, image_size)
+    if os.path.exists(disk_path):
+        os.remove(disk_path)
+    with open(disk_path, 'wb') as f:
+        f.truncate(image_size * 1024 * 1024)
+
+
 def prepare_image(disk_path, image_size):
     """
     Create a blank image and mount it to loop device.
     Image size must be greater than boot partition + rootfs.
-    Default image_size is 10GB.
+    See get_image_size().
     Return: loop device
     """
     logger.info("Creating raw disk image in %s", disk_path)
     # create a blank image
-    cmd = "dd if=/dev/zero of=%s bs=1M count=%s" % (disk_path, image_size)
-    ret = subprocess.run(cmd, shell=True)
+    create_sparse_image(disk_path, image_size)
 
-    # mount the disk to loop device
-    cmd = "losetup -fP %s" % disk_path
-    ret = subprocess.run(cmd, shell=True)
+    # mount the disk to loop device and get which loop device is used
+    loop_device = get_operation("attach_loop")(disk_path)
+    if not loop_device:
+        raise BuildError("Failed to attach %s to loop device" % disk_path)
 
-    # get which loop device is used to mount the disk image
-    cmd = "losetup -a | grep %s | awk -F ':' '{print $1}'" % DISK_NAME
-    output = subprocess.check_output(cmd, shell=True).decode("utf-8").strip()
-
-    return output
+    return loop_device
 
 
 def get_partitions_details(image_size):
     """
-    Partition 1 - vfat - for efi (500MB)
+    Partition 1 - vfat - for efi (EFI_PARTITION_SIZE)
     Partition 2 - ext4 - for rootfs (image_size - efi - swap)
-    Partition 3 - swap - 1024MB
+    Partition 3 - swap - SWAP_PARTITION_SIZE
+    The first and the last 1MB are left for the GPT headers.
     return: dictionary
     """
+    # e.g. 10240MB image
     # 1 500
-    # 501 9215
-    # 9216 10240
-    efi_size = 500
-    swap_size = 1024
-    end_swap = image_size
-    start_swap = end_swap - swap_size
+    # 501 9214
+    # 9215 10239
+    start_efi = 1
+    end_efi = start_efi + EFI_PARTITION_SIZE - 1
+    end_swap = image_size - 1
+    start_swap = end_swap - SWAP_PARTITION_SIZE
     end_rootfs = start_swap - 1
 
+    if end_rootfs <= end_efi:
+        raise BuildError("Image size %sMB is too small for the partitions" % image_size)
+
     partitions = {
         "efi": {
-            "start": 1,
-            "end": 500,
+            "start": start_efi,
+            "end": end_efi,
             "format": "vfat",
             "flag": "boot"
         },
         "rootfs": {
-            "start": 501,
+            "start": end_efi + 1,
             "end": end_rootfs,
             "format": "ext4"
         },
@@ -97,6 +127,7 @@ def get_partitions_details(image_size):
     }
     return partitions
 
+@trace_stage
 def create_partition(loop_device, disk_path, image_size):
     """
     Create a partition table such as gpt or msdos.
@@ -131,6 +162,7 @@ def create_partition(loop_device, disk_path, image_size):
         ret, output = run_cmd(cmd)
 
 
+@trace_stage
 def format_partition(loop_device, image_size):
     """
     Format the partitions according to get_partitions_details().
@@ -149,9 +181,8 @@ def format_partition(loop_device, image_size):
         elif 'swap' in value['format']:
             cmd = "mkswap %s" % lo_partition
         else:
-            logger.error("Failed to format partition %s. Unknown partition format %s", number, value['format'])
             cleanup_loop_device(loop_device)
-            sys.exit(1)
+            raise BuildError("Failed to format partition %s. Unknown partition format %s" % (number, value['format']))
 
         logger.debug("cmd: %s", cmd)
         ret, output = run_cmd(cmd)
@@ -184,6 +215,7 @@ def show_partition_table(disk_path):
     logger.info(output)
 
 
+@trace_stage
 def prepare_rootfs(loop_device, project_directory, custom_root_directory,
         custom_disk_directory, kernel_version):
     """
@@ -201,18 +233,16 @@ def prepare_rootfs(loop_device, project_directory, custom_root_directory,
     make_directory(rootfs_directory)
 
     # mount the disk of partition 2
-    cmd = "mount %s %s" % (p2, rootfs_directory)
-    ret = subprocess.run(cmd, shell=True)
+    ret = get_operation("mount_device")(p2, rootfs_directory)
 
     # copy the rootfs from custom_root_directory to the rootfs_directory
     cmd = "rsync -a %s %s" % (custom_root_directory, rootfs_directory)
-    subprocess.run(cmd, shell=True)
+    call_cmd(cmd)
 
     # mount efi partition
     efi_path = os.path.join(boot_directory, "efi")
     make_directories(efi_path)
-    cmd = "mount %s %s" % (p1, efi_path)
-    subprocess.run(cmd, shell=True)
+    get_operation("mount_device")(p1, efi_path)
 
     # copy the kernel, efi and initrd
     #TODO: check if there is a new kernel and initrd installed.
@@ -229,9 +259,7 @@ def prepare_rootfs(loop_device, project_directory, custom_root_directory,
 
 def cleanup_loop_device(loop_device):
     logger.info("Unmount loop device %s", loop_device)
-    cmd = "losetup -d %s" % loop_device
-    logger.debug("cmd: %s", cmd)
-    subprocess.run(cmd, shell=True)
+    get_operation("detach_loop")(loop_device)
 
 
 def cleanup(loop_device, project_directory):
@@ -11,28 +11,62 @@ create_iso_image()
 import os
 import subprocess
 
-from utilities.util import run_cmd, get_rootfs_size_bytes, calculate_checksums
+from utilities.util import run_cmd, call_cmd, get_rootfs_size_bytes, calculate_checksums
 from utilities.logger import create_logger
+from utilities.telemetry import trace_stage, trace_command
 from utilities.kernel import get_kernel_initrd, update_boot_configuration
 from utilities.file_ops import copy_to
 from utilities.iso import get_iso_report, generate_iso_template
+from utilities.squashfs import open_image, write_squashfs, can_write
+from utilities.bmap import create_bmap
+from utilities.errors import check_return_code
+from utilities.constant import SQUASHFS_COMPRESSION
+from utilities.boot_order import get_boot_trace_path, create_sort_file, SORT_FILE_NAME
 
 logger = create_logger(__name__)
 
+# files which are not in filesystem.squashfs, mksquashfs -wildcards patterns
+SQUASHFS_EXCLUDES = [
+    'proc/*',
+    'proc/.*',
+    'run/*',
+    'run/.*',
+    'tmp/*',
+    'tmp/.*',
+    'var/crash/*',
+    'var/crash/.*',
+    'swapfile',
+    'root/.bash_history',
+    'root/.cache',
+    'root/.wget-hsts',
+    'home/*/.bash_history',
+    'home/*/.cache',
+    'home/*/.wget-hsts',
+]
+
+@trace_stage
 def do_iso_image(project_directory, iso_file_path, output_iso_path,
-        custom_root_directory, custom_disk_directory, kernel_version):
+        custom_root_directory, custom_disk_directory, kernel_version, boot_trace=None,
+        compression=SQUASHFS_COMPRESSION, snapshot=None):
     """
-    Wrapper steps to create iso image
+    Wrapper steps to create iso image. With the snapshot of custom-root
+    taken after the extraction, the squashfs reuses the blocks of the
+    unchanged files of iso_file_path.
     """
     prepare_kernel(custom_root_directory, custom_disk_directory, kernel_version)
     update_boot_configuration(custom_disk_directory)
-    create_squashfs(custom_root_directory, custom_disk_directory)
+    sort_file = prepare_sort_file(project_directory, custom_root_directory, boot_trace)
+    check_return_code(create_squashfs(custom_root_directory, custom_disk_directory, sort_file,
+            compression, iso_file_path if snapshot is not None else None, snapshot), "mksquashfs")
     update_filesystem_size(custom_root_directory, custom_disk_directory)
     update_checksums(custom_disk_directory)
-    create_iso_image(project_directory, custom_disk_directory, iso_file_path, output_iso_path)
+    check_return_code(create_iso_image(project_directory, custom_disk_directory, iso_file_path,
+            output_iso_path), "xorriso")
     calculate_checksums(output_iso_path)
+    create_bmap(output_iso_path)
 
 
+@trace_stage
 def prepare_kernel(custom_root_directory, custom_disk_directory, kernel_version):
     """
     If new kernel is installed then
@@ -58,43 +92,110 @@ def prepare_kernel(custom_root_directory, custom_disk_directory, kernel_version)
         copy_to(kernel_path['initrd'], target_initrd_path)
 
 
-def create_squashfs(custom_root_directory, custom_disk_directory):
+@trace_stage
+def prepare_sort_file(project_directory, custom_root_directory, boot_trace):
+    """
+    Create the squashfs sort file from the boot trace.
+    Return path to the sort file or None if there is no boot trace.
+    """
+    if not boot_trace:
+        return None
+
+    trace_path = get_boot_trace_path(boot_trace)
+    if not trace_path:
+        logger.warning("Boot trace %s is not found. Files are not sorted", boot_trace)
+        return None
+
+    sort_file = os.path.join(project_directory, SORT_FILE_NAME)
+    if not create_sort_file(custom_root_directory, trace_path, sort_file):
+        return None
+
+    return sort_file
+
+
+def read_sort_file(sort_file):
+    """
+    Return dictionary of the relative path to the priority of a mksquashfs sort file
+    """
+    priorities = {}
+    if not sort_file:
+        return priorities
+    with open(sort_file, 'r') as f:
+        for line in f:
+            path, _, priority = line.strip().rpartition(' ')
+            if path and priority.lstrip('-').isdigit():
+                priorities[path] = int(priority)
+    return priorities
+
+
+def write_reused_squashfs(custom_root_directory, target_path, sort_file, compression, base_image,
+        snapshot):
+    """
+    Create filesystem.squashfs in process, copying the compressed blocks of
+    the unchanged files from filesystem.squashfs of the base ISO.
+    Return True if it is created, else mksquashfs creates it.
+    """
+    if not can_write(compression):
+        logger.warning("%s cannot be written in process, the base image blocks are not reused",
+                compression)
+        return False
+
+    try:
+        with open_image(base_image) as base:
+            if base.compression != compression:
+                logger.warning("The base image is %s compressed, its blocks are not reused for %s",
+                        base.compression, compression)
+                return False
+            write_squashfs(custom_root_directory, target_path, compression, SQUASHFS_EXCLUDES,
+                    base, snapshot, read_sort_file(sort_file))
+    except (OSError, ValueError) as exception:
+        logger.warning("Cannot reuse the blocks of the base image: %s", exception)
+        return False
+    return True
+
+
+@trace_stage
+def create_squashfs(custom_root_directory, custom_disk_directory, sort_file=None,
+        compression=SQUASHFS_COMPRESSION, base_image=None, snapshot=None):
+    """
+    Compress the rootfs with mksquashfs. With base_image, the path of the
+    base ISO, the compressed blocks of the files unchanged since the
+    extraction are copied from its squashfs instead.
+    Return: return code
+    """
     logger.info("Compress the Linux file system")
     logger.info("Source path is %s", custom_root_directory)
 
     target_path = os.path.join(custom_disk_directory, 'casper', 'filesystem.squashfs')
     logger.info("Target path is %s", target_path)
 
+    if base_image and write_reused_squashfs(custom_root_directory, target_path, sort_file,
+            compression, base_image, snapshot):
+        return 0
+
     # create filesystem.squashfs
-    compression = "gzip"
     cmd = (
             "mksquashfs {source_path} {target_path}"
             " -noappend"
             " -comp {compression}"
             " -wildcards"
-            " -e 'proc/*'"
-            " -e 'proc/.*'"
-            " -e 'run/*'"
-            " -e 'run/.*'"
-            " -e 'tmp/*'"
-            " -e 'tmp/.*'"
-            " -e 'var/crash/*'"
-            " -e 'var/crash/.*'"
-            " -e 'swapfile'"
-            " -e 'root/.bash_history'"
-            " -e 'root/.cache'"
-            " -e 'root/.wget-hsts'"
-            " -e 'home/*/.bash_history'"
-            " -e 'home/*/.cache'"
-            " -e 'home/*/.wget-hsts'"
         ).format(
             source_path=custom_root_directory,
             target_path=target_path,
             compression=compression
         )
-    run_cmd(cmd)
+    cmd += ''.join(" -e '%s'" % pattern for pattern in SQUASHFS_EXCLUDES)
+    if sort_file:
+        # place the files read during boot at the beginning
+        cmd += " -sort %s" % sort_file
+    logger.debug("cmd: %s", cmd)
+    ret, output = run_cmd(cmd)
+    if ret:
+        logger.error("mksquashfs failed, ret: %s\n%s", ret, output)
+    return ret
 
 
+@trace_stage
 def update_filesystem_size(custom_root_directory, custom_disk_directory):
     """
     Calculate the filesystem size and write to filesystem.size.
@@ -106,12 +207,14 @@ def update_filesystem_size(custom_root_directory, custom_disk_directory):
         f.write("%s" % filesystem_size)
 
 
+@trace_stage
 def update_checksums(custom_disk_directory):
     logger.info("Update checksums")
     checksums_file_path = os.path.join(custom_disk_directory, "md5sum.txt")
-    cmd = "find %s -type f -print0 | sudo xargs -0 md5sum | grep -v %s/isolinux/boot.cat" % (custom_disk_directory, custom_disk_directory)
+    cmd = "find %s -type f -print0 | xargs -0 md5sum | grep -v %s/isolinux/boot.cat" % (custom_disk_directory, custom_disk_directory)
 
-    output = subprocess.check_output(cmd, shell=True).decode("utf-8")
+    with trace_command(cmd, "md5sum"):
+        output = subprocess.check_output(cmd, shell=True).decode("utf-8")
     new_output = output.replace(custom_disk_directory, '.')
 
     #TODO: need to use relative path instead of absolute path
@@ -119,6 +222,7 @@ def update_checksums(custom_disk_directory):
         f.write(new_output)
 
 
+@trace_stage
 def create_iso_image(project_directory, custom_disk_directory, iso_file_path, output_iso_path):
     logger.info("Create disk image")
     iso_report = get_iso_report(iso_file_path)
@@ -139,5 +243,7 @@ def create_iso_image(project_directory, custom_disk_directory, iso_file_path, ou
             custom_disk_directory=custom_disk_directory
         )
     logger.debug("cmd: %s", cmd)
-    subprocess.run(cmd, shell=True)
-    #run_cmd(cmd)
+    ret = call_cmd(cmd)
+    if ret:
+        logger.error("xorriso failed, ret: %s", ret)
+    return ret
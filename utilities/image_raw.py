@@ -0,0 +1,347 @@
+"""
+Create a raw disk image without root privilege.
+No loop device, mount or parted is needed. Each partition is built
+into its own file and spliced into the final image.
+Start with do_raw_image() as entry point.
+
+mkfs.ext4 -d copies the owners of the files as it sees them, so it runs
+with the run_rootfs_cmd operation of the backend: as the build user on the
+host, or in a user namespace with the id mapping of the userns container.
+
+write_gpt() - write protective MBR and GPT headers in Python
+create_rootfs_partition() - populate ext4 with mkfs.ext4 -d
+install_efi_loader() - the signed shim and grub of the rootfs or the ISO for the ESP
+create_efi_partition() - create vfat ESP with mtools
+splice_partition() - copy partition file into the image with copy_file_range
+"""
+
+import os
+import shutil
+import struct
+import uuid
+import zlib
+
+from utilities.logger import create_logger
+from utilities.errors import BuildError
+from utilities.telemetry import trace_stage
+from utilities.backend import get_operation
+from utilities.file_ops import delete_directory
+from utilities.image import get_image_size, get_partitions_details, create_sparse_image
+from utilities.kernel import select_kernel_initrd
+from utilities.constant import IMAGE_HEADROOM
+from utilities.util import run_cmd, calculate_checksums
+from utilities.bmap import create_bmap
+
+logger = create_logger(__name__)
+
+SECTOR_SIZE = 512
+MB = 1024 * 1024
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+# sectors used by the partition entries array
+GPT_ENTRIES_SECTORS = GPT_ENTRIES * GPT_ENTRY_SIZE // SECTOR_SIZE
+ROOTFS_LABEL = "rootfs"
+# file in EFI/BOOT of the ESP to the candidates in the rootfs, then in the ISO
+EFI_LOADER_FILES = {
+    "BOOTX64.EFI": (["usr/lib/shim/shimx64.efi.signed.latest", "usr/lib/shim/shimx64.efi.signed"],
+            ["EFI/boot/bootx64.efi"]),
+    "grubx64.efi": (["usr/lib/grub/x86_64-efi-signed/grubx64.efi.signed"],
+            ["EFI/boot/grubx64.efi"]),
+    "mmx64.efi": (["usr/lib/shim/mmx64.efi"], ["EFI/boot/mmx64.efi"]),
+}
+# the signed grub reads grub.cfg of its prefix EFI/ubuntu, else of its own directory
+EFI_GRUB_DIRECTORIES = ["EFI/ubuntu", "EFI/BOOT"]
+EFI_GRUB_CONFIG = """search --no-floppy --label {label} --set=root
+set prefix=($root)/boot/grub
+if [ -e $prefix/grub.cfg ]; then
+    configfile $prefix/grub.cfg
+fi
+linux /boot/vmlinuz root=LABEL={label} ro quiet splash
+initrd /boot/initrd.img
+boot
+"""
+
+PARTITION_TYPES = {
+    "vfat": uuid.UUID("C12A7328-F81F-11D2-BA4B-00A0C93EC93B"),
+    "ext4": uuid.UUID("0FC63DAF-8483-4772-8E79-3D69D8477DE4"),
+    "swap": uuid.UUID("0657FD6D-A4AB-43C4-84E5-0933C84B4F4F"),
+}
+
+
+@trace_stage
+def do_raw_image(project_directory, output_image_path, custom_root_directory,
+        custom_disk_directory, kernel_version, image_headroom=IMAGE_HEADROOM):
+    """
+    Wrapper steps to create raw disk image as normal user
+    """
+    image_size = get_image_size(custom_root_directory, image_headroom)
+    partitions = get_partitions_details(image_size)
+    partitions_directory = os.path.join(project_directory, "partitions")
+    os.makedirs(partitions_directory, exist_ok=True)
+
+    # select kernel and initrd based on config.json and create symlink
+    boot_directory = os.path.join(custom_root_directory, "boot")
+    if os.path.isdir(boot_directory):
+        select_kernel_initrd(boot_directory, kernel_version)
+
+    create_sparse_image(output_image_path, image_size)
+    write_gpt(output_image_path, partitions)
+
+    for name, partition in partitions.items():
+        partition_path = os.path.join(partitions_directory, "%s.img" % name)
+        size = (partition['end'] - partition['start']) * MB
+
+        if partition['format'] == 'vfat':
+            efi_directory = os.path.join(partitions_directory, "esp")
+            install_efi_loader(efi_directory, custom_root_directory, custom_disk_directory)
+            ret = create_efi_partition(partition_path, size, efi_directory)
+        elif partition['format'] == 'ext4':
+            ret = create_rootfs_partition(partition_path, size, custom_root_directory)
+        elif partition['format'] == 'swap':
+            ret = create_swap_partition(partition_path, size)
+        else:
+            logger.error("Unknown partition format %s", partition['format'])
+            ret = 1
+
+        if ret:
+            raise BuildError("Failed to create %s partition" % name)
+
+        splice_partition(partition_path, output_image_path, partition['start'] * MB)
+        os.remove(partition_path)
+
+    delete_directory(partitions_directory)
+    calculate_checksums(output_image_path)
+    create_bmap(output_image_path)
+
+
+def get_gpt_entries(partitions):
+    """
+    Return the partition entries array of the GPT
+    """
+    entries = b''
+    for name, partition in partitions.items():
+        type_guid = PARTITION_TYPES[partition['format']]
+        first_lba = partition['start'] * MB // SECTOR_SIZE
+        last_lba = partition['end'] * MB // SECTOR_SIZE - 1
+        # bit 2 is legacy BIOS bootable
+        attributes = 1 << 2 if 'flag' in partition and 'boot' in partition['flag'] else 0
+        entries += struct.pack('<16s16sQQQ72s', type_guid.bytes_le, uuid.uuid4().bytes_le,
+                first_lba, last_lba, attributes, name.encode('utf-16-le'))
+
+    return entries.ljust(GPT_ENTRIES * GPT_ENTRY_SIZE, b'\0')
+
+
+def get_gpt_header(current_lba, backup_lba, entries_lba, last_usable_lba,
+        disk_guid, entries_crc):
+    """
+    Return one GPT header of 512 bytes
+    """
+    first_usable_lba = 2 + GPT_ENTRIES_SECTORS
+    fields = [b'EFI PART', 0x00010000, 92, 0, 0, current_lba, backup_lba,
+            first_usable_lba, last_usable_lba, disk_guid.bytes_le, entries_lba,
+            GPT_ENTRIES, GPT_ENTRY_SIZE, entries_crc]
+    layout = '<8sIIIIQQQQ16sQIII'
+    header = struct.pack(layout, *fields)
+    fields[3] = zlib.crc32(header)
+    header = struct.pack(layout, *fields)
+    return header.ljust(SECTOR_SIZE, b'\0')
+
+
+def get_protective_mbr(total_sectors):
+    """
+    Return the protective MBR covering the whole disk
+    """
+    size = min(total_sectors - 1, 0xFFFFFFFF)
+    entry = struct.pack('<B3sB3sII', 0, b'\x00\x02\x00', 0xEE, b'\xff\xff\xff', 1, size)
+    mbr = bytearray(SECTOR_SIZE)
+    mbr[446:446 + len(entry)] = entry
+    mbr[510:512] = b'\x55\xaa'
+    return bytes(mbr)
+
+
+def write_gpt(disk_path, partitions):
+    """
+    Write the protective MBR, primary and backup GPT to disk_path
+    """
+    logger.info("Write GPT partition table to %s", disk_path)
+    total_sectors = os.path.getsize(disk_path) // SECTOR_SIZE
+    last_lba = total_sectors - 1
+    backup_entries_lba = last_lba - GPT_ENTRIES_SECTORS
+    last_usable_lba = backup_entries_lba - 1
+
+    disk_guid = uuid.uuid4()
+    entries = get_gpt_entries(partitions)
+    entries_crc = zlib.crc32(entries)
+
+    primary = get_gpt_header(1, last_lba, 2, last_usable_lba, disk_guid, entries_crc)
+    backup = get_gpt_header(last_lba, 1, backup_entries_lba, last_usable_lba, disk_guid, entries_crc)
+
+    fd = os.open(disk_path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, get_protective_mbr(total_sectors), 0)
+        os.pwrite(fd, primary, SECTOR_SIZE)
+        os.pwrite(fd, entries, 2 * SECTOR_SIZE)
+        os.pwrite(fd, entries, backup_entries_lba * SECTOR_SIZE)
+        os.pwrite(fd, backup, last_lba * SECTOR_SIZE)
+    finally:
+        os.close(fd)
+
+
+@trace_stage
+def create_rootfs_partition(partition_path, size, custom_root_directory):
+    """
+    Create ext4 file system in partition_path populated
+    from custom_root_directory
+    """
+    logger.info("Create ext4 partition %s from %s", partition_path, custom_root_directory)
+    create_sparse_file(partition_path, size)
+    cmd = "mkfs.ext4 -q -F -L %s -d %s %s" % (ROOTFS_LABEL, custom_root_directory, partition_path)
+    return get_operation("run_rootfs_cmd")(cmd)
+
+
+def find_efi_file(candidates):
+    for root, paths in candidates:
+        for path in paths:
+            file_path = os.path.join(root, path)
+            if os.path.isfile(file_path):
+                return file_path
+    return None
+
+
+def install_efi_loader(efi_directory, custom_root_directory, custom_disk_directory):
+    """
+    Fill efi_directory with the content of boot/efi of the rootfs, and
+    the removable media path EFI/BOOT with the signed shim and grub of the
+    rootfs, or of the ISO if they are not installed, and a grub.cfg
+    booting the rootfs partition
+    """
+    if os.path.isdir(efi_directory):
+        delete_directory(efi_directory)
+    rootfs_efi_directory = os.path.join(custom_root_directory, "boot", "efi")
+    if os.path.isdir(rootfs_efi_directory):
+        shutil.copytree(rootfs_efi_directory, efi_directory, symlinks=False)
+
+    boot_directory = os.path.join(efi_directory, "EFI", "BOOT")
+    os.makedirs(boot_directory, exist_ok=True)
+    for name, (rootfs_paths, disk_paths) in EFI_LOADER_FILES.items():
+        target_path = os.path.join(boot_directory, name)
+        if os.path.exists(target_path):
+            continue
+        source_path = find_efi_file([(custom_root_directory, rootfs_paths),
+                (custom_disk_directory, disk_paths)])
+        if source_path:
+            logger.info("Install %s to the ESP as EFI/BOOT/%s", source_path, name)
+            shutil.copyfile(source_path, target_path)
+
+    if not os.path.isfile(os.path.join(boot_directory, "BOOTX64.EFI")):
+        raise BuildError("No EFI boot loader in the rootfs or %s" % custom_disk_directory)
+
+    for directory in EFI_GRUB_DIRECTORIES:
+        config_path = os.path.join(efi_directory, directory, "grub.cfg")
+        if os.path.exists(config_path):
+            continue
+        os.makedirs(os.path.dirname(config_path), exist_ok=True)
+        with open(config_path, 'w') as f:
+            f.write(EFI_GRUB_CONFIG.format(label=ROOTFS_LABEL))
+
+
+@trace_stage
+def create_efi_partition(partition_path, size, efi_directory):
+    """
+    Create vfat ESP in partition_path with the content
+    of efi_directory using mtools
+    """
+    logger.info("Create vfat partition %s", partition_path)
+    create_sparse_file(partition_path, size)
+    cmd = "mformat -i %s -F -v ESP ::" % partition_path
+    logger.debug("cmd: %s", cmd)
+    ret, output = run_cmd(cmd)
+    if ret:
+        logger.error(output)
+        return ret
+
+    if os.path.isdir(efi_directory) and os.listdir(efi_directory):
+        cmd = "mcopy -i %s -s -p -Q %s/* ::/" % (partition_path, efi_directory)
+        logger.debug("cmd: %s", cmd)
+        ret, output = run_cmd(cmd)
+        if ret:
+            logger.error(output)
+
+    return ret
+
+
+@trace_stage
+def create_swap_partition(partition_path, size):
+    logger.info("Create swap partition %s", partition_path)
+    create_sparse_file(partition_path, size)
+    cmd = "mkswap %s" % partition_path
+    logger.debug("cmd: %s", cmd)
+    ret, output = run_cmd(cmd)
+    if ret:
+        logger.error(output)
+    return ret
+
+
+def create_sparse_file(file_path, size):
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    with open(file_path, 'wb') as f:
+        f.truncate(size)
+
+
+def get_data_segments(fd, size):
+    """
+    Return list of (offset, length) of the allocated data in a sparse file
+    """
+    segments = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError:
+            # no more data after offset
+            break
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        segments.append((start, end - start))
+        offset = end
+
+    return segments
+
+
+@trace_stage
+def splice_partition(partition_path, disk_path, offset):
+    """
+    Copy the data segments of partition_path into disk_path at offset.
+    Holes are skipped so the disk image stays sparse.
+    """
+    logger.info("Splice %s into %s at offset %s", partition_path, disk_path, offset)
+    src = os.open(partition_path, os.O_RDONLY)
+    dst = os.open(disk_path, os.O_WRONLY)
+    try:
+        size = os.fstat(src).st_size
+        for start, length in get_data_segments(src, size):
+            copy_range(src, dst, start, offset + start, length)
+    finally:
+        os.close(src)
+        os.close(dst)
+
+
+def copy_range(src, dst, src_offset, dst_offset, length):
+    """
+    Copy length bytes with copy_file_range. Fall back to read and write
+    when the kernel or file system does not support it.
+    """
+    while length > 0:
+        try:
+            copied = os.copy_file_range(src, dst, length, src_offset, dst_offset)
+        except (AttributeError, OSError):
+            copied = 0
+        if copied <= 0:
+            data = os.pread(src, min(length, 4 * MB), src_offset)
+            if not data:
+                break
+            copied = os.pwrite(dst, data, dst_offset)
+
+        src_offset += copied
+        dst_offset += copied
+        length -= copied
@@ -0,0 +1,176 @@
+"""
+Single, cached initramfs generation. While the kernel overlay and the
+packages are installed update-initramfs is a no-op (see
+create_defer_initramfs_scripts), afterwards it runs once for the selected
+kernel in a second container.
+
+The initrd is cached in <cache>/initramfs by a key of the kernel release,
+the compressor, the module set (names, sizes and mtimes below
+lib/modules/<release>), the hooks and configuration of etc/initramfs-tools and
+usr/share/initramfs-tools, the module options of modprobe.d, etc/crypttab and
+the versions of the packages shipping them, so an identical rebuild copies the
+cached initrd instead of running update-initramfs.
+
+set_initramfs_compression() - COMPRESS of the initramfs in the rootfs
+get_initramfs_key() - cache key of the initramfs of a kernel
+generate_initramfs() - the initrd of the selected kernel, from the cache if possible
+"""
+
+import hashlib
+import os
+import shutil
+
+from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
+from utilities.errors import BuildError, check_return_code
+from utilities.constant import INITRD, SCRIPT_INITRAMFS
+from utilities.apt import get_installed_packages
+from utilities.dpkg import get_dpkg_directory
+from utilities.kernel_index import index_directory, find_kernel
+from utilities.container import create_virtual_environment
+from utilities.create_scripts import create_initramfs_script
+
+logger = create_logger(__name__)
+
+INITRAMFS_CACHE_DIRECTORY = "initramfs"
+COMPRESSION_CONFIG = os.path.join("etc", "initramfs-tools", "conf.d", "compress")
+# directories of the hooks, scripts and configuration of initramfs-tools
+INITRAMFS_DIRECTORIES = [os.path.join("etc", "initramfs-tools"),
+        os.path.join("usr", "share", "initramfs-tools")]
+# configuration copied into the initramfs by the hooks of initramfs-tools and cryptsetup
+INITRAMFS_CONFIG_PATHS = [os.path.join("etc", "modprobe.d"), os.path.join("usr", "lib", "modprobe.d"),
+        os.path.join("etc", "crypttab")]
+# packages whose files are copied into every initramfs
+INITRAMFS_PACKAGES = ["initramfs-tools", "initramfs-tools-core", "initramfs-tools-bin",
+        "busybox-initramfs", "klibc-utils", "udev", "linux-firmware"]
+CHUNK_SIZE = 1024 * 1024
+
+
+def set_initramfs_compression(custom_root_directory, compression):
+    """
+    Write COMPRESS to etc/initramfs-tools/conf.d/compress of the rootfs,
+    it is kept in the image for the later kernel updates
+    """
+    if not compression:
+        return
+    logger.info("initramfs compression: %s", compression)
+    config_path = os.path.join(custom_root_directory, COMPRESSION_CONFIG)
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    with open(config_path, 'w') as f:
+        f.write("COMPRESS=%s\n" % compression)
+
+
+def update_file_digest(digest, file_path):
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+
+def update_path_digest(digest, file_path, relative_path, with_contents):
+    if os.path.islink(file_path):
+        digest.update(("%s -> %s\n" % (relative_path, os.readlink(file_path))).encode('utf-8'))
+    elif with_contents:
+        digest.update(("%s\n" % relative_path).encode('utf-8'))
+        update_file_digest(digest, file_path)
+    else:
+        file_stat = os.stat(file_path)
+        digest.update(("%s %d %d\n" % (relative_path, file_stat.st_size,
+                file_stat.st_mtime_ns)).encode('utf-8'))
+
+
+def update_tree_digest(digest, root, with_contents):
+    """
+    Add the paths below root, or the file root, to digest, with their
+    contents or their sizes and mtimes
+    """
+    if os.path.isfile(root):
+        update_path_digest(digest, root, os.path.basename(root), with_contents)
+        return
+    for directory, directories, files in os.walk(root):
+        directories.sort()
+        for name in sorted(files):
+            file_path = os.path.join(directory, name)
+            update_path_digest(digest, file_path, os.path.relpath(file_path, root), with_contents)
+
+
+def get_hook_packages(custom_root_directory):
+    """
+    Return the names of the packages with files in the initramfs-tools directories
+    """
+    prefixes = tuple('/%s/' % directory for directory in INITRAMFS_DIRECTORIES)
+    info_directory = os.path.join(get_dpkg_directory(custom_root_directory), 'info')
+    packages = set()
+    if not os.path.isdir(info_directory):
+        return packages
+
+    for name in os.listdir(info_directory):
+        if not name.endswith('.list'):
+            continue
+        with open(os.path.join(info_directory, name), 'r', errors='replace') as f:
+            if any(line.startswith(prefixes) for line in f):
+                packages.add(name[:-len('.list')].split(':')[0])
+    return packages
+
+
+def get_initramfs_key(custom_root_directory, kernel_entry, compression):
+    """
+    Return the cache key of the initramfs of the kernel entry of kernel_index
+    """
+    digest = hashlib.sha256()
+    digest.update(("%s\n%s\n" % (kernel_entry['version'], compression)).encode('utf-8'))
+
+    if kernel_entry['modules']:
+        update_tree_digest(digest, kernel_entry['modules'], with_contents=False)
+    for path in INITRAMFS_DIRECTORIES + INITRAMFS_CONFIG_PATHS:
+        digest.update(("%s\n" % path).encode('utf-8'))
+        update_tree_digest(digest, os.path.join(custom_root_directory, path), with_contents=True)
+
+    installed = get_installed_packages(custom_root_directory)
+    for package in sorted(set(INITRAMFS_PACKAGES) | get_hook_packages(custom_root_directory)):
+        if package in installed:
+            digest.update(("%s %s\n" % (package, installed[package].get('Version'))).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+@trace_stage
+def generate_initramfs(custom_root_directory, kernel_version, compression=None, cache_directory=None):
+    """
+    Generate boot/initrd.img-<release> of kernel_version in the rootfs, or
+    copy it from the cache. The initramfs of all the kernels is updated if
+    kernel_version is not installed in the rootfs.
+    """
+    entries = index_directory(os.path.join(custom_root_directory, 'boot'), custom_root_directory)
+    entry = find_kernel(entries, kernel_version)
+    if not entry:
+        logger.warning("Kernel %s is not installed in the rootfs, update the initramfs of all kernels",
+                kernel_version)
+        create_initramfs_script(os.path.dirname(custom_root_directory), None)
+        check_return_code(create_virtual_environment(custom_root_directory,
+                script_name=SCRIPT_INITRAMFS), "update-initramfs")
+        return None
+
+    version = entry['version']
+    initrd_path = os.path.join(custom_root_directory, 'boot', "%s.img-%s" % (INITRD, version))
+    cached_path = None
+    if cache_directory:
+        key = get_initramfs_key(custom_root_directory, entry, compression)
+        cached_path = os.path.join(cache_directory, INITRAMFS_CACHE_DIRECTORY, key)
+        if os.path.isfile(cached_path):
+            logger.info("Reuse the cached initramfs %s of %s", key[:16], version)
+            shutil.copy2(cached_path, initrd_path + '.tmp')
+            os.replace(initrd_path + '.tmp', initrd_path)
+            return initrd_path
+
+    logger.info("Generate the initramfs of %s", version)
+    create_initramfs_script(os.path.dirname(custom_root_directory), version)
+    check_return_code(create_virtual_environment(custom_root_directory,
+            script_name=SCRIPT_INITRAMFS), "update-initramfs")
+    if not os.path.isfile(initrd_path):
+        raise BuildError("update-initramfs did not generate %s" % initrd_path)
+
+    if cached_path:
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        shutil.copy2(initrd_path, cached_path + '.tmp')
+        os.replace(cached_path + '.tmp', cached_path)
+    return initrd_path
@@ -0,0 +1,164 @@
+"""
+Inspect a base image without mounting or extracting it. filesystem.squashfs
+of the ISO (or a bare squashfs) is read in process, only the inodes and
+blocks of the asked paths are decompressed.
+
+get_image_kernels() - kernels of boot/ with their initrd and modules
+get_image_packages() - package index of var/lib/dpkg/status
+get_rootfs_size() - disk usage of the rootfs as in casper/filesystem.size
+inspect_image() - the inspect command: info, ls, cat, extract, kernels, packages
+"""
+
+import os
+import stat
+import sys
+import time
+
+from utilities.logger import create_logger
+from utilities.constant import VMLINUZ, INITRD
+from utilities.dpkg import DPKG_DIRECTORY, iter_deb822, index_packages, is_installed
+from utilities.kernel_index import get_version_suffix
+from utilities.squashfs import open_image
+
+logger = create_logger(__name__)
+
+INSPECT_ACTIONS = ["info", "ls", "cat", "extract", "kernels", "packages"]
+DPKG_STATUS = os.path.join(DPKG_DIRECTORY, 'status')
+DPKG_ARCH = os.path.join(DPKG_DIRECTORY, 'arch')
+MODULES_DIRECTORIES = ["lib/modules", "usr/lib/modules"]
+# allocation unit of the rootfs files in filesystem.size
+FILESYSTEM_BLOCK_SIZE = 4096
+
+
+def get_image_kernels(image):
+    """
+    Return list of {'version', 'vmlinuz', 'initrd', 'modules'} of the kernels in boot/ of the image
+    """
+    boot = image.lookup('boot')
+    if boot is None or not boot.is_directory():
+        return []
+    names = [name for name, inode in image.list_directory('boot') if not inode.is_symlink()]
+
+    entries = []
+    for name in sorted(names):
+        version = get_version_suffix(name, VMLINUZ)
+        if not version:
+            continue
+        entry = {"version": version, "vmlinuz": "/boot/" + name, "initrd": None, "modules": None}
+        for initrd in names:
+            if get_version_suffix(initrd, INITRD) == version:
+                entry['initrd'] = "/boot/" + initrd
+        for directory in MODULES_DIRECTORIES:
+            modules = image.lookup("%s/%s" % (directory, version))
+            if modules is not None and modules.is_directory():
+                entry['modules'] = "/%s/%s" % (directory, version)
+                break
+        entries.append(entry)
+    return entries
+
+
+def get_image_packages(image):
+    """
+    Return the package index of var/lib/dpkg/status of the image, see
+    dpkg.get_package_index(). The packages of which only the configuration
+    files are kept are in it, see dpkg.is_installed().
+    """
+    if image.lookup(DPKG_STATUS) is None:
+        return {}
+    lines = image.read_file(DPKG_STATUS).decode('utf-8', 'replace').splitlines()
+
+    native_architecture = None
+    if image.lookup(DPKG_ARCH) is not None:
+        arch_lines = image.read_file(DPKG_ARCH).decode('utf-8', 'replace').split()
+        native_architecture = arch_lines[0] if arch_lines else None
+    return index_packages(iter_deb822(lines), native_architecture)
+
+
+def get_rootfs_size(image):
+    """
+    Return the disk usage in bytes of the extracted rootfs, hard links counted once
+    """
+    size = 0
+    numbers = set()
+    for path, inode in image.walk():
+        if inode.number in numbers:
+            continue
+        numbers.add(inode.number)
+        blocks = -(-inode.size // FILESYSTEM_BLOCK_SIZE) if inode.is_file() else 1
+        size += blocks * FILESYSTEM_BLOCK_SIZE
+    return size
+
+
+def format_inode(name, inode):
+    mode = stat.filemode(inode.get_file_mode())
+    mtime = time.strftime('%Y-%m-%d %H:%M', time.gmtime(inode.mtime))
+    line = "%s %5d %5d %10d %s %s" % (mode, inode.uid, inode.gid, inode.size, mtime, name)
+    if inode.is_symlink():
+        line += " -> %s" % os.fsdecode(inode.target)
+    return line
+
+
+def show(line):
+    """
+    Output of the actions except cat, through the logger as the build plan
+    """
+    logger.info("%s", line)
+
+
+def show_info(image, image_path):
+    show("image: %s" % image_path)
+    show("offset: %d" % image.offset)
+    show("compression: %s" % image.compression)
+    show("block size: %d" % image.block_size)
+    show("inodes: %d" % image.inode_count)
+    show("fragments: %d" % image.fragment_count)
+    show("bytes used: %d" % image.bytes_used)
+    show("created: %s" % time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(image.mtime)))
+    show("key: %s" % image.get_key())
+
+
+def inspect_image(image_path, action, paths=(), output_directory=None):
+    """
+    Run an inspect action on an ISO or squashfs image. cat writes the
+    files to stdout, the other actions show their output with the logger.
+    Return the exit code.
+    """
+    try:
+        with open_image(image_path) as image:
+            if action == "info":
+                show_info(image, image_path)
+            elif action == "ls":
+                for path in paths or ['/']:
+                    inode = image.get_inode(path, follow_symlinks=False)
+                    if not inode.is_directory():
+                        show(format_inode(path, inode))
+                        continue
+                    for name, child in image.list_directory(path):
+                        show(format_inode(name, child))
+            elif action == "cat":
+                for path in paths:
+                    inode = image.get_inode(path)
+                    if not inode.is_file():
+                        raise IsADirectoryError("%s is not a regular file" % path)
+                    for chunk in image.iter_file(inode):
+                        sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
+            elif action == "extract":
+                for path in paths:
+                    relative_path = os.path.normpath('/' + path).lstrip('/')
+                    target_path = os.path.join(output_directory or '.', relative_path or '.')
+                    os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+                    count = image.extract(path, target_path)
+                    logger.info("Extracted %d inodes of %s to %s", count, path, target_path)
+            elif action == "kernels":
+                for entry in get_image_kernels(image):
+                    show("%s %s initrd=%s modules=%s" % (entry['version'], entry['vmlinuz'],
+                            entry['initrd'], entry['modules']))
+            elif action == "packages":
+                for name, package in sorted(get_image_packages(image).items()):
+                    if is_installed(package):
+                        show("%s\t%s" % (name, package['version']))
+    except (OSError, ValueError) as exception:
+        logger.error("%s", exception)
+        return 1
+    return 0
@@ -2,34 +2,25 @@
 
 import os
 import re
-import subprocess
 import zlib
 
 from utilities.logger import create_logger
 from utilities.file_ops import make_directory, delete_directory
 from utilities.util import run_cmd
+from utilities.backend import get_operation
 
 logger = create_logger(__name__)
 
 def mount(iso_file_path, iso_mount_point):
     """
-    Mount the iso file to the mount point
+    Mount the iso file to the mount point.
+    See utilities/backend.py for how the mount is done.
     """
     if os.path.exists(iso_file_path):
         make_directory(iso_mount_point)
-        user_id = 1000
-        group_id = 1000
-        cmd = ("mount --options loop,uid={user_id},gid={group_id} {iso_file_path} {iso_mount_point}").format(
-            user_id=user_id,
-            group_id=group_id,
-            iso_file_path=iso_file_path,
-            iso_mount_point=iso_mount_point
-                )
         #program = '/usr/share/cubic/commands/mount-iso'
         #cmd = 'pkexec "%s" "%s" "%s" "%s" "%s"' % (program, iso_file_path, iso_mount_point, user_id, group_id)
-        logger.debug(cmd)
-        ret = subprocess.run(cmd, shell=True)
-        ret = ret.returncode
+        ret = get_operation("mount_iso")(iso_file_path, iso_mount_point)
     else:
         logger.error("File %s is not exists", iso_file_path)
         ret = 1
@@ -40,11 +31,7 @@ def unmount(iso_mount_point):
     """
     Unmount a mount point
     """
-    if os.path.ismount(iso_mount_point):
-        logger.info("Unmount %s", iso_mount_point)
-        cmd = "umount %s" % iso_mount_point
-        logger.debug("cmd: %s", cmd)
-        subprocess.run(cmd, shell=True)
+    return get_operation("unmount")(iso_mount_point)
 
 
 def remove_mount_point(iso_mount_point):
@@ -297,3 +284,134 @@ def decode_iso(h):
     t = b.decode('utf-8')
 
     return t
+
+
+ISO_SECTOR_SIZE = 2048
+
+
+def get_rock_ridge_name(system_use):
+    """
+    Return the Rock Ridge name of the NM entries in the system use area
+    of a directory record, or None
+    """
+    name = b''
+    found = False
+    offset = 0
+    while offset + 4 <= len(system_use):
+        signature = system_use[offset:offset + 2]
+        length = system_use[offset + 2]
+        if length < 4:
+            break
+        if signature == b'NM':
+            found = True
+            # the flags byte follows the version, bit 0 is set when the name continues
+            name += system_use[offset + 5:offset + length]
+        elif signature == b'ST':
+            break
+        offset += length
+    return name.decode('utf-8', 'replace') if found and name else None
+
+
+def get_iso_directory_records(f, extent, size):
+    """
+    Yield (name, extent, size, flags) of the directory at extent.
+    The name is the Rock Ridge name if present, else the ISO 9660 name
+    without the version, in lower case. mkisofs and xorriso map e.g.
+    .disk to _DISK in the ISO 9660 name.
+    """
+    f.seek(extent * ISO_SECTOR_SIZE)
+    data = f.read(size)
+    offset = 0
+    while offset < len(data):
+        length = data[offset]
+        if length == 0:
+            # records do not cross the sector boundary
+            offset = (offset // ISO_SECTOR_SIZE + 1) * ISO_SECTOR_SIZE
+            continue
+
+        record = data[offset:offset + length]
+        record_extent = int.from_bytes(record[2:6], 'little')
+        record_size = int.from_bytes(record[10:14], 'little')
+        flags = record[25]
+        name_length = record[32]
+        name = record[33:33 + name_length]
+        if name not in (b'\x00', b'\x01'):
+            # the system use area follows the name, padded to an even offset
+            system_use = record[33 + name_length + (1 - name_length % 2):]
+            rock_ridge_name = get_rock_ridge_name(system_use)
+            if rock_ridge_name:
+                name = rock_ridge_name.lower()
+            else:
+                name = name.decode('ascii', 'replace').split(';')[0].rstrip('.').lower()
+            yield name, record_extent, record_size, flags
+        offset += length
+
+
+def find_iso_file(iso_file_path, file_path):
+    """
+    Find a file in the ISO without mounting it.
+    Return (offset, size) in bytes or None if not found.
+    Multi-extent files such as a large filesystem.squashfs are supported.
+    """
+    with open(iso_file_path, 'rb') as f:
+        f.seek(16 * ISO_SECTOR_SIZE)
+        descriptor = f.read(ISO_SECTOR_SIZE)
+        if descriptor[1:6] != b'CD001' or descriptor[0] != 1:
+            logger.error("%s is not an ISO 9660 image", iso_file_path)
+            return None
+
+        root = descriptor[156:156 + 34]
+        extent = int.from_bytes(root[2:6], 'little')
+        size = int.from_bytes(root[10:14], 'little')
+        names = [name.lower() for name in file_path.strip('/').split('/')]
+
+        for number, target in enumerate(names):
+            found = None
+            for name, record_extent, record_size, flags in get_iso_directory_records(f, extent, size):
+                if name != target:
+                    if found:
+                        break
+                    continue
+                if found:
+                    # next extent of a multi-extent file
+                    found = (found[0], found[1] + record_size, flags)
+                else:
+                    found = (record_extent, record_size, flags)
+                # bit 7 is set when more extents follow
+                if not flags & 0x80:
+                    break
+
+            if not found:
+                return None
+            extent, size, flags = found
+
+        return extent * ISO_SECTOR_SIZE, size
+
+
+def read_iso_file(iso_file_path, file_path, max_size=1024 * 1024):
+    """
+    Return the content of a small file in the ISO or None if not found
+    """
+    location = find_iso_file(iso_file_path, file_path)
+    if not location:
+        return None
+
+    offset, size = location
+    with open(iso_file_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(min(size, max_size))
+
+
+def list_iso_directory(iso_file_path, directory_path):
+    """
+    Return list of (name, is_directory) in a directory of the ISO or None if not found
+    """
+    location = find_iso_file(iso_file_path, directory_path)
+    if not location:
+        return None
+
+    offset, size = location
+    with open(iso_file_path, 'rb') as f:
+        # bit 1 of the flags is set for directories
+        return [(name, bool(flags & 0x02))
+                for name, extent, record_size, flags in get_iso_directory_records(f, offset // ISO_SECTOR_SIZE, size)]
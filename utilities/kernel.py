@@ -8,7 +8,6 @@ and set the grub.conf.
 """
 
 import os
-import subprocess
 import shutil
 import re
 
@@ -16,6 +15,7 @@ from utilities import logger
 from utilities.extract import get_casper_directory
 from utilities.constant import VMLINUZ, INITRD, SYMLINK_VMLINUZ, SYMLINK_INITRD
 from utilities.file_ops import get_directory_file_list, copy_to
+from utilities.kernel_index import get_kernel_index, index_directory, find_kernel
 
 logger = logger.create_logger(__name__)
 
@@ -66,24 +66,14 @@ def get_kernel_initrd(custom_disk_directory, custom_root_directory, kernel_versi
     Get selected kernel based on kernel_version
     and return path to vmlinuz and initrd
     """
-    # get a list of vmlinuz and initrd from boot_directory
-    boot_directory = os.path.join(custom_root_directory, 'boot')
-    vmlinuz_list = get_directory_file_list(VMLINUZ, boot_directory)
-    initrd_list = get_directory_file_list(INITRD, boot_directory)
-
-    kernel_path = {}
     vmlinuz_path = os.path.join(custom_disk_directory, 'casper', 'vmlinuz')
     initrd_path = os.path.join(custom_disk_directory, 'casper', 'initrd')
 
-    for vmlinuz in vmlinuz_list:
-        if kernel_version in vmlinuz:
-            vmlinuz_path = vmlinuz
-            break
-    
-    for initrd in initrd_list:
-        if kernel_version in initrd:
-            initrd_path = initrd
-            break
+    entries = get_kernel_index(custom_disk_directory, custom_root_directory)
+    entry = find_kernel(entries, kernel_version, 'rootfs')
+    if entry:
+        vmlinuz_path = entry['vmlinuz']
+        initrd_path = entry['initrd'] or initrd_path
 
     logger.info("Selected kernel %s", vmlinuz_path)
     logger.info("Select initrd %s", initrd_path)
@@ -98,35 +88,25 @@ def select_kernel_initrd(boot_directory, kernel_version):
     """
     Select kernel from boot directory as default kernel
     """
-    # get a list of kernel and initrd from boot directory and make a symlink
-    vmlinuz_list = get_directory_file_list(VMLINUZ, boot_directory)
-    initrd_list = get_directory_file_list(INITRD, boot_directory)
-
-    for vmlinuz in vmlinuz_list:
-        if kernel_version in vmlinuz:
-            logger.info("Select kernel %s", vmlinuz)
-            # create a symlink to vmlinuz
-            src = os.path.basename(vmlinuz)
-            dst = os.path.join(os.path.dirname(vmlinuz), SYMLINK_VMLINUZ)
-            logger.debug("src %s", src)
-            logger.debug("dst %s", dst)
-            #if os.path.exists(dst) and os.path.islink(dst):
-            if os.path.islink(dst):
-                logger.info("unlink %s", dst)
-                os.unlink(dst)
-            os.symlink(src, dst)
-
-    for initrd in initrd_list:
-        if kernel_version in initrd:
-            logger.info("Select initrd %s", initrd)
-            # create a symlink to initrd
-            src = os.path.basename(initrd)
-            dst = os.path.join(os.path.dirname(initrd), SYMLINK_INITRD)
-            logger.debug("src %s", src)
-            logger.debug("dst %s", dst)
-            if os.path.islink(dst):
-                os.unlink(dst)
-            os.symlink(src, dst)
+    # find the kernel and its initrd in boot directory and make a symlink
+    entry = find_kernel(index_directory(boot_directory), kernel_version)
+    if not entry:
+        logger.warning("Kernel %s is not found in %s", kernel_version, boot_directory)
+        return
+
+    links = [(entry['vmlinuz'], SYMLINK_VMLINUZ), (entry['initrd'], SYMLINK_INITRD)]
+    for path, link in links:
+        if not path:
+            continue
+        logger.info("Select %s", path)
+        src = os.path.basename(path)
+        dst = os.path.join(boot_directory, link)
+        logger.debug("src %s", src)
+        logger.debug("dst %s", dst)
+        if os.path.islink(dst):
+            logger.info("unlink %s", dst)
+            os.unlink(dst)
+        os.symlink(src, dst)
 
 
 def get_version_from_file_name(file_path):
@@ -136,50 +116,28 @@ def get_version_from_file_name(file_path):
     logger.info("Version %s", version)
 
 
-def get_version_from_file_type(file_path):
-    logger.info("Get version name from file type %s", file_path)
-    cmd = "file %s" % file_path
-    output = subprocess.check_output(cmd, shell=True).decode("utf-8")
-    version = None
-    version_info = re.search(r'(\d+\.\d+\.\d+(?:-\d+))', output)
-    if version_info:
-        version = version_info.group(1)
-        logger.info("Version %s", version)
-
-    return version
-
 def copy_kernel(custom_disk_directory, custom_root_directory, boot_directory):
-    kernel_list = get_vmlinuz_list(custom_disk_directory, custom_root_directory)
-    for kernel in kernel_list:
+    for entry in get_kernel_index(custom_disk_directory, custom_root_directory):
         # copy all kernel to boot directory
-        #TODO: rename the file with vmlinuz because there is a symlink with 'vmlinuz'
-        vmlinuz = os.path.basename(kernel)
-        if vmlinuz == VMLINUZ:
-            # rename the casper/vmlinuz to vmlinuz-<version>
-            version_name = get_version_from_file_type(kernel)
-            if version_name:
-                vmlinuz = vmlinuz + '-' + version_name
+        # casper/vmlinuz is renamed to vmlinuz-<version>, there is a symlink with 'vmlinuz'
+        vmlinuz = os.path.basename(entry['vmlinuz'])
+        if vmlinuz == VMLINUZ and entry['version']:
+            vmlinuz = vmlinuz + '-' + entry['version']
 
-        copy_to(kernel, os.path.join(boot_directory, vmlinuz))
+        copy_to(entry['vmlinuz'], os.path.join(boot_directory, vmlinuz))
 
 
 def copy_initrd(custom_disk_directory, custom_root_directory, boot_directory):
-    initrd_list = get_initrd_list(custom_disk_directory, custom_root_directory)
-    for initrd in initrd_list:
+    for entry in get_kernel_index(custom_disk_directory, custom_root_directory):
         # copy all initrd to boot directory
-        initrdimg = os.path.basename(initrd)
-        if initrdimg == INITRD:
-            # rename casper/initrd to initrd-<version>
-            #TODO: need to find a way to get the initrd version
-            version_name = get_version_from_file_type(initrd)
-            if version_name:
-                initrdimg = initrdimg + '-' + version_name
-            else:
-                # TODO: This is temporary use the readlink
-                initrdimg = os.readlink(os.path.join(boot_directory, 'initrd.img'))
-                
-
-        copy_to(initrd, os.path.join(boot_directory, initrdimg))
+        if not entry['initrd']:
+            continue
+        # casper/initrd is renamed to initrd.img-<version> of its vmlinuz
+        initrdimg = os.path.basename(entry['initrd'])
+        if initrdimg == INITRD and entry['version']:
+            initrdimg = SYMLINK_INITRD + '-' + entry['version']
+
+        copy_to(entry['initrd'], os.path.join(boot_directory, initrdimg))
 
 
 def update_boot_configuration(custom_disk_directory):
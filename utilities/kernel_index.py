@@ -0,0 +1,311 @@
+"""
+Index of the kernels of the rootfs and the casper directory, read
+natively without the file command.
+
+read_kernel_version() - version from the bzImage setup header, or the
+                        'Linux version' banner of other images
+read_initrd() - compression, early cpio archives and kernel version of an initrd
+get_kernel_index() - vmlinuz paired with its initrd and module directory
+"""
+
+import bz2
+import lzma
+import os
+import re
+import zlib
+
+from utilities.logger import create_logger
+from utilities.constant import VMLINUZ, INITRD
+
+logger = create_logger(__name__)
+
+try:
+    # Python 3.14
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+# bzImage setup header, see Documentation/arch/x86/boot.rst
+SETUP_HEADER_MAGIC = b'HdrS'
+SETUP_HEADER_MAGIC_OFFSET = 0x202
+KERNEL_VERSION_OFFSET = 0x20e
+SETUP_OFFSET = 0x200
+LINUX_BANNER = re.compile(rb'Linux version (\S+)')
+# bytes searched for the banner in an image without setup header
+BANNER_SEARCH_SIZE = 64 * 1024 * 1024
+
+CPIO_NEWC_MAGIC = (b'070701', b'070702')
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = 'TRAILER!!!'
+MODULES_PATTERN = re.compile(r'^(?:\./)?(?:usr/)?lib/modules/([^/]+)/')
+# magic numbers of the initramfs compressors
+INITRD_COMPRESSIONS = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x02\x21\x4c\x18', 'lz4'),
+    (b'\x89LZO', 'lzo'),
+    (b'BZh', 'bzip2'),
+    (b'\x5d\x00\x00', 'lzma'),
+]
+CHUNK_SIZE = 1024 * 1024
+
+
+def align(offset, alignment=4):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def read_kernel_version(file_path):
+    """
+    Return the kernel release of a vmlinuz, e.g. 5.15.0-76-generic, or None
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(SETUP_OFFSET + 0x100)
+        if header[SETUP_HEADER_MAGIC_OFFSET:SETUP_HEADER_MAGIC_OFFSET + 4] == SETUP_HEADER_MAGIC:
+            pointer = int.from_bytes(header[KERNEL_VERSION_OFFSET:KERNEL_VERSION_OFFSET + 2], 'little')
+            if pointer:
+                f.seek(pointer + SETUP_OFFSET)
+                version = f.read(256).split(b'\x00')[0].split()
+                if version:
+                    return version[0].decode('ascii', 'replace')
+
+        # other architectures, the image is searched for the banner
+        f.seek(0)
+        if header.startswith(b'\x1f\x8b'):
+            data = decompress_head(f, zlib.decompressobj(16 + zlib.MAX_WBITS), BANNER_SEARCH_SIZE)
+        else:
+            data = f.read(BANNER_SEARCH_SIZE)
+
+    match = LINUX_BANNER.search(data)
+    return match.group(1).decode('ascii', 'replace') if match else None
+
+
+def decompress_head(f, decompressor, size):
+    """
+    Return up to size bytes of the decompressed stream of f
+    """
+    data = b''
+    while len(data) < size:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        try:
+            data += decompressor.decompress(chunk)
+        except (zlib.error, lzma.LZMAError, OSError, EOFError):
+            break
+        if getattr(decompressor, 'eof', False):
+            break
+    return data[:size]
+
+
+def iter_cpio(read):
+    """
+    Yield (name, size) of the entries of a newc cpio archive until its trailer.
+    read(n) returns the next n bytes, the data of the entries is skipped.
+    """
+    offset = 0
+    while True:
+        header = read(CPIO_HEADER_SIZE)
+        if len(header) < CPIO_HEADER_SIZE or header[:6] not in CPIO_NEWC_MAGIC:
+            return
+        size = int(header[54:62], 16)
+        name_size = int(header[94:102], 16)
+        name_end = align(offset + CPIO_HEADER_SIZE + name_size)
+        name = read(name_end - offset - CPIO_HEADER_SIZE)[:name_size - 1].decode('utf-8', 'replace')
+        offset = name_end
+        data_end = align(offset + size)
+        read(data_end - offset)
+        offset = data_end
+        if name == CPIO_TRAILER:
+            return
+        yield name, size
+
+
+class StreamReader:
+    """
+    read(n) over a file, optionally through a decompressor
+    """
+    def __init__(self, f, decompressor=None):
+        self.f = f
+        self.decompressor = decompressor
+        self.buffer = b''
+        self.position = 0
+
+    def fill(self, size):
+        while len(self.buffer) < size:
+            chunk = self.f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if self.decompressor:
+                if getattr(self.decompressor, 'eof', False):
+                    break
+                chunk = self.decompressor.decompress(chunk)
+            self.buffer += chunk
+
+    def read(self, size):
+        self.fill(size)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+
+def get_decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression in ('xz', 'lzma'):
+        return lzma.LZMADecompressor()
+    if compression == 'bzip2':
+        return bz2.BZ2Decompressor()
+    if compression == 'zstd' and zstd:
+        return zstd.ZstdDecompressor()
+    return None
+
+
+def read_initrd(file_path, find_version=True):
+    """
+    Return dictionary of the initrd: 'compression' of the main archive,
+    'early' names of the uncompressed early archives such as microcode
+    and 'version' of the kernel of the modules, None if it cannot be read.
+    The main archive is decompressed to find the version only if find_version.
+    """
+    info = {"compression": None, "early": [], "version": None}
+    with open(file_path, 'rb') as f:
+        # early cpio archives such as the microcode, padded with zeros
+        offset = 0
+        while True:
+            f.seek(offset)
+            if f.read(6) not in CPIO_NEWC_MAGIC:
+                break
+            f.seek(offset)
+            reader = StreamReader(f)
+            for name, size in iter_cpio(reader.read):
+                info['early'].append(name)
+                match = MODULES_PATTERN.match(name)
+                if match and not info['version']:
+                    info['version'] = match.group(1)
+            offset = skip_padding(f, offset + reader.position)
+
+        f.seek(offset)
+        head = f.read(8)
+        if not head:
+            # an uncompressed initrd
+            return info
+        for magic, compression in INITRD_COMPRESSIONS:
+            if head.startswith(magic):
+                info['compression'] = compression
+                break
+
+        decompressor = get_decompressor(info['compression'])
+        if not decompressor or info['version'] or not find_version:
+            return info
+
+        f.seek(offset)
+        reader = StreamReader(f, decompressor)
+        try:
+            for name, size in iter_cpio(reader.read):
+                match = MODULES_PATTERN.match(name)
+                if match:
+                    info['version'] = match.group(1)
+                    break
+        except (zlib.error, lzma.LZMAError, OSError, EOFError, ValueError) as exception:
+            logger.warning("Cannot read %s: %s", file_path, exception)
+
+    return info
+
+
+def skip_padding(f, offset):
+    """
+    Return the offset of the first byte which is not zero from offset
+    """
+    f.seek(offset)
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        stripped = chunk.lstrip(b'\x00')
+        if stripped or not chunk:
+            return offset + len(chunk) - len(stripped)
+        offset += len(chunk)
+
+
+def get_version_suffix(file_path, prefix):
+    """
+    Return the version in the file name vmlinuz-<version> or initrd.img-<version>
+    """
+    name = os.path.basename(file_path)
+    for separator in ['-', '.img-']:
+        if name.startswith(prefix + separator):
+            return name[len(prefix + separator):]
+    return None
+
+
+def list_boot_files(directory, prefix):
+    """
+    Return the regular files of directory which start with prefix
+    """
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+            if name.startswith(prefix) and os.path.isfile(os.path.join(directory, name))
+            and not os.path.islink(os.path.join(directory, name)))
+
+
+def index_directory(directory, modules_root=None, source='rootfs'):
+    """
+    Return list of kernel entries of a boot or casper directory:
+    {'version', 'vmlinuz', 'initrd', 'compression', 'modules', 'source'}
+    """
+    initrds = []
+    for initrd in list_boot_files(directory, INITRD):
+        version = get_version_suffix(initrd, INITRD)
+        info = read_initrd(initrd, find_version=not version)
+        initrds.append((initrd, version or info['version'], info))
+
+    entries = []
+    for vmlinuz in list_boot_files(directory, VMLINUZ):
+        version = read_kernel_version(vmlinuz) or get_version_suffix(vmlinuz, VMLINUZ)
+        entry = {"version": version, "vmlinuz": vmlinuz, "initrd": None, "compression": None,
+                "modules": None, "source": source}
+
+        for initrd, initrd_version, info in initrds:
+            if version and initrd_version == version:
+                entry['initrd'], entry['compression'] = initrd, info['compression']
+                break
+
+        if modules_root and version:
+            for modules in [os.path.join(modules_root, 'lib', 'modules', version),
+                    os.path.join(modules_root, 'usr', 'lib', 'modules', version)]:
+                if os.path.isdir(modules):
+                    entry['modules'] = modules
+                    break
+        entries.append(entry)
+
+    # a casper directory has one kernel, its initrd is paired even if its version is unknown
+    unpaired = [initrd for initrd in initrds if not any(entry['initrd'] == initrd[0] for entry in entries)]
+    if source == 'casper' and len(entries) == 1 and not entries[0]['initrd'] and unpaired:
+        entries[0]['initrd'], entries[0]['compression'] = unpaired[0][0], unpaired[0][2]['compression']
+
+    for entry in entries:
+        logger.debug("Kernel %s: %s %s", entry['version'], entry['vmlinuz'], entry['initrd'])
+    return entries
+
+
+def get_kernel_index(custom_disk_directory, custom_root_directory):
+    """
+    Return the kernel entries of custom-root/boot and custom-disk/casper
+    """
+    entries = index_directory(os.path.join(custom_root_directory, 'boot'), custom_root_directory)
+    entries += index_directory(os.path.join(custom_disk_directory, 'casper'), custom_root_directory,
+            'casper')
+    return entries
+
+
+def find_kernel(entries, kernel_version, source=None):
+    """
+    Return the entry of kernel_version, or None.
+    kernel_version may be a part of the version as in config.json.
+    """
+    for entry in entries:
+        if source and entry['source'] != source:
+            continue
+        if entry['version'] and kernel_version and kernel_version in entry['version']:
+            return entry
+    return None
@@ -6,14 +6,16 @@ This need to modify outside of chroot environment.
 """
 
 import os
-import subprocess
 import re
 
 from utilities.logger import create_logger
-from utilities.util import run_cmd
+from utilities.telemetry import trace_stage
+from utilities.util import call_cmd
+from utilities.dpkg import get_package_index, get_manifest_lines, check_manifest_remove
 
 logger = create_logger(__name__)
 
+@trace_stage
 def modify_release_description(custom_root_directory):
     logger.info("Update the release descriptions")
     desc = get_os_release(custom_root_directory)
@@ -57,9 +59,9 @@ def update_release_description(target_file_path, key, value):
             f.write(line + os.linesep)
 
     cmd = "mv %s %s" % (temp_file_path, target_file_path)
-    ret = subprocess.run(cmd, shell=True)
+    ret = call_cmd(cmd)
 
-    return ret.returncode
+    return ret
 
 
 def get_os_release(custom_root_directory):
@@ -82,18 +84,28 @@ def get_os_release(custom_root_directory):
     return os_name
 
 
+@trace_stage
 def create_filesystem_manifest(custom_root_directory, custom_disk_directory):
+    """
+    Write casper/filesystem.manifest from the dpkg status of the rootfs
+    and check filesystem.manifest-remove against it.
+    Return the package index to be reused by later stages.
+    """
     logger.info("Create file system manifest")
     file_path = os.path.join(custom_disk_directory, 'casper', 'filesystem.manifest')
     logger.info("Write file system manifest to %s", file_path)
 
-    dpkg_database_directory = os.path.join(custom_root_directory, 'var', 'lib', 'dpkg')
-    cmd = "dpkg-query --show --admindir=%s" % dpkg_database_directory
-    ret, output = run_cmd(cmd)
-
-    installed_packages = output.splitlines()
+    package_index = get_package_index(custom_root_directory)
+    installed_packages = get_manifest_lines(package_index)
     packages_count = len(installed_packages)
+    logger.info("%s packages in the file system manifest", packages_count)
 
     with open(file_path, 'w') as f:
         for line in installed_packages:
             f.write('%s\n' % line)
+
+    for name in ['filesystem.manifest-remove', 'filesystem.manifest-minimal-remove']:
+        manifest_remove_path = os.path.join(custom_disk_directory, 'casper', name)
+        check_manifest_remove(package_index, manifest_remove_path)
+
+    return package_index
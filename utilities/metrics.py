@@ -0,0 +1,243 @@
+"""
+Historical build metrics stored in <cache>/metrics.db (SQLite).
+Each build records the stage timings, artifact sizes and package count,
+keyed by variant and config hash.
+
+get_config_hash() - hash of the resolved variant configuration
+collect_artifacts() - sizes of the build artifacts
+record_build() - store the metrics of a build
+find_regressions() - compare the last build with the recent history
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import statistics
+import time
+
+from utilities.logger import create_logger
+
+logger = create_logger(__name__)
+
+METRICS_DATABASE = "metrics.db"
+# kinds of metric
+STAGE = "stage"
+ARTIFACT = "artifact"
+COUNT = "count"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    variant TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    build_id INTEGER NOT NULL REFERENCES builds(id),
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS builds_variant ON builds(variant, config_hash, started);
+CREATE INDEX IF NOT EXISTS metrics_build ON metrics(build_id);
+"""
+
+
+def get_metrics_database(cache_directory):
+    return os.path.join(cache_directory, METRICS_DATABASE)
+
+
+def connect(cache_directory):
+    os.makedirs(cache_directory, exist_ok=True)
+    connection = sqlite3.connect(get_metrics_database(cache_directory))
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def get_variant_config(config, variant):
+    """
+    Return the variant configuration with the global defaults applied
+    """
+    variant_config = {key: value for key, value in config.items() if key != 'variant'}
+    variant_config.update(config['variant'][variant])
+    return variant_config
+
+
+def get_config_hash(config, variant):
+    data = json.dumps(get_variant_config(config, variant), sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+
+def get_file_size(file_path):
+    if file_path and os.path.isfile(file_path):
+        return os.path.getsize(file_path)
+    return None
+
+
+def collect_artifacts(custom_disk_directory, output_paths):
+    """
+    Return dictionary of artifact name to size in bytes.
+    rootfs size is read from casper/filesystem.size, so du is not run again.
+    """
+    artifacts = {}
+    filesystem_size = os.path.join(custom_disk_directory, 'casper', 'filesystem.size')
+    if os.path.isfile(filesystem_size):
+        with open(filesystem_size, 'r') as f:
+            value = f.read().strip()
+            if value.isdigit():
+                artifacts['rootfs'] = int(value)
+
+    squashfs = os.path.join(custom_disk_directory, 'casper', 'filesystem.squashfs')
+    sizes = {'squashfs': get_file_size(squashfs)}
+    for output_path in output_paths:
+        extension = os.path.splitext(output_path)[1].lstrip('.')
+        sizes[extension] = get_file_size(output_path)
+
+    artifacts.update({name: size for name, size in sizes.items() if size is not None})
+    return artifacts
+
+
+def get_stage_timings(spans):
+    """
+    Return dictionary of stage or command name to total wall time
+    """
+    timings = {}
+    for span in spans:
+        timings[span['name']] = timings.get(span['name'], 0) + span['wall']
+    return timings
+
+
+def record_build(cache_directory, variant, config_hash, started, spans, artifacts, counts):
+    """
+    Store the metrics of one build. Return the build id.
+    """
+    connection = connect(cache_directory)
+    try:
+        with connection:
+            cursor = connection.execute(
+                    "INSERT INTO builds (variant, config_hash, started, duration) VALUES (?, ?, ?, ?)",
+                    (variant, config_hash, started, time.time() - started))
+            build_id = cursor.lastrowid
+            rows = [(build_id, STAGE, name, value) for name, value in get_stage_timings(spans).items()]
+            rows += [(build_id, ARTIFACT, name, value) for name, value in artifacts.items()]
+            rows += [(build_id, COUNT, name, value) for name, value in counts.items()]
+            connection.executemany(
+                    "INSERT INTO metrics (build_id, kind, name, value) VALUES (?, ?, ?, ?)", rows)
+    finally:
+        connection.close()
+
+    logger.info("Build metrics recorded in %s", get_metrics_database(cache_directory))
+    return build_id
+
+
+def get_builds(connection, variant, config_hash=None, limit=None):
+    """
+    Return list of build rows, newest first
+    """
+    query = "SELECT id, variant, config_hash, started, duration FROM builds WHERE variant = ?"
+    params = [variant]
+    if config_hash:
+        query += " AND config_hash = ?"
+        params.append(config_hash)
+    query += " ORDER BY started DESC"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    return connection.execute(query, params).fetchall()
+
+
+def get_build_metrics(connection, build_id):
+    """
+    Return dictionary of (kind, name) to value
+    """
+    rows = connection.execute("SELECT kind, name, value FROM metrics WHERE build_id = ?", (build_id,))
+    return {(kind, name): value for kind, name, value in rows}
+
+
+def get_variants(connection):
+    return [row[0] for row in connection.execute("SELECT DISTINCT variant FROM builds ORDER BY variant")]
+
+
+def get_history(cache_directory, variant, config_hash=None, history=5):
+    """
+    Return the metrics of the last build and list of metrics of
+    the previous builds of the same variant
+    """
+    if not os.path.exists(get_metrics_database(cache_directory)):
+        return None, []
+
+    connection = connect(cache_directory)
+    try:
+        builds = get_builds(connection, variant, config_hash, history + 1)
+        metrics = [get_build_metrics(connection, build[0]) for build in builds]
+    finally:
+        connection.close()
+
+    if not metrics:
+        return None, []
+
+    return metrics[0], metrics[1:]
+
+
+def find_regressions(cache_directory, variant, config_hash=None, history=5, threshold=20,
+        min_seconds=1.0):
+    """
+    Compare the last build of the variant with the median of the previous builds.
+    Stages and commands shorter than min_seconds are ignored as noise.
+    Return list of (kind, name, median, value, percent) which grew beyond threshold percent.
+    """
+    latest, previous = get_history(cache_directory, variant, config_hash, history)
+    regressions = []
+    if not latest or not previous:
+        return regressions
+
+    for key, value in sorted(latest.items()):
+        kind, name = key
+        values = [metrics[key] for metrics in previous if key in metrics]
+        if not values:
+            continue
+        median = statistics.median(values)
+        if kind == STAGE and max(value, median) < min_seconds:
+            continue
+        if median <= 0:
+            continue
+        percent = (value - median) * 100.0 / median
+        if percent > threshold:
+            regressions.append((kind, name, median, value, percent))
+
+    return regressions
+
+
+def get_stats(cache_directory, variants=None, config_hash=None, history=5, threshold=20):
+    """
+    Log the regressions of each variant.
+    Return total number of regressions.
+    """
+    database = get_metrics_database(cache_directory)
+    if not os.path.exists(database):
+        logger.error("No build metrics in %s", database)
+        return 0
+
+    if not variants:
+        connection = connect(cache_directory)
+        try:
+            variants = get_variants(connection)
+        finally:
+            connection.close()
+
+    total = 0
+    for variant in variants:
+        regressions = find_regressions(cache_directory, variant, config_hash, history, threshold)
+        if not regressions:
+            logger.info("%s: no regression against the last %s builds", variant, history)
+            continue
+
+        for kind, name, median, value, percent in regressions:
+            unit = 's' if kind == STAGE else ''
+            logger.warning("%s: %s %s grew %.1f%% (median %.2f%s, last %.2f%s)",
+                    variant, kind, name, percent, median, unit, value, unit)
+        total += len(regressions)
+
+    return total
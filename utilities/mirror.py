@@ -0,0 +1,314 @@
+"""
+Offline local apt repository. The packages of each variant are resolved
+against the manifest of its base image and written with their
+dependencies to a repository with one suite per variant:
+
+    <mirror>/pool/...                          .deb files
+    <mirror>/dists/<variant>/Release           signed to InRelease, Release.gpg
+    <mirror>/dists/<variant>/main/binary-<arch>/Packages(.gz, .xz)
+    <mirror>/mirror.gpg                        public key of the signature
+
+Builds with the local_mirror config bind the repository read only into
+the container and apt reads no other source, so the build is hermetic.
+
+create_mirror() - resolve, download and write the repository
+set_mirror_sources() - make apt in the rootfs read only the repository
+"""
+
+import datetime
+import glob
+import gzip
+import hashlib
+import lzma
+import os
+import shutil
+
+from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
+from utilities.errors import BuildError
+from utilities.iso import read_iso_file, list_iso_directory
+from utilities.util import run_cmd, set_apt_sources, remove_apt_sources
+from utilities.apt import ConnectionPool, load_indexes, parse_source_line, resolve_packages, \
+        fetch_packages, get_archives_directory, get_archive_name
+from utilities.fastest_mirror import rewrite_sources
+from utilities.parser import get_base_image, get_cache_directory, get_mirrors, get_packages_list, \
+        get_sources_list
+
+logger = create_logger(__name__)
+
+MIRROR_COMPONENT = "main"
+MIRROR_KEY_FILE = "mirror.gpg"
+# where the repository is mounted in the container
+MIRROR_MOUNT_POINT = "/var/local/ubuntu-image-mirror"
+ARCHIVE_URL = "http://archive.ubuntu.com/ubuntu"
+PORTS_URL = "http://ports.ubuntu.com/ubuntu-ports"
+ARCHIVE_COMPONENTS = ["main", "restricted", "universe", "multiverse"]
+
+
+def get_iso_installed_packages(iso_file_path):
+    """
+    Return dictionary of name to stanza of the packages in casper/filesystem.manifest
+    """
+    manifest = read_iso_file(iso_file_path, 'casper/filesystem.manifest', 16 * 1024 * 1024)
+    if manifest is None:
+        return None
+
+    architecture = get_iso_architecture(iso_file_path)
+    installed = {}
+    for line in manifest.decode('utf-8', errors='replace').splitlines():
+        words = line.split()
+        if len(words) != 2:
+            continue
+        name, _, package_architecture = words[0].partition(':')
+        installed[name] = {"Package": name, "Version": words[1],
+                "Architecture": package_architecture or architecture,
+                "Status": "install ok installed"}
+    return installed
+
+
+def get_iso_architecture(iso_file_path):
+    """
+    Return the architecture in .disk/info, e.g. 'Ubuntu 22.04.3 LTS "Jammy Jellyfish" - Release amd64 (20230807.2)'
+    """
+    info = read_iso_file(iso_file_path, '.disk/info') or b''
+    words = info.decode('utf-8', errors='replace').split('(')[0].split()
+    return words[-1] if words else None
+
+
+def get_iso_codename(iso_file_path):
+    """
+    Return the codename of the release in the dists directory of the ISO
+    """
+    entries = list_iso_directory(iso_file_path, 'dists') or []
+    codenames = [name for name, is_directory in entries
+            if is_directory and name not in ('stable', 'unstable')]
+    return codenames[0] if codenames else None
+
+
+def get_iso_sources(iso_file_path, architecture):
+    """
+    Return the sources.list lines of the release of the ISO on the Ubuntu archive
+    """
+    codename = get_iso_codename(iso_file_path)
+    if not codename:
+        return []
+
+    url = ARCHIVE_URL if architecture in ('amd64', 'i386') else PORTS_URL
+    return ["deb %s %s %s" % (url, suite, ' '.join(ARCHIVE_COMPONENTS))
+            for suite in [codename, codename + '-updates', codename + '-security']]
+
+
+def resolve_variant(config, variant, pool):
+    """
+    Return architecture and list of stanzas of the packages to install in the variant
+    """
+    iso_file_path = get_base_image(config, variant)
+    installed = get_iso_installed_packages(iso_file_path)
+    architecture = get_iso_architecture(iso_file_path)
+    if installed is None or not architecture:
+        raise BuildError("Cannot read the manifest or architecture of %s" % iso_file_path)
+
+    sources_list = get_iso_sources(iso_file_path, architecture) + (get_sources_list(config, variant) or [])
+    sources = [source for source in map(parse_source_line, sources_list) if source]
+    cache_directory = get_cache_directory(config, variant)
+    sources = rewrite_sources(get_mirrors(config), sources, cache_directory)
+    index = load_indexes(sources, architecture, cache_directory, pool)
+
+    packages = get_packages_list(config, variant) or []
+    selected, unresolved = resolve_packages(packages, index, installed, architecture)
+    if unresolved:
+        raise BuildError("Cannot resolve %s for variant %s" % (
+                ', '.join(str(group) for _, group in unresolved), variant))
+
+    logger.info("Resolved %d packages for variant %s", len(selected), variant)
+    return architecture, list(selected.values())
+
+
+def get_pool_path(stanza):
+    """
+    Return path of the .deb in the repository, the path of the origin if it is in a pool
+    """
+    filename = os.path.normpath(stanza['Filename']).lstrip('/')
+    if not filename.startswith('pool/'):
+        filename = os.path.join('pool', MIRROR_COMPONENT, os.path.basename(filename))
+    return filename
+
+
+def add_to_pool(mirror_directory, stanza, archives_directory):
+    """
+    Hard link the .deb from the artifact cache into the pool, copy if on another file system.
+    Return the stanza of the Packages index.
+    """
+    pool_path = get_pool_path(stanza)
+    target = os.path.join(mirror_directory, pool_path)
+    source = os.path.join(archives_directory, get_archive_name(stanza))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if not os.path.exists(target):
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    entry = {key: value for key, value in stanza.items() if not key.startswith('_')}
+    entry['Filename'] = pool_path
+    return entry
+
+
+def format_stanza(stanza):
+    lines = []
+    for key, value in stanza.items():
+        lines.append("%s: %s" % (key, value.replace('\n', '\n ')))
+    return '\n'.join(lines) + '\n'
+
+
+def write_index(suite_directory, path, content):
+    """
+    Write the Packages index uncompressed, gzip and xz.
+    Return list of (path relative to the suite, size, sha256).
+    """
+    entries = []
+    for extension, compress in [('', bytes), ('.gz', gzip.compress), ('.xz', lzma.compress)]:
+        data = compress(content)
+        file_path = os.path.join(suite_directory, path + extension)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        entries.append((path + extension, len(data), hashlib.sha256(data).hexdigest()))
+    return entries
+
+
+def write_release(suite_directory, suite, architecture, entries):
+    release = [
+        "Origin: ubuntu-image",
+        "Label: ubuntu-image",
+        "Suite: %s" % suite,
+        "Codename: %s" % suite,
+        "Date: %s" % datetime.datetime.now(datetime.timezone.utc).strftime('%a, %d %b %Y %H:%M:%S UTC'),
+        "Architectures: %s" % architecture,
+        "Components: %s" % MIRROR_COMPONENT,
+        "SHA256:",
+    ]
+    release += [" %s %d %s" % (sha256, size, path) for path, size, sha256 in entries]
+    release_path = os.path.join(suite_directory, 'Release')
+    with open(release_path, 'w') as f:
+        f.write('\n'.join(release) + '\n')
+    return release_path
+
+
+def sign_release(release_path, key):
+    """
+    Sign the Release file to InRelease and Release.gpg with gpg
+    """
+    directory = os.path.dirname(release_path)
+    for option, name in [('--clearsign', 'InRelease'), ('--armor --detach-sign', 'Release.gpg')]:
+        cmd = "gpg --batch --yes --local-user %s %s --output %s %s" % (
+                key, option, os.path.join(directory, name), release_path)
+        ret, output = run_cmd(cmd)
+        if ret:
+            raise BuildError("Cannot sign %s: %s" % (release_path, output))
+
+
+def export_key(mirror_directory, key):
+    cmd = "gpg --batch --yes --export --output %s %s" % (os.path.join(mirror_directory, MIRROR_KEY_FILE), key)
+    ret, output = run_cmd(cmd)
+    if ret:
+        raise BuildError("Cannot export the key %s: %s" % (key, output))
+
+
+def prune_mirror(mirror_directory, pool_paths, suites):
+    """
+    Remove the .deb files and suites which are not part of the repository anymore
+    """
+    for file_path in glob.glob(os.path.join(mirror_directory, 'pool', '**', '*.deb'), recursive=True):
+        if os.path.relpath(file_path, mirror_directory) not in pool_paths:
+            os.remove(file_path)
+    for suite_directory in glob.glob(os.path.join(mirror_directory, 'dists', '*')):
+        if os.path.basename(suite_directory) not in suites:
+            shutil.rmtree(suite_directory)
+
+
+@trace_stage
+def create_mirror(config, variants, mirror_directory, key=None):
+    """
+    Write a local apt repository with the resolved packages of the variants,
+    one suite per variant. The repository is signed if key is given,
+    else the builds trust it without signature.
+    Return: 0
+    """
+    mirror_directory = os.path.abspath(mirror_directory)
+    variants = variants or sorted(config['variant'])
+    pool = ConnectionPool()
+    pool_paths = set()
+
+    for variant in variants:
+        architecture, stanzas = resolve_variant(config, variant, pool)
+        cache_directory = get_cache_directory(config, variant)
+        paths = fetch_packages(stanzas, cache_directory, pool=pool)
+        if len(paths) != len(stanzas):
+            raise BuildError("Cannot download all packages of variant %s" % variant)
+
+        archives_directory = get_archives_directory(cache_directory)
+        entries = [add_to_pool(mirror_directory, stanza, archives_directory)
+                for stanza in sorted(stanzas, key=lambda stanza: stanza['Package'])]
+        pool_paths.update(entry['Filename'] for entry in entries)
+
+        suite_directory = os.path.join(mirror_directory, 'dists', variant)
+        content = '\n'.join(format_stanza(entry) for entry in entries).encode('utf-8')
+        index_entries = write_index(suite_directory,
+                "%s/binary-%s/Packages" % (MIRROR_COMPONENT, architecture), content)
+        release_path = write_release(suite_directory, variant, architecture, index_entries)
+        if key:
+            sign_release(release_path, key)
+        else:
+            for name in ['InRelease', 'Release.gpg']:
+                if os.path.exists(os.path.join(suite_directory, name)):
+                    os.remove(os.path.join(suite_directory, name))
+        logger.info("Wrote %d packages of variant %s to %s", len(entries), variant, suite_directory)
+
+    prune_mirror(mirror_directory, pool_paths, variants)
+    key_path = os.path.join(mirror_directory, MIRROR_KEY_FILE)
+    if key:
+        export_key(mirror_directory, key)
+    elif os.path.exists(key_path):
+        os.remove(key_path)
+
+    return 0
+
+
+def get_mirror_sources_line(mirror_directory, variant):
+    """
+    Return the sources.list line of the mounted repository for the variant
+    """
+    if not os.path.isfile(os.path.join(mirror_directory, 'dists', variant, 'Release')):
+        raise BuildError("Variant %s is not in the mirror %s" % (variant, mirror_directory))
+
+    if os.path.isfile(os.path.join(mirror_directory, MIRROR_KEY_FILE)):
+        option = "signed-by=%s" % os.path.join(MIRROR_MOUNT_POINT, MIRROR_KEY_FILE)
+    else:
+        logger.warning("The mirror %s is not signed", mirror_directory)
+        option = "trusted=yes"
+    return "deb [%s] file:%s %s %s" % (option, MIRROR_MOUNT_POINT, variant, MIRROR_COMPONENT)
+
+
+def set_mirror_sources(custom_root_directory, mirror_directory, variant):
+    """
+    Make apt in the rootfs read only the mounted repository
+    """
+    set_apt_sources([get_mirror_sources_line(mirror_directory, variant)], custom_root_directory)
+    os.makedirs(os.path.join(custom_root_directory, MIRROR_MOUNT_POINT.lstrip('/')), exist_ok=True)
+
+
+def remove_mirror_sources(custom_root_directory):
+    """
+    Remove the apt configuration and the lists of the repository from the rootfs
+    """
+    remove_apt_sources(custom_root_directory)
+
+    lists_prefix = MIRROR_MOUNT_POINT.strip('/').replace('/', '_')
+    for file_path in glob.glob(os.path.join(custom_root_directory, 'var', 'lib', 'apt', 'lists',
+            '_%s_*' % lists_prefix)):
+        os.remove(file_path)
+
+    mount_point = os.path.join(custom_root_directory, MIRROR_MOUNT_POINT.lstrip('/'))
+    if os.path.isdir(mount_point) and not os.listdir(mount_point):
+        os.rmdir(mount_point)
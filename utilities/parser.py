@@ -7,8 +7,13 @@ import json
 import re
 
 from utilities.logger import create_logger
+from utilities.errors import BuildError
 from utilities.util import run_cmd
 from utilities.file_ops import make_directories
+from utilities.fastest_mirror import get_ranked_urls, download_file
+from utilities.constant import IMAGE_HEADROOM, SQUASHFS_COMPRESSION, MEMORY_BUDGET, PREFETCH_PACKAGES, \
+        APT_CACHE_PROXY, DEFER_INITRAMFS, INITRAMFS_COMPRESSION, PURGE_KERNELS, SLIM_PROFILES, SLIM_LOCALES, \
+        SIZE_REPORT, REUSE_SQUASHFS_BLOCKS
 
 logger = create_logger(__name__)
 
@@ -71,7 +76,7 @@ def get_cache_directory(config, variant):
     """
     cache_directory = None
     if 'cache' in config:
-        cache_directory = config['cache']
+        cache_directory = os.path.expanduser(config['cache'])
 
     return cache_directory
 
@@ -90,10 +95,21 @@ def get_base_image_url(config, variant):
     return image
 
 
-def get_base_image(config, variant):
+def get_mirrors(config):
     """
-    Check base image from cache directory if exists.
-    Else, download it to cache directory/base-image/<version>.
+    Return dictionary of URL prefix of a source to the list of its mirrors
+    """
+    mirrors = {}
+    if 'mirrors' in config:
+        mirrors = config['mirrors']
+
+    return mirrors
+
+
+def get_base_image_path(config, variant):
+    """
+    Return path of the base image in cache directory/base-image/<version>.
+    The base image may not be downloaded yet.
     """
     # get cache directory
     cache_directory = get_cache_directory(config, variant)
@@ -101,13 +117,22 @@ def get_base_image(config, variant):
     # Get the base image name
     base_image_url = get_base_image_url(config, variant)
     image_iso = os.path.basename(base_image_url)
-    image_version = '0.0'
     image_version = re.search(r'(\d+\.\d+)', image_iso)
-    if image_version:
-        image_version = image_version.group(0)
+    image_version = image_version.group(0) if image_version else '0.0'
 
     cache_base_image_directory = os.path.join(cache_directory, 'base-image', image_version)
-    base_image = os.path.join(cache_base_image_directory, image_iso)
+    return os.path.join(cache_base_image_directory, image_iso)
+
+
+def get_base_image(config, variant):
+    """
+    Check base image from cache directory if exists.
+    Else, download it to cache directory/base-image/<version>.
+    """
+    base_image_url = get_base_image_url(config, variant)
+    base_image = get_base_image_path(config, variant)
+    image_iso = os.path.basename(base_image)
+    cache_base_image_directory = os.path.dirname(base_image)
     logger.info("base image in %s", base_image)
 
     if os.path.exists(base_image):
@@ -127,9 +152,17 @@ def get_base_image(config, variant):
 
     make_directories(cache_base_image_directory)
     logger.info("Downloading %s", image_iso)
+    urls = get_ranked_urls(get_mirrors(config), base_image_url, get_cache_directory(config, variant))
+    if len(urls) > 1:
+        if not download_file(urls, base_image):
+            raise BuildError("Cannot download %s from any mirror" % image_iso)
+        return base_image
+
     cmd = "wget --directory-prefix=%s %s" % (cache_base_image_directory, base_image_url)
     logger.debug("cmd: %s", cmd)
-    run_cmd(cmd)
+    ret, output = run_cmd(cmd)
+    if ret or not os.path.exists(base_image):
+        raise BuildError("Cannot download %s: %s" % (base_image_url, output))
 
     #base_image_path = os.path.dirname(base_image_url)
     #cmd = "wget --directory-prefix=%s %s" % (cache_base_image_directory, os.path.join(base_image_path, 'SHA256SUMS'))
@@ -153,3 +186,194 @@ def get_image_types(config, variant):
     return image_type
 
 
+def get_image_headroom(config, variant):
+    """
+    Return the free space in MB added on top of the rootfs
+    when sizing the raw disk image.
+    """
+    image_headroom = IMAGE_HEADROOM
+    if 'image_headroom' in config['variant'][variant]:
+        image_headroom = config['variant'][variant]['image_headroom']
+    elif 'image_headroom' in config:
+        image_headroom = config['image_headroom']
+
+    return int(image_headroom)
+
+
+def get_boot_trace(config, variant):
+    """
+    Return the boot trace used to order the files in the squashfs.
+    Either a path to a recorded trace or name of a shipped trace such as 'casper'.
+    """
+    boot_trace = None
+    if 'boot_trace' in config['variant'][variant]:
+        boot_trace = config['variant'][variant]['boot_trace']
+    elif 'boot_trace' in config:
+        boot_trace = config['boot_trace']
+
+    return boot_trace
+
+
+def get_squashfs_compression(config, variant):
+    """
+    Return the compressor of filesystem.squashfs such as gzip, xz, lzo, lz4 or zstd.
+    Casper in older Ubuntu releases may not support all of them.
+    """
+    compression = SQUASHFS_COMPRESSION
+    if 'compression' in config['variant'][variant]:
+        compression = config['variant'][variant]['compression']
+    elif 'compression' in config:
+        compression = config['compression']
+
+    return compression
+
+
+def get_memory_budget(config, variant):
+    """
+    Return the memory in MB which can be used to stage custom-root,
+    custom-disk and the partition images on tmpfs. 0 disables the staging.
+    """
+    memory_budget = MEMORY_BUDGET
+    if 'memory_budget' in config['variant'][variant]:
+        memory_budget = config['variant'][variant]['memory_budget']
+    elif 'memory_budget' in config:
+        memory_budget = config['memory_budget']
+
+    return int(memory_budget)
+
+
+def get_prefetch_packages(config, variant):
+    """
+    Return True if the packages are resolved and downloaded on the host
+    before the container starts
+    """
+    prefetch = PREFETCH_PACKAGES
+    if 'prefetch_packages' in config['variant'][variant]:
+        prefetch = config['variant'][variant]['prefetch_packages']
+    elif 'prefetch_packages' in config:
+        prefetch = config['prefetch_packages']
+
+    return bool(prefetch)
+
+
+def get_local_mirror(config, variant):
+    """
+    Return path of the local apt repository written by the mirror command
+    or None if the packages are installed from the network
+    """
+    mirror = None
+    if 'local_mirror' in config['variant'][variant]:
+        mirror = config['variant'][variant]['local_mirror']
+    elif 'local_mirror' in config:
+        mirror = config['local_mirror']
+
+    return os.path.abspath(os.path.expanduser(mirror)) if mirror else None
+
+
+def get_apt_cache_proxy(config, variant, default_address):
+    """
+    Return host:port of the caching apt proxy or None if it is disabled.
+    True is the default address.
+    """
+    proxy = APT_CACHE_PROXY
+    if 'apt_cache_proxy' in config['variant'][variant]:
+        proxy = config['variant'][variant]['apt_cache_proxy']
+    elif 'apt_cache_proxy' in config:
+        proxy = config['apt_cache_proxy']
+
+    if proxy is True:
+        return default_address
+    return proxy or None
+
+
+def get_defer_initramfs(config, variant):
+    """
+    Return True if update-initramfs is deferred to a single run for kernel.version
+    """
+    defer = DEFER_INITRAMFS
+    if 'defer_initramfs' in config['variant'][variant]:
+        defer = config['variant'][variant]['defer_initramfs']
+    elif 'defer_initramfs' in config:
+        defer = config['defer_initramfs']
+
+    return bool(defer)
+
+
+def get_initramfs_compression(config, variant):
+    """
+    Return the compressor of the initramfs such as gzip, lz4, xz or zstd,
+    None if the one of the rootfs is kept
+    """
+    compression = INITRAMFS_COMPRESSION
+    if 'initramfs_compression' in config['variant'][variant]:
+        compression = config['variant'][variant]['initramfs_compression']
+    elif 'initramfs_compression' in config:
+        compression = config['initramfs_compression']
+
+    return compression or None
+
+
+def get_purge_kernels(config, variant):
+    """
+    Return True if the kernels other than kernel.version are purged from the rootfs
+    """
+    purge = PURGE_KERNELS
+    if 'purge_kernels' in config['variant'][variant]:
+        purge = config['variant'][variant]['purge_kernels']
+    elif 'purge_kernels' in config:
+        purge = config['purge_kernels']
+
+    return bool(purge)
+
+
+def get_slim_profiles(config, variant):
+    """
+    Return list of the slimming profiles of the rootfs
+    """
+    profiles = SLIM_PROFILES
+    if 'slim' in config['variant'][variant]:
+        profiles = config['variant'][variant]['slim']
+    elif 'slim' in config:
+        profiles = config['slim']
+
+    return list(profiles or [])
+
+
+def get_slim_locales(config, variant):
+    """
+    Return list of the languages kept by the locales profile
+    """
+    locales = SLIM_LOCALES
+    if 'slim_locales' in config['variant'][variant]:
+        locales = config['variant'][variant]['slim_locales']
+    elif 'slim_locales' in config:
+        locales = config['slim_locales']
+
+    return list(locales)
+
+
+def get_size_report(config, variant):
+    """
+    Return True if the size report of the packages and directories is written
+    """
+    report = SIZE_REPORT
+    if 'size_report' in config['variant'][variant]:
+        report = config['variant'][variant]['size_report']
+    elif 'size_report' in config:
+        report = config['size_report']
+
+    return bool(report)
+
+
+def get_reuse_squashfs_blocks(config, variant):
+    """
+    Return True if filesystem.squashfs copies the compressed blocks of the
+    files unchanged from the base image
+    """
+    reuse = REUSE_SQUASHFS_BLOCKS
+    if 'reuse_squashfs_blocks' in config['variant'][variant]:
+        reuse = config['variant'][variant]['reuse_squashfs_blocks']
+    elif 'reuse_squashfs_blocks' in config:
+        reuse = config['reuse_squashfs_blocks']
+
+    return bool(reuse)
@@ -0,0 +1,289 @@
+"""
+Dry-run build planner. Estimate the duration of each stage and the
+peak disk usage before the build starts, without mounting or extracting.
+The kernels and packages of the base image are read from its squashfs in process.
+
+get_build_plan() - resolve the variant, cache hits and estimates
+show_build_plan() - log the plan
+check_disk_space() - compare the estimate with the free space
+"""
+
+import os
+import shutil
+import statistics
+import urllib.request
+
+from utilities.logger import create_logger
+from utilities.iso import find_iso_file, read_iso_file
+from utilities.squashfs import open_image, CASPER_SQUASHFS
+from utilities.inspector import get_image_kernels, get_image_packages, get_rootfs_size
+from utilities.dpkg import is_installed
+from utilities.staging import fits_in_memory, get_staging_size
+from utilities.metrics import get_history, get_config_hash, STAGE, ARTIFACT
+from utilities.parser import get_base_image_path, get_base_image_url, get_cache_directory, \
+        get_image_types, get_kernel_overlays, get_packages_list, get_squashfs_compression
+
+logger = create_logger(__name__)
+
+# ratio of rootfs size to squashfs size when filesystem.size is not in the ISO
+SQUASHFS_RATIO = 2.5
+# free space kept on top of the estimate
+SPACE_MARGIN = 1.1
+# estimated throughput in MB/s when there is no history
+THROUGHPUT = {
+    "download": 20,
+    "copy_original_iso_files": 200,
+    "extract_squashfs": 100,
+    "create_squashfs": {"gzip": 40, "xz": 10, "lzo": 60, "lz4": 150, "zstd": 60},
+    "update_filesystem_size": 1000,
+    "update_checksums": 400,
+    "create_iso_image": 200,
+    "do_raw_image": 150,
+}
+# seconds per package installed in the container
+PACKAGE_INSTALL_TIME = 5
+
+
+def get_remote_size(url, timeout=10):
+    """
+    Return Content-Length of url or None
+    """
+    try:
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            length = response.headers.get('Content-Length')
+            return int(length) if length else None
+    except (OSError, ValueError):
+        return None
+
+
+def get_base_image_sizes(base_image):
+    """
+    Return sizes in bytes of the ISO, the squashfs and the uncompressed rootfs.
+    The rootfs size is read from casper/filesystem.size of the ISO, else
+    summed from the inodes of the squashfs.
+    """
+    sizes = {"iso": os.path.getsize(base_image)}
+    location = find_iso_file(base_image, CASPER_SQUASHFS)
+    if location:
+        sizes['squashfs'] = location[1]
+
+    filesystem_size = read_iso_file(base_image, 'casper/filesystem.size')
+    if filesystem_size and filesystem_size.strip().isdigit():
+        sizes['rootfs'] = int(filesystem_size.strip())
+    elif 'squashfs' in sizes:
+        try:
+            with open_image(base_image) as image:
+                sizes['rootfs'] = get_rootfs_size(image)
+        except (OSError, ValueError) as exception:
+            logger.debug("Cannot read the rootfs size of %s: %s", base_image, exception)
+            sizes['rootfs'] = int(sizes['squashfs'] * SQUASHFS_RATIO)
+
+    return sizes
+
+
+def get_base_image_content(base_image):
+    """
+    Return {'compression', 'kernels', 'packages'} of the squashfs of the base image, or None
+    """
+    try:
+        with open_image(base_image) as image:
+            return {"compression": image.compression,
+                    "kernels": [entry['version'] for entry in get_image_kernels(image)],
+                    "packages": sum(1 for package in get_image_packages(image).values()
+                            if is_installed(package))}
+    except (OSError, ValueError) as exception:
+        logger.debug("Cannot read the squashfs of %s: %s", base_image, exception)
+        return None
+
+
+def get_history_estimates(cache_directory, variant, config_hash):
+    """
+    Return dictionary of (kind, name) to median of the previous builds.
+    Builds with the same configuration are used if there are any.
+    """
+    latest, previous = get_history(cache_directory, variant, config_hash)
+    if not latest:
+        latest, previous = get_history(cache_directory, variant)
+    builds = [metrics for metrics in [latest] + previous if metrics]
+
+    estimates = {}
+    keys = set(key for metrics in builds for key in metrics)
+    for key in keys:
+        estimates[key] = statistics.median(metrics[key] for metrics in builds if key in metrics)
+
+    return estimates
+
+
+def get_nearest_directory(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def get_build_plan(config, variant, project_directory, output_iso_path, memory_budget=0):
+    """
+    Return the build plan as dictionary.
+    With memory_budget in MB, custom-root, custom-disk and the partition
+    images are planned on tmpfs if they fit.
+    """
+    cache_directory = get_cache_directory(config, variant)
+    base_image = get_base_image_path(config, variant)
+    image_types = get_image_types(config, variant).split(' ')
+    compression = get_squashfs_compression(config, variant)
+    packages = get_packages_list(config, variant) or []
+    config_hash = get_config_hash(config, variant)
+    history = get_history_estimates(cache_directory, variant, config_hash)
+    MB = 1024 * 1024
+
+    plan = {
+        "variant": variant,
+        "config_hash": config_hash,
+        "project_directory": project_directory,
+        "cache": [],
+        "stages": [],
+        "disk": {},
+        "history": bool(history),
+    }
+
+    # cache hits
+    base_image_cached = os.path.exists(base_image)
+    plan['cache'].append(("base image", base_image, base_image_cached))
+    for overlay in get_kernel_overlays(config, variant) or []:
+        if overlay.startswith('http'):
+            plan['cache'].append(("kernel overlay", overlay, False))
+        else:
+            plan['cache'].append(("kernel overlay", overlay, os.path.exists(overlay)))
+    for output_path in [output_iso_path, os.path.splitext(output_iso_path)[0] + '.img']:
+        if os.path.exists(output_path):
+            plan['cache'].append(("output (overwritten)", output_path, True))
+
+    # sizes and content of the base image
+    plan['base'] = None
+    if base_image_cached:
+        sizes = get_base_image_sizes(base_image)
+        plan['base'] = get_base_image_content(base_image)
+    else:
+        iso_size = get_remote_size(get_base_image_url(config, variant)) or 0
+        sizes = {"iso": iso_size, "squashfs": int(iso_size * 0.85)}
+        sizes['rootfs'] = int(sizes['squashfs'] * SQUASHFS_RATIO)
+    sizes.setdefault('squashfs', sizes['iso'])
+    sizes.setdefault('rootfs', int(sizes['squashfs'] * SQUASHFS_RATIO))
+
+    # sizes after customization, from history if any
+    custom_rootfs = history.get((ARTIFACT, 'rootfs'), sizes['rootfs'])
+    custom_squashfs = history.get((ARTIFACT, 'squashfs'),
+            sizes['squashfs'] * custom_rootfs / max(sizes['rootfs'], 1))
+    custom_iso = history.get((ARTIFACT, 'iso'), sizes['iso'] - sizes['squashfs'] + custom_squashfs)
+    plan['sizes'] = {"base_iso": sizes['iso'], "base_squashfs": sizes['squashfs'],
+            "base_rootfs": sizes['rootfs'], "rootfs": custom_rootfs,
+            "squashfs": custom_squashfs, "iso": custom_iso}
+
+    def add_stage(name, size, throughput=None):
+        if (STAGE, name) in history:
+            seconds, source = history[(STAGE, name)], "history"
+        elif throughput:
+            seconds, source = size / MB / throughput, "estimate"
+        else:
+            seconds, source = size, "estimate"
+        plan['stages'].append((name, seconds, source))
+
+    if not base_image_cached:
+        add_stage("download", sizes['iso'], THROUGHPUT['download'])
+    add_stage("copy_original_iso_files", sizes['iso'] - sizes['squashfs'], THROUGHPUT['copy_original_iso_files'])
+    add_stage("extract_squashfs", sizes['rootfs'], THROUGHPUT['extract_squashfs'])
+    add_stage("create_virtual_environment", len(packages) * PACKAGE_INSTALL_TIME)
+    add_stage("create_filesystem_manifest", 1)
+    if 'iso' in image_types:
+        add_stage("create_squashfs", custom_rootfs,
+                THROUGHPUT['create_squashfs'].get(compression, THROUGHPUT['create_squashfs']['gzip']))
+        add_stage("update_filesystem_size", custom_rootfs, THROUGHPUT['update_filesystem_size'])
+        add_stage("update_checksums", custom_iso, THROUGHPUT['update_checksums'])
+        add_stage("create_iso_image", custom_iso, THROUGHPUT['create_iso_image'])
+    if 'img' in image_types:
+        add_stage("do_raw_image", custom_rootfs, THROUGHPUT['do_raw_image'])
+
+    # peak disk usage of the project directory.
+    # custom-disk without squashfs + custom-root, then the new squashfs and the output image.
+    base = (sizes['iso'] - sizes['squashfs']) + custom_rootfs
+    peaks = [base]
+    if 'iso' in image_types:
+        peaks.append(base + custom_squashfs + custom_iso)
+    if 'img' in image_types:
+        # the ext4 partition file and the image hold the rootfs at the same time
+        peaks.append(base + custom_squashfs * ('iso' in image_types) + 2 * custom_rootfs * 1.1)
+
+    # custom-root, custom-disk and the partition images can be staged on tmpfs
+    staging = custom_rootfs + sizes['iso'] - sizes['squashfs'] + custom_squashfs
+    if 'img' in image_types:
+        staging += custom_rootfs * 1.1
+    plan['staging_footprint'] = staging
+    plan['tmpfs'] = fits_in_memory(staging, memory_budget)
+    if plan['tmpfs']:
+        outputs = custom_iso * ('iso' in image_types) + custom_rootfs * 1.1 * ('img' in image_types)
+        plan['disk']['project'] = (get_nearest_directory(project_directory), outputs)
+    else:
+        plan['disk']['project'] = (get_nearest_directory(project_directory), max(peaks))
+    plan['disk']['cache'] = (get_nearest_directory(cache_directory),
+            0 if base_image_cached else sizes['iso'])
+
+    return plan
+
+
+def check_disk_space(plan):
+    """
+    Return list of (directory, needed, free) which do not have enough space.
+    The project and the cache directory may be on the same file system.
+    """
+    needed = {}
+    for directory, size in plan['disk'].values():
+        device = os.stat(directory).st_dev
+        path, total = needed.get(device, (directory, 0))
+        needed[device] = (path, total + size)
+
+    insufficient = []
+    for directory, size in needed.values():
+        free = shutil.disk_usage(directory).free
+        if size * SPACE_MARGIN > free:
+            insufficient.append((directory, size * SPACE_MARGIN, free))
+
+    return insufficient
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return "%.1f%s" % (size, unit)
+        size /= 1024.0
+    return "%.1fTB" % size
+
+
+def show_build_plan(plan):
+    logger.info("Build plan for variant %s (config %s)", plan['variant'], plan['config_hash'])
+    for name, path, hit in plan['cache']:
+        logger.info("  cache %-6s %-20s %s", "hit" if hit else "miss", name, path)
+
+    if plan.get('base'):
+        base = plan['base']
+        logger.info("  base %s, %d packages, kernels %s", base['compression'], base['packages'],
+                ' '.join(base['kernels']) or "none")
+
+    for name, value in plan['sizes'].items():
+        logger.info("  size %-14s %s", name, format_size(value))
+
+    total = 0
+    for name, seconds, source in plan['stages']:
+        logger.info("  stage %-28s %8.0fs (%s)", name, seconds, source)
+        total += seconds
+    logger.info("  total %-28s %8.0fs", "", total)
+
+    if plan['tmpfs']:
+        logger.info("  staging tmpfs %s", format_size(get_staging_size(plan['staging_footprint'])))
+    else:
+        logger.info("  staging disk, footprint %s", format_size(plan['staging_footprint']))
+
+    for name, (directory, size) in plan['disk'].items():
+        free = shutil.disk_usage(directory).free
+        logger.info("  disk %-8s peak %s, free %s in %s", name, format_size(size),
+                format_size(free), directory)
@@ -0,0 +1,352 @@
+"""
+Caching HTTP proxy for apt, shared by the builds of a host. The .deb
+files and by-hash indexes are immutable, they are stored in
+<cache>/proxy by the sha256 of their URL and downloaded once even if
+several builds request them at the same time. Other requests such as
+InRelease are forwarded. HTTPS is tunneled without caching.
+
+A build with apt_cache_proxy in the config attaches to the proxy
+listening on the address or starts one in a detached process, which
+outlives the build so the concurrent builds attached to it keep it. apt
+in the container uses it through etc/apt/apt.conf.d/my_proxy. The proxy
+is also started with run_proxy() or in the process of the daemon.
+"""
+
+import hashlib
+import http.client
+import http.server
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+from utilities.logger import create_logger
+from utilities.apt import ConnectionPool
+
+logger = create_logger(__name__)
+
+PROXY_ADDRESS = "127.0.0.1:8473"
+PROXY_CACHE_DIRECTORY = "proxy"
+CHUNK_SIZE = 1024 * 1024
+# immutable files which are cached, the other files are forwarded
+CACHED_EXTENSIONS = ('.deb', '.udeb', '.ddeb')
+# request headers passed to the forwarded requests
+FORWARDED_REQUEST_HEADERS = ('If-Modified-Since', 'If-None-Match', 'Range', 'If-Range', 'Cache-Control')
+FORWARDED_RESPONSE_HEADERS = ('Content-Type', 'Content-Range', 'Last-Modified', 'ETag', 'Date')
+
+# download states of ProxyCache.claim
+HIT = "hit"
+WAIT = "wait"
+FETCH = "fetch"
+
+PROXY_LOG = "proxy.log"
+# seconds a detached proxy has to listen
+PROXY_START_TIMEOUT = 10
+BUILD_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'build_image.py')
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+class ProxyCache:
+    """
+    Files in <directory>/proxy/<2 chars>/<sha256 of the URL>, with the
+    downloads in flight so that a URL is downloaded by one request at a time
+    """
+    def __init__(self, directory):
+        self.directory = os.path.join(os.path.abspath(directory), PROXY_CACHE_DIRECTORY)
+        self.lock = threading.Lock()
+        self.downloads = {}
+        self.pool = ConnectionPool()
+        self.hits = 0
+        self.misses = 0
+
+    def is_cacheable(self, url):
+        path = urllib.parse.urlsplit(url).path
+        return path.endswith(CACHED_EXTENSIONS) or '/by-hash/' in path
+
+    def get_path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def claim(self, url):
+        """
+        Return HIT if the URL is cached, (WAIT, event) if another request
+        downloads it, else FETCH and the caller downloads it and calls release()
+        """
+        with self.lock:
+            if os.path.isfile(self.get_path(url)):
+                self.hits += 1
+                return HIT, None
+            if url in self.downloads:
+                return WAIT, self.downloads[url]
+            self.downloads[url] = threading.Event()
+            self.misses += 1
+            return FETCH, None
+
+    def release(self, url):
+        with self.lock:
+            self.downloads.pop(url).set()
+
+
+class ProxyRequestHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, apt sends many requests on one connection
+    protocol_version = 'HTTP/1.1'
+    cache = None
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = self.path
+        if not url.startswith('http://'):
+            return self.send_body(400, b"Not a proxy request\n")
+
+        if self.command == 'HEAD' or 'Range' in self.headers or not self.cache.is_cacheable(url):
+            return self.forward(url)
+
+        cache = self.cache
+        while True:
+            state, event = cache.claim(url)
+            if state == HIT:
+                return self.send_file(cache.get_path(url))
+            if state == WAIT:
+                # the other request either cached the file or failed, then try again
+                event.wait()
+                continue
+            try:
+                return self.fetch(url, cache.get_path(url))
+            finally:
+                cache.release(url)
+
+    def get_forwarded_headers(self):
+        return {key: self.headers[key] for key in FORWARDED_REQUEST_HEADERS if key in self.headers}
+
+    def copy_response_headers(self, response):
+        for key in FORWARDED_RESPONSE_HEADERS:
+            value = response.getheader(key)
+            if value:
+                self.send_header(key, value)
+
+    def open_upstream(self, url, headers):
+        try:
+            return self.cache.pool.open(url, headers)
+        except (OSError, http.client.HTTPException) as exception:
+            logger.warning("GET %s: %s", url, exception)
+            self.send_body(502, ("%s\n" % exception).encode('utf-8'))
+            return None
+
+    def forward(self, url):
+        """
+        Forward the request without caching
+        """
+        response = self.open_upstream(url, self.get_forwarded_headers())
+        if not response:
+            return
+
+        self.send_response(response.status, response.reason)
+        self.copy_response_headers(response)
+        length = response.getheader('Content-Length')
+        if length is not None:
+            self.send_header('Content-Length', length)
+        else:
+            # the upstream response is chunked, the end of the body is the end of the connection
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+            if self.command != 'HEAD':
+                self.wfile.write(chunk)
+
+    def fetch(self, url, file_path):
+        """
+        Download the file to the cache and send it to the client at the same time.
+        The download is completed for the other builds if this client goes away.
+        """
+        response = self.open_upstream(url, {})
+        if not response:
+            return
+        if response.status != 200:
+            body = response.read()
+            return self.send_body(response.status, body, {'Content-Type': 'text/plain'})
+
+        logger.info("Fetch %s", url)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        temp_path = "%s.%d.part" % (file_path, threading.get_ident())
+        client = True
+        length = response.getheader('Content-Length')
+        try:
+            self.send_response(200)
+            self.copy_response_headers(response)
+            if length is None:
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            else:
+                self.send_header('Content-Length', length)
+            self.end_headers()
+        except OSError:
+            client = False
+
+        size = 0
+        complete = False
+        with open(temp_path, 'wb') as f:
+            try:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    size += len(chunk)
+                    if client:
+                        try:
+                            self.wfile.write(chunk)
+                        except OSError:
+                            client = False
+                            self.close_connection = True
+                # a chunked body read to its end had the terminating chunk, it raises
+                # IncompleteRead if the connection is cut. The end of a body without
+                # Content-Length and chunks cannot be told from a cut connection.
+                complete = size == int(length) if length is not None else response.chunked
+            except (OSError, http.client.HTTPException) as exception:
+                logger.warning("Download of %s failed: %s", url, exception)
+
+        if not complete:
+            logger.warning("Incomplete download of %s, not cached", url)
+            os.remove(temp_path)
+            self.close_connection = True
+            return
+        os.replace(temp_path, file_path)
+
+    def send_file(self, file_path):
+        logger.debug("Cache hit %s", self.path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.debian.binary-package')
+        self.send_header('Content-Length', str(os.path.getsize(file_path)))
+        self.end_headers()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                self.wfile.write(chunk)
+
+    def do_CONNECT(self):
+        """
+        Tunnel HTTPS to the host:port of the request
+        """
+        host, _, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=60)
+        except (OSError, ValueError) as exception:
+            return self.send_body(502, ("%s\n" % exception).encode('utf-8'))
+
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.close_connection = True
+        sockets = [self.connection, upstream]
+        with upstream:
+            while True:
+                readable, _, broken = select.select(sockets, [], sockets, 60)
+                if broken or not readable:
+                    break
+                for source in readable:
+                    data = source.recv(CHUNK_SIZE)
+                    if not data:
+                        return
+                    (upstream if source is self.connection else self.connection).sendall(data)
+
+
+def is_listening(address):
+    host, _, port = address.rpartition(':')
+    try:
+        with socket.create_connection((host or '127.0.0.1', int(port)), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def create_proxy_server(cache_directory, address):
+    handler = type('Handler', (ProxyRequestHandler,), {'cache': ProxyCache(cache_directory)})
+    host, _, port = address.rpartition(':')
+    server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+    server.daemon_threads = True
+    return server
+
+
+def spawn_proxy(cache_directory, address):
+    """
+    Start the proxy in a detached process, in its own session, logging to
+    <cache>/proxy/proxy.log. Return True if it listens on address.
+    """
+    log_directory = os.path.join(cache_directory, PROXY_CACHE_DIRECTORY)
+    os.makedirs(log_directory, exist_ok=True)
+    with open(os.path.join(log_directory, PROXY_LOG), 'ab') as log:
+        subprocess.Popen([sys.executable, BUILD_SCRIPT, 'proxy', cache_directory, '-l', address],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                start_new_session=True)
+
+    # a build starting at the same time may win the address, its proxy is used then
+    deadline = time.time() + PROXY_START_TIMEOUT
+    while time.time() < deadline:
+        if is_listening(address):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def start_proxy(cache_directory, address=PROXY_ADDRESS, detached=True):
+    """
+    Attach to the proxy listening on address or start one. The proxy of a
+    build is detached, the other builds attached to it keep it when the
+    build exits; the daemon keeps it in a thread of its own process.
+    Return: URL of the proxy
+    """
+    with _servers_lock:
+        if address not in _servers:
+            if is_listening(address):
+                logger.info("Use the apt proxy on %s", address)
+            elif detached and spawn_proxy(cache_directory, address):
+                logger.info("Started the apt proxy on %s, caching in %s", address, cache_directory)
+            else:
+                if detached:
+                    logger.warning("The detached apt proxy does not listen on %s, run it in this process",
+                            address)
+                server = create_proxy_server(cache_directory, address)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                _servers[address] = server
+                logger.info("Started the apt proxy on %s, caching in %s", address, cache_directory)
+    return "http://%s" % address
+
+
+def stop_proxies():
+    with _servers_lock:
+        for server in _servers.values():
+            server.shutdown()
+            server.server_close()
+        _servers.clear()
+
+
+def run_proxy(cache_directory, address=PROXY_ADDRESS):
+    server = create_proxy_server(cache_directory, address)
+    logger.info("apt proxy listening on %s, caching in %s", address, cache_directory)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    cache = server.RequestHandlerClass.cache
+    logger.info("%d hits, %d misses", cache.hits, cache.misses)
+    return 0
@@ -0,0 +1,102 @@
+"""
+Background deletion of the project files.
+A directory is renamed into the trash directory next to it, which is
+atomic and instant, and deleted by a detached rm with idle I/O priority.
+The build never waits for the deletion. Trash left by an interrupted
+build is collected by collect_trash() on the next start.
+
+reap_directory() - move the directory to the trash and delete it in background
+collect_trash() - delete the leftover trash
+"""
+
+import os
+import shutil
+import subprocess
+import time
+
+from utilities.logger import create_logger
+from utilities.file_ops import delete_directory
+
+logger = create_logger(__name__)
+
+TRASH_DIRECTORY = ".trash"
+
+
+def get_trash_directory(path):
+    """
+    Return the trash directory on the same file system as path
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(path)), TRASH_DIRECTORY)
+
+
+def get_reaper_cmd(path):
+    """
+    Return command to delete path with the lowest CPU and I/O priority.
+    --one-file-system keeps the mounts left in a rootfs untouched.
+    """
+    cmd = ['rm', '-rf', '--one-file-system', path]
+    if shutil.which('nice'):
+        cmd = ['nice', '-n', '19'] + cmd
+    if shutil.which('ionice'):
+        cmd = ['ionice', '-c', '3'] + cmd
+    return cmd
+
+
+def spawn_reaper(path):
+    """
+    Start the deletion of path in a detached process
+    """
+    logger.debug("Reap %s", path)
+    subprocess.Popen(get_reaper_cmd(path), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def move_to_trash(path):
+    """
+    Rename path into the trash directory.
+    Return: path in the trash or None if it cannot be renamed, e.g. a mount point
+    """
+    trash_directory = get_trash_directory(path)
+    os.makedirs(trash_directory, exist_ok=True)
+    trash_path = os.path.join(trash_directory, "%s.%d.%d" % (
+            os.path.basename(os.path.abspath(path)), os.getpid(), time.time_ns()))
+    try:
+        os.rename(path, trash_path)
+    except OSError as exception:
+        logger.warning("Cannot move %s to trash: %s", path, exception)
+        return None
+
+    return trash_path
+
+
+def reap_directory(path):
+    """
+    Remove the directory without blocking the build.
+    Fall back to the foreground deletion if it cannot be moved to the trash.
+    """
+    if not os.path.lexists(path):
+        return
+
+    trash_path = move_to_trash(path)
+    if not trash_path:
+        delete_directory(path)
+        return
+
+    logger.info("Delete %s in background", path)
+    spawn_reaper(trash_path)
+
+
+def collect_trash(directory):
+    """
+    Delete the trash left in directory by previous builds in background.
+    An entry which is still deleted by a running reaper is deleted twice, which is harmless.
+    """
+    trash_directory = os.path.join(directory, TRASH_DIRECTORY)
+    if not os.path.isdir(trash_directory):
+        return
+
+    entries = os.listdir(trash_directory)
+    if entries:
+        logger.info("Collect %d leftover entries in %s", len(entries), trash_directory)
+    for entry in entries:
+        spawn_reaper(os.path.join(trash_directory, entry))
@@ -0,0 +1,323 @@
+"""
+Size attribution of the rootfs. The files are mapped to the packages which
+own them (var/lib/dpkg/info/*.list) and their contribution to
+filesystem.squashfs is estimated with the configured compressor. The
+report of a build lists the packages and directories sorted by estimated
+compressed size, with the difference to the base image and to the
+previous build of the variant.
+
+The report of the base image is cached in <cache>/size-reports by the
+superblock of its squashfs and the compressor, the last report of a variant is kept there for the
+next build.
+
+create_size_report() - packages and directories of a rootfs by size
+diff_reports() - package size changes between two reports
+write_size_report() - JSON and HTML report of a build
+"""
+
+import concurrent.futures
+import hashlib
+import html
+import json
+import os
+import stat
+
+from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
+from utilities.apt import get_installed_packages
+from utilities.dpkg import get_dpkg_directory
+from utilities.compressed_size import get_block_compressor, estimate_compressed_size
+from utilities.squashfs import open_image
+
+logger = create_logger(__name__)
+
+UNOWNED = "(unowned)"
+REPORT_DIRECTORY = "size-reports"
+# bytes of a file which are compressed for the estimate
+SAMPLE_SIZE = 64 * 1024
+# the directories are reported down to this depth, e.g. /usr/share/doc
+DIRECTORY_DEPTH = 3
+# directories which are not in the squashfs
+SKIPPED_DIRECTORIES = ['proc', 'sys', 'dev', 'run', 'tmp']
+# rows of the HTML tables
+HTML_ROWS = 100
+WORKERS = os.cpu_count() or 4
+
+
+class PathResolver:
+    """
+    Resolve the directories of the paths in the rootfs through its
+    symlinks, e.g. /bin to /usr/bin, caching them by directory
+    """
+    def __init__(self, custom_root_directory):
+        self.root = os.path.realpath(custom_root_directory)
+        self.directories = {}
+
+    def resolve(self, path):
+        directory, name = os.path.split(path)
+        if directory not in self.directories:
+            real_directory = os.path.realpath(os.path.join(self.root, directory.lstrip('/')))
+            if real_directory == self.root or real_directory.startswith(self.root + '/'):
+                self.directories[directory] = '/' + os.path.relpath(real_directory, self.root)
+            else:
+                self.directories[directory] = directory
+        return os.path.join(self.directories[directory], name).replace('//', '/')
+
+
+def get_file_owners(custom_root_directory):
+    """
+    Return dictionary of the absolute path of a file in the rootfs to the package owning it
+    """
+    info_directory = os.path.join(get_dpkg_directory(custom_root_directory), 'info')
+    resolver = PathResolver(custom_root_directory)
+    owners = {}
+    if not os.path.isdir(info_directory):
+        return owners
+
+    for name in sorted(os.listdir(info_directory)):
+        if not name.endswith('.list'):
+            continue
+        package = name[:-len('.list')].split(':')[0]
+        with open(os.path.join(info_directory, name), 'r', errors='replace') as f:
+            for line in f:
+                path = line.rstrip('\n')
+                if path and path != '/.':
+                    owners.setdefault(resolver.resolve(path), package)
+    return owners
+
+
+def iter_rootfs_files(custom_root_directory):
+    """
+    Yield (absolute path in the rootfs, host path, stat) of the regular files
+    """
+    for directory, directories, files in os.walk(custom_root_directory):
+        if directory == custom_root_directory:
+            directories[:] = [name for name in directories if name not in SKIPPED_DIRECTORIES]
+        directories.sort()
+        for name in sorted(files):
+            host_path = os.path.join(directory, name)
+            file_stat = os.lstat(host_path)
+            if stat.S_ISREG(file_stat.st_mode):
+                yield '/' + os.path.relpath(host_path, custom_root_directory), host_path, file_stat
+
+
+def get_directory_prefixes(path):
+    parts = path.strip('/').split('/')[:-1]
+    return ['/' + '/'.join(parts[:depth]) for depth in range(1, min(len(parts), DIRECTORY_DEPTH) + 1)]
+
+
+def add_size(totals, key, size, compressed):
+    entry = totals.setdefault(key, {"files": 0, "bytes": 0, "compressed": 0})
+    entry['files'] += 1
+    entry['bytes'] += size
+    entry['compressed'] += compressed
+
+
+@trace_stage
+def create_size_report(custom_root_directory, compression):
+    """
+    Return the size report of the rootfs:
+    {'compression', 'total', 'packages': [...], 'directories': [...]}
+    with the entries sorted by estimated compressed size
+    """
+    owners = get_file_owners(custom_root_directory)
+    installed = get_installed_packages(custom_root_directory)
+    compressor = get_block_compressor(compression)
+
+    # hard links are stored once in the squashfs
+    files = []
+    inodes = set()
+    for path, host_path, file_stat in iter_rootfs_files(custom_root_directory):
+        if (file_stat.st_dev, file_stat.st_ino) in inodes:
+            continue
+        inodes.add((file_stat.st_dev, file_stat.st_ino))
+        files.append((path, host_path, file_stat.st_size))
+
+    # zlib and lzma release the GIL while they compress
+    with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        estimates = executor.map(lambda file: estimate_compressed_size(file[1], compressor, SAMPLE_SIZE)
+                if file[2] else 0, files, chunksize=64)
+        packages = {}
+        directories = {}
+        total = {"files": 0, "bytes": 0, "compressed": 0}
+        for (path, host_path, size), compressed in zip(files, estimates):
+            add_size(packages, owners.get(path, UNOWNED), size, compressed)
+            for prefix in get_directory_prefixes(path):
+                add_size(directories, prefix, size, compressed)
+            total['files'] += 1
+            total['bytes'] += size
+            total['compressed'] += compressed
+
+    def get_sorted(totals, key_name):
+        return sorted((dict(entry, **{key_name: key}) for key, entry in totals.items()),
+                key=lambda entry: (-entry['compressed'], entry[key_name]))
+
+    report = {"compression": compression, "total": total,
+            "packages": get_sorted(packages, 'name'),
+            "directories": get_sorted(directories, 'path')}
+    for entry in report['packages']:
+        entry['version'] = installed.get(entry['name'], {}).get('Version')
+
+    logger.info("rootfs: %d files, %.1fMB, estimated %.1fMB in squashfs", total['files'],
+            total['bytes'] / 1024 / 1024, total['compressed'] / 1024 / 1024)
+    return report
+
+
+def diff_reports(old_report, new_report):
+    """
+    Return the packages whose size changed from old_report to new_report,
+    sorted by the change of the compressed size
+    """
+    old_packages = {entry['name']: entry for entry in old_report['packages']}
+    new_packages = {entry['name']: entry for entry in new_report['packages']}
+    empty = {"bytes": 0, "compressed": 0, "version": None}
+
+    changes = []
+    for name in set(old_packages) | set(new_packages):
+        old = old_packages.get(name, empty)
+        new = new_packages.get(name, empty)
+        change = {"name": name, "old_version": old.get('version'), "new_version": new.get('version'),
+                "bytes": new['bytes'] - old['bytes'], "compressed": new['compressed'] - old['compressed']}
+        if change['bytes'] or change['compressed'] or change['old_version'] != change['new_version']:
+            changes.append(change)
+
+    changes.sort(key=lambda change: (-abs(change['compressed']), change['name']))
+    return {"bytes": new_report['total']['bytes'] - old_report['total']['bytes'],
+            "compressed": new_report['total']['compressed'] - old_report['total']['compressed'],
+            "packages": changes}
+
+
+def get_base_report_path(cache_directory, iso_file_path, compression):
+    """
+    Return the path of the cached base report, keyed by the squashfs
+    superblock so a renamed or downloaded again ISO still hits the cache
+    """
+    try:
+        with open_image(iso_file_path) as image:
+            key = "%s %s" % (image.get_key(), compression)
+    except (OSError, ValueError):
+        iso_stat = os.stat(iso_file_path)
+        key = "%s %d %d %s" % (os.path.basename(iso_file_path), iso_stat.st_size, iso_stat.st_mtime,
+                compression)
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_directory, REPORT_DIRECTORY, "base-%s.json" % digest)
+
+
+def get_base_report(custom_root_directory, iso_file_path, compression, cache_directory=None):
+    """
+    Return the size report of the extracted base image, cached by the ISO and compressor
+    """
+    report_path = None
+    if cache_directory:
+        report_path = get_base_report_path(cache_directory, iso_file_path, compression)
+        report = load_report(report_path)
+        if report:
+            return report
+
+    report = create_size_report(custom_root_directory, compression)
+    if report_path:
+        save_report(report_path, report)
+    return report
+
+
+def get_previous_report_path(cache_directory, variant):
+    return os.path.join(cache_directory, REPORT_DIRECTORY, "%s.json" % variant)
+
+
+def load_report(report_path):
+    if not os.path.isfile(report_path):
+        return None
+    try:
+        with open(report_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def save_report(report_path, report):
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path + '.tmp', 'w') as f:
+        json.dump(report, f)
+    os.replace(report_path + '.tmp', report_path)
+
+
+def format_size(size):
+    return "%+.1f" % (size / 1024 / 1024) if size < 0 else "%.1f" % (size / 1024 / 1024)
+
+
+def get_html_table(title, columns, rows):
+    lines = ["<h2>%s</h2>" % html.escape(title), "<table>",
+            "<tr>%s</tr>" % ''.join("<th>%s</th>" % html.escape(column) for column in columns)]
+    for row in rows[:HTML_ROWS]:
+        lines.append("<tr>%s</tr>" % ''.join("<td>%s</td>" % html.escape(str(value)) for value in row))
+    if len(rows) > HTML_ROWS:
+        lines.append("<tr><td colspan=\"%d\">%d more in the JSON report</td></tr>"
+                % (len(columns), len(rows) - HTML_ROWS))
+    lines.append("</table>")
+    return lines
+
+
+def get_diff_rows(diff):
+    return [(change['name'], change['old_version'] or '-', change['new_version'] or '-',
+            "%+.1f" % (change['bytes'] / 1024 / 1024), "%+.1f" % (change['compressed'] / 1024 / 1024))
+            for change in diff['packages']]
+
+
+def write_size_report(report, json_path, html_path):
+    """
+    Write the report with its diffs ('base', 'previous') as JSON and HTML
+    """
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    total = report['total']
+    lines = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\"><title>Size report</title>",
+            "<style>table{border-collapse:collapse}td,th{border:1px solid #ccc;padding:2px 8px}"
+            "td:not(:first-child){text-align:right}</style></head><body>",
+            "<h1>Size report</h1>",
+            "<p>%d files, %s MB, estimated %s MB in filesystem.squashfs (%s)</p>"
+            % (total['files'], format_size(total['bytes']), format_size(total['compressed']),
+               html.escape(report['compression']))]
+    lines += get_html_table("Packages", ["package", "version", "files", "MB", "compressed MB"],
+            [(entry['name'], entry['version'] or '-', entry['files'], format_size(entry['bytes']),
+              format_size(entry['compressed'])) for entry in report['packages']])
+    lines += get_html_table("Directories", ["directory", "files", "MB", "compressed MB"],
+            [(entry['path'], entry['files'], format_size(entry['bytes']), format_size(entry['compressed']))
+             for entry in report['directories']])
+    columns = ["package", "old version", "new version", "MB", "compressed MB"]
+    for key, title in [('base', "Changes from the base image"), ('previous', "Changes from the previous build")]:
+        diff = report.get(key)
+        if diff:
+            lines += get_html_table("%s: %+.1f MB compressed" % (title, diff['compressed'] / 1024 / 1024),
+                    columns, get_diff_rows(diff))
+    lines.append("</body></html>")
+
+    with open(html_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    logger.info("Size report in %s", json_path)
+
+
+def report_sizes(custom_root_directory, compression, base_report, cache_directory, variant, output_path):
+    """
+    Create the size report of the customized rootfs with the diffs to the
+    base image and the previous build, write it next to output_path and
+    keep it for the next build of the variant
+    """
+    report = create_size_report(custom_root_directory, compression)
+    if base_report:
+        report['base'] = diff_reports(base_report, report)
+
+    previous_path = get_previous_report_path(cache_directory, variant) if cache_directory else None
+    if previous_path:
+        previous = load_report(previous_path)
+        if previous and previous.get('compression') == compression:
+            report['previous'] = diff_reports(previous, report)
+        save_report(previous_path, {key: report[key] for key in ['compression', 'total', 'packages']})
+
+    base_path = os.path.splitext(output_path)[0]
+    write_size_report(report, base_path + '.sizes.json', base_path + '.sizes.html')
+    for key, title in [('base', "base image"), ('previous', "previous build")]:
+        if key in report:
+            logger.info("Change from the %s: %+.1fMB, estimated %+.1fMB in squashfs", title,
+                    report[key]['bytes'] / 1024 / 1024, report[key]['compressed'] / 1024 / 1024)
+    return report
@@ -0,0 +1,193 @@
+"""
+Slimming of the rootfs by named profiles, between the package installation
+and create_squashfs(). A profile is a list of dpkg path-exclude and
+path-include rules, the last matching rule of a path wins as in dpkg:
+
+docs - usr/share/doc except the copyright files
+man - manual and info pages
+locales - translations except the languages in slim_locales
+apt - apt lists and package caches
+caches - old debconf and dpkg databases, man cache, logs
+
+The rules of the profiles marked DPKG_PROFILES are installed in
+etc/dpkg/dpkg.cfg.d before the packages, so the excluded files of new
+packages are never unpacked. After the installation the files of the base
+image matching a profile are removed and the saved bytes and estimated
+squashfs bytes of each profile are reported.
+
+set_dpkg_excludes() - path-exclude rules for dpkg in the rootfs
+slim_rootfs() - remove the files of the profiles and report the savings
+"""
+
+import fnmatch
+import json
+import os
+import re
+
+from utilities.logger import create_logger
+from utilities.telemetry import trace_stage
+from utilities.errors import BuildError
+from utilities.compressed_size import get_block_compressor, estimate_compressed_size
+
+logger = create_logger(__name__)
+
+EXCLUDE = "exclude"
+INCLUDE = "include"
+
+SLIM_PROFILES = {
+    "docs": [
+        (EXCLUDE, "/usr/share/doc/*"),
+        (INCLUDE, "/usr/share/doc/*/copyright"),
+        (EXCLUDE, "/usr/share/doc-base/*"),
+        (EXCLUDE, "/usr/share/gtk-doc/*"),
+        (EXCLUDE, "/usr/share/help/*"),
+    ],
+    "man": [
+        (EXCLUDE, "/usr/share/man/*"),
+        (EXCLUDE, "/usr/share/info/*"),
+        (EXCLUDE, "/usr/share/lintian/*"),
+        (EXCLUDE, "/usr/share/linda/*"),
+    ],
+    # the kept languages are added by get_profile_rules
+    "locales": [
+        (EXCLUDE, "/usr/share/locale/*"),
+        (INCLUDE, "/usr/share/locale/locale.alias"),
+    ],
+    "apt": [
+        (EXCLUDE, "/var/lib/apt/lists/*"),
+        (INCLUDE, "/var/lib/apt/lists/lock"),
+        (EXCLUDE, "/var/cache/apt/*.bin"),
+        (EXCLUDE, "/var/cache/apt/archives/*.deb"),
+    ],
+    "caches": [
+        (EXCLUDE, "/var/cache/debconf/*-old"),
+        (EXCLUDE, "/var/lib/dpkg/*-old"),
+        (EXCLUDE, "/var/cache/man/*"),
+        (EXCLUDE, "/var/log/*.log"),
+        (EXCLUDE, "/var/log/apt/*"),
+    ],
+}
+# profiles whose rules are given to dpkg before the packages are installed
+DPKG_PROFILES = ["docs", "man", "locales"]
+DPKG_EXCLUDES_FILE = os.path.join("etc", "dpkg", "dpkg.cfg.d", "ubuntu-image-slim")
+# bytes of a file which are compressed for the estimate
+ESTIMATE_LIMIT = 4 * 1024 * 1024
+WILDCARD = re.compile(r'[*?\[]')
+
+
+def get_profile_rules(profile, locales=()):
+    """
+    Return the rules of the profile
+    """
+    if profile not in SLIM_PROFILES:
+        raise BuildError("Unknown slim profile %s, known profiles: %s"
+                % (profile, ', '.join(sorted(SLIM_PROFILES))))
+
+    rules = list(SLIM_PROFILES[profile])
+    if profile == "locales":
+        rules += [(INCLUDE, "/usr/share/locale/%s*" % locale) for locale in locales]
+    return rules
+
+
+def is_excluded(path, rules):
+    """
+    Return True if the last rule matching the absolute path of the rootfs is an exclude
+    """
+    excluded = False
+    for kind, pattern in rules:
+        if fnmatch.fnmatchcase(path, pattern):
+            excluded = kind == EXCLUDE
+    return excluded
+
+
+def set_dpkg_excludes(custom_root_directory, profiles, locales=()):
+    """
+    Write the rules of the dpkg profiles to etc/dpkg/dpkg.cfg.d of the
+    rootfs. They are kept in the image, the later installations are slim too.
+    """
+    config_path = os.path.join(custom_root_directory, DPKG_EXCLUDES_FILE)
+    lines = []
+    for profile in profiles:
+        if profile in DPKG_PROFILES:
+            lines += ["path-%s=%s" % rule for rule in get_profile_rules(profile, locales)]
+
+    if not lines:
+        if os.path.exists(config_path):
+            os.remove(config_path)
+        return
+
+    logger.info("dpkg excludes the files of %s", ', '.join(p for p in profiles if p in DPKG_PROFILES))
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    with open(config_path, 'w') as f:
+        f.write("# written by ubuntu-image, see slim in config.json\n")
+        f.write('\n'.join(lines) + '\n')
+
+
+def get_walk_roots(rules):
+    """
+    Return the directories below which the exclude rules can match
+    """
+    roots = set()
+    for kind, pattern in rules:
+        if kind != EXCLUDE:
+            continue
+        match = WILDCARD.search(pattern)
+        prefix = pattern[:match.start()] if match else pattern
+        roots.add(prefix if prefix.endswith('/') else os.path.dirname(prefix) + '/')
+    # a root below another root is walked with it
+    return sorted(root for root in roots
+            if not any(root != other and root.startswith(other) for other in roots))
+
+
+def iter_profile_files(custom_root_directory, rules):
+    """
+    Yield (absolute path in the rootfs, host path) of the files excluded by the rules
+    """
+    for root in get_walk_roots(rules):
+        host_root = os.path.join(custom_root_directory, root.lstrip('/'))
+        if not os.path.isdir(host_root) or os.path.islink(host_root.rstrip('/')):
+            continue
+        for directory, directories, files in os.walk(host_root):
+            directories.sort()
+            for name in sorted(files):
+                host_path = os.path.join(directory, name)
+                path = '/' + os.path.relpath(host_path, custom_root_directory)
+                if is_excluded(path, rules):
+                    yield path, host_path
+
+
+@trace_stage
+def slim_rootfs(custom_root_directory, profiles, locales=(), compression='gzip', report_path=None):
+    """
+    Remove the files of the profiles from the rootfs.
+    Return dictionary of profile to {'files', 'bytes', 'compressed'} where
+    compressed is the estimated size saved in filesystem.squashfs.
+    """
+    compressor = get_block_compressor(compression)
+    report = {}
+    for profile in profiles:
+        rules = get_profile_rules(profile, locales)
+        saved = {"files": 0, "bytes": 0, "compressed": 0}
+        inodes = set()
+        for path, host_path in iter_profile_files(custom_root_directory, rules):
+            stat = os.lstat(host_path)
+            # hard links are stored once in the squashfs
+            if os.path.isfile(host_path) and not os.path.islink(host_path) \
+                    and (stat.st_dev, stat.st_ino) not in inodes:
+                inodes.add((stat.st_dev, stat.st_ino))
+                saved['bytes'] += stat.st_size
+                saved['compressed'] += estimate_compressed_size(host_path, compressor, ESTIMATE_LIMIT)
+            os.remove(host_path)
+            saved['files'] += 1
+
+        logger.info("slim %s: %d files, %.1fMB, %.1fMB in squashfs", profile, saved['files'],
+                saved['bytes'] / 1024 / 1024, saved['compressed'] / 1024 / 1024)
+        report[profile] = saved
+
+    if report_path:
+        total = {key: sum(saved[key] for saved in report.values())
+                for key in ["files", "bytes", "compressed"]}
+        with open(report_path, 'w') as f:
+            json.dump({"compression": compression, "profiles": report, "total": total}, f, indent=4)
+        logger.info("Slim report in %s", report_path)
+    return report
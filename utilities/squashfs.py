@@ -0,0 +1,1185 @@
+"""
+squashfs 4.0 in process. The reader reads the superblock, the inode,
+directory, fragment and id tables and the data blocks of an image, also
+inside an ISO at an offset. The writer creates a flat filesystem.squashfs
+from a directory like mksquashfs and copies the compressed data blocks and
+fragments of the files which are unchanged from a base image verbatim, so
+only the new and modified files are compressed.
+
+A file of custom-root is unchanged if the base image has a regular file at
+the same path with the same size and mtime, and either its inode and ctime
+are the same as in the snapshot taken right after the base image was
+extracted, or its checksum is the checksum of the decompressed base file.
+
+SquashfsImage - reader of an image: lookup(), list_directory(), read_file(),
+                read_xattrs() and extract() of single paths without unsquashfs
+open_image() - reader of a squashfs file or of filesystem.squashfs of an ISO
+snapshot_tree() - inode and ctime of the files right after the extraction
+write_squashfs() - create an image, reusing the blocks of a base image
+"""
+
+import collections
+import concurrent.futures
+import fnmatch
+import functools
+import hashlib
+import lzma
+import os
+import stat
+import struct
+import time
+import zlib
+
+from utilities.logger import create_logger
+from utilities.iso import find_iso_file
+
+logger = create_logger(__name__)
+
+try:
+    # Python 3.14
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+SQUASHFS_MAGIC = 0x73717368
+SUPERBLOCK_FORMAT = '<IIIIIHHHHHHQQQQQQQQ'
+SUPERBLOCK_SIZE = 96
+METADATA_SIZE = 8192
+METADATA_UNCOMPRESSED = 0x8000
+DATA_UNCOMPRESSED = 0x1000000
+DATA_SIZE_MASK = 0xFFFFFF
+INVALID_BLOCK = 0xFFFFFFFFFFFFFFFF
+INVALID_FRAGMENT = 0xFFFFFFFF
+INVALID_XATTR = 0xFFFFFFFF
+DEFAULT_BLOCK_SIZE = 128 * 1024
+PADDING = 4096
+# entries of a directory header
+DIRECTORY_HEADER_ENTRIES = 256
+
+# superblock flags
+FLAG_NO_XATTRS = 0x0200
+FLAG_COMPRESSOR_OPTIONS = 0x0400
+FLAG_DUPLICATES = 0x0040
+
+COMPRESSION_IDS = {"gzip": 1, "lzma": 2, "lzo": 3, "xz": 4, "lz4": 5, "zstd": 6}
+COMPRESSION_NAMES = {value: key for key, value in COMPRESSION_IDS.items()}
+GZIP_LEVEL = 9
+GZIP_WINDOW_SIZE = 15
+XZ_PRESET = 6
+ZSTD_LEVEL = 15
+
+# inode types, the extended types are the basic type + 7
+DIRECTORY = 1
+FILE = 2
+SYMLINK = 3
+BLOCK_DEVICE = 4
+CHARACTER_DEVICE = 5
+FIFO = 6
+SOCKET = 7
+EXTENDED = 7
+FILE_TYPES = {stat.S_IFDIR: DIRECTORY, stat.S_IFREG: FILE, stat.S_IFLNK: SYMLINK,
+        stat.S_IFBLK: BLOCK_DEVICE, stat.S_IFCHR: CHARACTER_DEVICE, stat.S_IFIFO: FIFO,
+        stat.S_IFSOCK: SOCKET}
+MODE_TYPES = {value: key for key, value in FILE_TYPES.items()}
+XATTR_PREFIXES = {"user.": 0, "trusted.": 1, "security.": 2}
+XATTR_VALUE_OUT_OF_LINE = 0x100
+
+CASPER_SQUASHFS = "casper/filesystem.squashfs"
+MAX_SYMLINK_HOPS = 40
+
+# a base fragment is copied if the unchanged files use this part of it
+FRAGMENT_REUSE_RATIO = 0.5
+WORKERS = os.cpu_count() or 4
+
+
+def get_decompressor(compression_id, options=None):
+    """
+    Return function decompressing a block of the compressor
+    """
+    name = COMPRESSION_NAMES.get(compression_id)
+    if name == 'gzip':
+        return zlib.decompress
+    if name == 'xz':
+        return lambda data: lzma.decompress(data, format=lzma.FORMAT_XZ)
+    if name == 'lzma':
+        return lambda data: lzma.decompress(data, format=lzma.FORMAT_ALONE)
+    if name == 'zstd' and zstd:
+        return zstd.decompress
+    raise ValueError("Cannot decompress %s squashfs in Python" % (name or compression_id))
+
+
+def get_compressor(compression, block_size, options=None):
+    """
+    Return function compressing a block like mksquashfs, with the
+    compressor options of a base image if given
+    """
+    if compression == 'gzip':
+        level, window_size = GZIP_LEVEL, GZIP_WINDOW_SIZE
+        if options and len(options) >= 6:
+            level, window_size = struct.unpack_from('<IH', options)
+
+        def compress(data):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, window_size)
+            return compressor.compress(data) + compressor.flush()
+        return compress
+
+    if compression == 'xz':
+        # the kernel allocates the dictionary by the block size or the options
+        dictionary_size = block_size
+        if options and len(options) >= 4:
+            dictionary_size = struct.unpack_from('<I', options)[0]
+        filters = [{"id": lzma.FILTER_LZMA2, "preset": XZ_PRESET, "dict_size": dictionary_size}]
+        return lambda data: lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32,
+                filters=filters)
+
+    if compression == 'zstd' and zstd:
+        return lambda data: zstd.compress(data, level=ZSTD_LEVEL)
+    raise ValueError("Cannot compress %s squashfs in Python" % compression)
+
+
+def can_write(compression):
+    try:
+        get_compressor(compression, DEFAULT_BLOCK_SIZE)
+    except ValueError:
+        return False
+    return True
+
+
+class Inode:
+    """
+    An inode of the image. The fields of its type are set by SquashfsImage.read_inode
+    """
+    def __init__(self, inode_type, mode, uid, gid, mtime, number):
+        self.type = inode_type
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.mtime = mtime
+        self.number = number
+        self.nlink = 1
+        self.xattr = INVALID_XATTR
+        self.size = 0
+
+    @property
+    def basic_type(self):
+        return self.type - EXTENDED if self.type > EXTENDED else self.type
+
+    def is_directory(self):
+        return self.basic_type == DIRECTORY
+
+    def is_file(self):
+        return self.basic_type == FILE
+
+    def is_symlink(self):
+        return self.basic_type == SYMLINK
+
+    def get_file_mode(self):
+        return MODE_TYPES[self.basic_type] | self.mode
+
+
+class MetadataStream:
+    """
+    Read the uncompressed bytes of a table from (block, offset)
+    """
+    def __init__(self, image, table_start, block, offset):
+        self.image = image
+        self.position = table_start + block
+        self.data = b''
+        self.offset = offset
+        self.next_position = self.position
+
+    def read(self, size):
+        result = b''
+        while len(result) < size:
+            if self.offset >= len(self.data):
+                if self.data:
+                    self.position = self.next_position
+                    self.offset = 0
+                self.data, self.next_position = self.image.read_metadata_block(self.position)
+                if not self.data:
+                    raise ValueError("Metadata at %d is empty" % self.position)
+            chunk = self.data[self.offset:self.offset + size - len(result)]
+            self.offset += len(chunk)
+            result += chunk
+        return result
+
+    def unpack(self, format):
+        return struct.unpack(format, self.read(struct.calcsize(format)))
+
+
+class SquashfsImage:
+    """
+    squashfs 4.0 image in file_path at offset, e.g. filesystem.squashfs in an ISO
+    """
+    def __init__(self, file_path, offset=0):
+        self.file_path = file_path
+        self.offset = offset
+        self.fd = os.open(file_path, os.O_RDONLY)
+        self.xattr_table = None
+        # the caches belong to the image, a cache of the class would keep every image alive
+        self.read_cached_metadata_block = functools.lru_cache(maxsize=256)(self.load_metadata_block)
+        self.read_fragment = functools.lru_cache(maxsize=64)(self.load_fragment)
+        try:
+            self.read_superblock()
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.read_cached_metadata_block.cache_clear()
+        self.read_fragment.cache_clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def pread(self, position, size):
+        data = os.pread(self.fd, size, self.offset + position)
+        if len(data) != size:
+            raise ValueError("Cannot read %d bytes at %d of %s" % (size, position, self.file_path))
+        return data
+
+    def read_superblock(self):
+        fields = struct.unpack(SUPERBLOCK_FORMAT, self.pread(0, SUPERBLOCK_SIZE))
+        (magic, self.inode_count, self.mtime, self.block_size, self.fragment_count,
+                self.compression_id, self.block_log, self.flags, self.id_count, major, minor,
+                self.root_inode, self.bytes_used, self.id_table_start, self.xattr_id_table_start,
+                self.inode_table_start, self.directory_table_start, self.fragment_table_start,
+                self.export_table_start) = fields
+        if magic != SQUASHFS_MAGIC:
+            raise ValueError("%s is not a squashfs image" % self.file_path)
+        if (major, minor) != (4, 0):
+            raise ValueError("squashfs %d.%d is not supported" % (major, minor))
+
+        self.compression = COMPRESSION_NAMES.get(self.compression_id)
+        # the options are an uncompressed metadata block after the superblock
+        self.options = None
+        self.options_block = None
+        if self.flags & FLAG_COMPRESSOR_OPTIONS:
+            header = struct.unpack('<H', self.pread(SUPERBLOCK_SIZE, 2))[0]
+            size = header & ~METADATA_UNCOMPRESSED
+            self.options_block = self.pread(SUPERBLOCK_SIZE, 2 + size)
+            self.options = self.options_block[2:]
+        self.decompress = get_decompressor(self.compression_id, self.options)
+        self.ids = list(struct.unpack('<%dI' % self.id_count,
+                self.read_lookup_table(self.id_table_start, self.id_count * 4)))
+        fragments = self.read_lookup_table(self.fragment_table_start, self.fragment_count * 16)
+        self.fragments = [struct.unpack_from('<QI', fragments, number * 16)
+                for number in range(self.fragment_count)]
+
+    def read_metadata_block(self, position):
+        """
+        Return the uncompressed metadata block at position and the position of the next one
+        """
+        return self.read_cached_metadata_block(position)
+
+    def load_metadata_block(self, position):
+        header = struct.unpack('<H', self.pread(position, 2))[0]
+        size = header & ~METADATA_UNCOMPRESSED
+        data = self.pread(position + 2, size)
+        if not header & METADATA_UNCOMPRESSED:
+            data = self.decompress(data)
+        return data, position + 2 + size
+
+    def read_lookup_table(self, table_start, size):
+        """
+        Return size bytes of a table stored in metadata blocks listed at table_start
+        """
+        if not size:
+            return b''
+        count = -(-size // METADATA_SIZE)
+        positions = struct.unpack('<%dQ' % count, self.pread(table_start, count * 8))
+        data = b''.join(self.read_metadata_block(position)[0] for position in positions)
+        return data[:size]
+
+    def read_inode(self, reference):
+        stream = MetadataStream(self, self.inode_table_start, reference >> 16, reference & 0xFFFF)
+        inode_type, mode, uid, gid, mtime, number = stream.unpack('<HHHHII')
+        inode = Inode(inode_type, mode, self.ids[uid], self.ids[gid], mtime, number)
+        inode.reference = reference
+
+        if inode_type == DIRECTORY:
+            inode.start_block, inode.nlink, inode.size, inode.offset, inode.parent = \
+                    stream.unpack('<IIHHI')
+        elif inode_type == DIRECTORY + EXTENDED:
+            (inode.nlink, inode.size, inode.start_block, inode.parent, index_count, inode.offset,
+                    inode.xattr) = stream.unpack('<IIIIHHI')
+        elif inode_type in (FILE, FILE + EXTENDED):
+            if inode_type == FILE:
+                inode.blocks_start, inode.fragment, inode.fragment_offset, inode.size = \
+                        stream.unpack('<IIII')
+            else:
+                (inode.blocks_start, inode.size, inode.sparse, inode.nlink, inode.fragment,
+                        inode.fragment_offset, inode.xattr) = stream.unpack('<QQQIIII')
+            count = self.get_block_count(inode.size, inode.fragment)
+            inode.block_sizes = list(stream.unpack('<%dI' % count)) if count else []
+        elif inode_type in (SYMLINK, SYMLINK + EXTENDED):
+            inode.nlink, target_size = stream.unpack('<II')
+            inode.target = stream.read(target_size)
+            inode.size = target_size
+            if inode_type == SYMLINK + EXTENDED:
+                inode.xattr = stream.unpack('<I')[0]
+        elif inode.basic_type in (BLOCK_DEVICE, CHARACTER_DEVICE):
+            inode.nlink, inode.rdev = stream.unpack('<II')
+            if inode_type > EXTENDED:
+                inode.xattr = stream.unpack('<I')[0]
+        elif inode.basic_type in (FIFO, SOCKET):
+            inode.nlink = stream.unpack('<I')[0]
+            if inode_type > EXTENDED:
+                inode.xattr = stream.unpack('<I')[0]
+        else:
+            raise ValueError("Unknown inode type %d" % inode_type)
+        return inode
+
+    def get_block_count(self, size, fragment):
+        if fragment == INVALID_FRAGMENT:
+            return -(-size // self.block_size)
+        return size // self.block_size
+
+    def iter_directory(self, inode):
+        """
+        Yield (name, inode reference, basic type) of the entries of a directory inode
+        """
+        remaining = inode.size - 3
+        if remaining <= 0:
+            return
+        stream = MetadataStream(self, self.directory_table_start, inode.start_block, inode.offset)
+        while remaining > 0:
+            count, start, base_number = stream.unpack('<III')
+            remaining -= 12
+            for _ in range(count + 1):
+                offset, number_offset, entry_type, name_size = stream.unpack('<HhHH')
+                name = stream.read(name_size + 1)
+                remaining -= 8 + name_size + 1
+                yield os.fsdecode(name), (start << 16) | offset, entry_type
+
+    def walk(self, reference=None, path=''):
+        """
+        Yield (path relative to the root, inode) of the image in directory order
+        """
+        inode = self.read_inode(self.root_inode if reference is None else reference)
+        yield path, inode
+        if not inode.is_directory():
+            return
+        for name, child_reference, entry_type in self.iter_directory(inode):
+            child_path = name if not path else path + '/' + name
+            if entry_type == DIRECTORY:
+                yield from self.walk(child_reference, child_path)
+            else:
+                yield child_path, self.read_inode(child_reference)
+
+    def read_block(self, position, word):
+        """
+        Return the uncompressed data block of the size word at position
+        """
+        size = word & DATA_SIZE_MASK
+        if not size:
+            return bytes(self.block_size)
+        data = self.pread(position, size)
+        return data if word & DATA_UNCOMPRESSED else self.decompress(data)
+
+    def load_fragment(self, index):
+        start, word = self.fragments[index]
+        return self.read_block(start, word)
+
+    def iter_file(self, inode):
+        """
+        Yield the data of a regular file inode
+        """
+        position = inode.blocks_start
+        remaining = inode.size
+        for word in inode.block_sizes:
+            data = self.read_block(position, word)[:remaining]
+            position += word & DATA_SIZE_MASK
+            remaining -= len(data)
+            yield data
+        if inode.fragment != INVALID_FRAGMENT and remaining > 0:
+            yield self.read_fragment(inode.fragment)[inode.fragment_offset:inode.fragment_offset + remaining]
+
+    def get_data_size(self, inode):
+        return sum(word & DATA_SIZE_MASK for word in inode.block_sizes)
+
+    def get_key(self):
+        """
+        Return a digest of the superblock, it changes with the content of the image
+        """
+        return hashlib.sha256(self.pread(0, SUPERBLOCK_SIZE)).hexdigest()
+
+    def find_entry(self, directory, name):
+        for entry_name, reference, entry_type in self.iter_directory(directory):
+            if entry_name == name:
+                return self.read_inode(reference)
+        return None
+
+    def lookup(self, path, follow_symlinks=True):
+        """
+        Return the inode of the absolute or root relative path, or None if
+        not found. The symlinks of the directories are always followed, the
+        one of the last component if follow_symlinks.
+        """
+        parts = [part for part in path.split('/') if part and part != '.']
+        parents = []
+        inode = self.read_inode(self.root_inode)
+        hops = 0
+        while parts:
+            name = parts.pop(0)
+            if name == '..':
+                if parents:
+                    inode = parents.pop()
+                continue
+            if not inode.is_directory():
+                return None
+            child = self.find_entry(inode, name)
+            if child is None:
+                return None
+            if child.is_symlink() and (parts or follow_symlinks):
+                hops += 1
+                if hops > MAX_SYMLINK_HOPS:
+                    raise ValueError("Too many levels of symbolic links in %s" % path)
+                target = os.fsdecode(child.target)
+                if target.startswith('/'):
+                    parents = []
+                    inode = self.read_inode(self.root_inode)
+                parts = [part for part in target.split('/') if part and part != '.'] + parts
+                continue
+            parents.append(inode)
+            inode = child
+        return inode
+
+    def get_inode(self, path, follow_symlinks=True):
+        inode = self.lookup(path, follow_symlinks)
+        if inode is None:
+            raise FileNotFoundError("%s is not in %s" % (path, self.file_path))
+        return inode
+
+    def list_directory(self, path):
+        """
+        Return list of (name, inode) of a directory of the image
+        """
+        inode = self.get_inode(path)
+        if not inode.is_directory():
+            raise NotADirectoryError("%s is not a directory in %s" % (path, self.file_path))
+        return [(name, self.read_inode(reference))
+                for name, reference, entry_type in self.iter_directory(inode)]
+
+    def read_file(self, path, max_size=None):
+        """
+        Return the content of a regular file of the image, up to max_size bytes
+        """
+        inode = self.get_inode(path)
+        if not inode.is_file():
+            raise IsADirectoryError("%s is not a regular file in %s" % (path, self.file_path))
+        data = bytearray()
+        for chunk in self.iter_file(inode):
+            data += chunk
+            if max_size is not None and len(data) >= max_size:
+                return bytes(data[:max_size])
+        return bytes(data)
+
+    def read_xattrs(self, inode):
+        """
+        Return list of (name, value) of the xattrs of the inode
+        """
+        if inode.xattr == INVALID_XATTR or self.xattr_id_table_start == INVALID_BLOCK:
+            return []
+        if self.xattr_table is None:
+            table_start, count = struct.unpack('<QI', self.pread(self.xattr_id_table_start, 12))
+            ids = self.read_lookup_table(self.xattr_id_table_start + 16, count * 16)
+            self.xattr_table = (table_start,
+                    [struct.unpack_from('<QII', ids, number * 16) for number in range(count)])
+        table_start, ids = self.xattr_table
+
+        reference, count, size = ids[inode.xattr]
+        stream = MetadataStream(self, table_start, reference >> 16, reference & 0xFFFF)
+        prefixes = {value: key for key, value in XATTR_PREFIXES.items()}
+        xattrs = []
+        for _ in range(count):
+            prefix, name_size = stream.unpack('<HH')
+            name = prefixes[prefix & ~XATTR_VALUE_OUT_OF_LINE] + os.fsdecode(stream.read(name_size))
+            value_size = stream.unpack('<I')[0]
+            value = stream.read(value_size)
+            if prefix & XATTR_VALUE_OUT_OF_LINE:
+                value_reference = struct.unpack('<Q', value)[0]
+                value_stream = MetadataStream(self, table_start, value_reference >> 16,
+                        value_reference & 0xFFFF)
+                value = value_stream.read(value_stream.unpack('<I')[0])
+            xattrs.append((name, value))
+        return xattrs
+
+    def extract(self, path, target_path):
+        """
+        Extract a path of the image to target_path, directories with their
+        content. The mode, mtime and xattrs are kept, the owners if run as root.
+        Return the number of extracted inodes.
+        """
+        inode = self.get_inode(path, follow_symlinks=False)
+        return self.extract_inode(inode, target_path)
+
+    def extract_inode(self, inode, target_path):
+        count = 1
+        if inode.is_directory():
+            os.makedirs(target_path, exist_ok=True)
+            for name, reference, entry_type in self.iter_directory(inode):
+                count += self.extract_inode(self.read_inode(reference), os.path.join(target_path, name))
+        elif inode.is_file():
+            with open(target_path, 'wb') as f:
+                for chunk in self.iter_file(inode):
+                    f.write(chunk)
+        elif inode.is_symlink():
+            if os.path.lexists(target_path):
+                os.remove(target_path)
+            os.symlink(inode.target, target_path)
+        elif os.geteuid() == 0:
+            os.mknod(target_path, inode.get_file_mode(), getattr(inode, 'rdev', 0))
+        else:
+            logger.debug("Skip the special file %s", target_path)
+            return 0
+
+        if os.geteuid() == 0:
+            os.chown(target_path, inode.uid, inode.gid, follow_symlinks=False)
+        if not inode.is_symlink():
+            os.chmod(target_path, inode.mode)
+        for name, value in self.read_xattrs(inode):
+            try:
+                os.setxattr(target_path, name, value, follow_symlinks=False)
+            except OSError as exception:
+                logger.debug("Cannot set %s of %s: %s", name, target_path, exception)
+        os.utime(target_path, (inode.mtime, inode.mtime), follow_symlinks=False)
+        return count
+
+
+def open_image(file_path):
+    """
+    Return SquashfsImage of a squashfs file, or of casper/filesystem.squashfs
+    if file_path is an ISO
+    """
+    with open(file_path, 'rb') as f:
+        magic = f.read(4)
+    if len(magic) == 4 and struct.unpack('<I', magic)[0] == SQUASHFS_MAGIC:
+        return SquashfsImage(file_path)
+
+    location = find_iso_file(file_path, CASPER_SQUASHFS)
+    if not location:
+        raise ValueError("%s is neither a squashfs nor an ISO with %s" % (file_path, CASPER_SQUASHFS))
+    return SquashfsImage(file_path, location[0])
+
+
+def is_excluded(relative_path, excludes):
+    """
+    Return True if a mksquashfs -wildcards exclude matches the path, * does not match /
+    """
+    parts = relative_path.split('/')
+    for pattern in excludes:
+        pattern_parts = pattern.split('/')
+        if len(pattern_parts) == len(parts) and all(fnmatch.fnmatchcase(part, pattern_part)
+                for part, pattern_part in zip(parts, pattern_parts)):
+            return True
+    return False
+
+
+def snapshot_tree(custom_root_directory):
+    """
+    Return dictionary of the relative path of the regular files to (inode, ctime)
+    """
+    snapshot = {}
+    for directory, directories, files in os.walk(custom_root_directory):
+        for name in files:
+            file_path = os.path.join(directory, name)
+            file_stat = os.lstat(file_path)
+            if stat.S_ISREG(file_stat.st_mode):
+                snapshot[os.path.relpath(file_path, custom_root_directory)] = \
+                        (file_stat.st_ino, file_stat.st_ctime_ns)
+    return snapshot
+
+
+def get_xattrs(host_path):
+    """
+    Return the sorted (name, value) of the xattrs squashfs supports
+    """
+    try:
+        names = os.listxattr(host_path, follow_symlinks=False)
+    except OSError:
+        return ()
+    xattrs = []
+    for name in names:
+        if name.startswith(tuple(XATTR_PREFIXES)):
+            try:
+                xattrs.append((name, os.getxattr(host_path, name, follow_symlinks=False)))
+            except OSError:
+                continue
+    return tuple(sorted(xattrs))
+
+
+class Node:
+    """
+    A file of the source directory and its inode in the new image
+    """
+    def __init__(self, path, host_path, file_stat):
+        self.path = path
+        self.name = os.fsencode(os.path.basename(path))
+        self.host_path = host_path
+        self.stat = file_stat
+        self.children = []
+        self.link = None
+        self.nlink = 1
+        self.number = None
+        self.parent_number = None
+        self.reference = None
+        self.xattrs = get_xattrs(host_path)
+        # data of a regular file: blocks_start, block sizes, fragment, fragment offset
+        self.data = None
+
+    @property
+    def type(self):
+        return FILE_TYPES[stat.S_IFMT(self.stat.st_mode)]
+
+
+def scan_tree(custom_root_directory, excludes):
+    """
+    Return the root node of the directory. A hard link is a node with link
+    set to the first node of its inode.
+    """
+    root = Node('', custom_root_directory, os.lstat(custom_root_directory))
+    links = {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for name in sorted(os.listdir(node.host_path), key=os.fsencode):
+            path = name if not node.path else node.path + '/' + name
+            if is_excluded(path, excludes):
+                continue
+            host_path = os.path.join(node.host_path, name)
+            file_stat = os.lstat(host_path)
+            if stat.S_IFMT(file_stat.st_mode) not in FILE_TYPES:
+                continue
+            child = Node(path, host_path, file_stat)
+            node.children.append(child)
+            if stat.S_ISDIR(file_stat.st_mode):
+                stack.append(child)
+            elif file_stat.st_nlink > 1:
+                key = (file_stat.st_dev, file_stat.st_ino)
+                if key in links:
+                    child.link = links[key]
+                    child.link.nlink += 1
+                else:
+                    links[key] = child
+    return root
+
+
+def number_inodes(node, counter):
+    """
+    Number the inodes children first, the root is the last inode
+    """
+    for child in node.children:
+        if child.link:
+            continue
+        if child.type == DIRECTORY:
+            number_inodes(child, counter)
+        else:
+            counter[0] += 1
+            child.number = counter[0]
+    counter[0] += 1
+    node.number = counter[0]
+
+
+def iter_nodes(node):
+    yield node
+    for child in node.children:
+        yield from iter_nodes(child)
+
+
+def iter_bounded(executor, function, items, window):
+    """
+    Yield (item, function(item)) in order with at most window calls in flight
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append((item, executor.submit(function, item)))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+class MetadataWriter:
+    """
+    Uncompressed bytes of a table written as metadata blocks
+    """
+    def __init__(self, compress):
+        self.compress = compress
+        self.output = bytearray()
+        self.buffer = bytearray()
+
+    def position(self):
+        """
+        Return (block, offset) of the next byte
+        """
+        return len(self.output), len(self.buffer)
+
+    def reference(self):
+        block, offset = self.position()
+        return (block << 16) | offset
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= METADATA_SIZE:
+            self.write_block(bytes(self.buffer[:METADATA_SIZE]))
+            del self.buffer[:METADATA_SIZE]
+
+    def write_block(self, block):
+        compressed = self.compress(block)
+        if len(compressed) < len(block):
+            self.output += struct.pack('<H', len(compressed)) + compressed
+        else:
+            self.output += struct.pack('<H', len(block) | METADATA_UNCOMPRESSED) + block
+
+    def finish(self):
+        if self.buffer:
+            self.write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        return bytes(self.output)
+
+
+class FragmentPacker:
+    """
+    Pack the tails of the files into fragment blocks
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.buffer = bytearray()
+        self.index = None
+
+    def add(self, tail):
+        """
+        Return (fragment index, offset) of the tail
+        """
+        if len(self.buffer) + len(tail) > self.writer.block_size:
+            self.flush()
+        if self.index is None:
+            self.index = self.writer.reserve_fragment()
+        offset = len(self.buffer)
+        self.buffer += tail
+        return self.index, offset
+
+    def flush(self):
+        if self.index is not None and self.buffer:
+            position = self.writer.tell()
+            word = self.writer.write_block(bytes(self.buffer))
+            self.writer.fragments[self.index] = (position, word)
+        self.buffer = bytearray()
+        self.index = None
+
+
+class SquashfsWriter:
+    """
+    Write a squashfs image to f. The data is written first, the tables at the end.
+    """
+    def __init__(self, f, compression, block_size=DEFAULT_BLOCK_SIZE, base=None):
+        self.f = f
+        self.compression = compression
+        self.block_size = block_size
+        self.base = base
+        self.options_block = base.options_block if base else None
+        self.compress = get_compressor(compression, block_size, base.options if base else None)
+        self.fragments = []
+        self.zero_block = bytes(block_size)
+        self.ids = {}
+        self.xattrs = {}
+        self.copied_blocks = {}
+        self.copied_fragments = {}
+        self.duplicates = {}
+        self.statistics = {"reused_files": 0, "reused_bytes": 0, "compressed_files": 0,
+                "compressed_bytes": 0}
+
+        f.seek(0)
+        f.truncate()
+        f.write(bytes(SUPERBLOCK_SIZE))
+        if self.options_block:
+            f.write(self.options_block)
+
+    def tell(self):
+        return self.f.tell()
+
+    def write_block(self, block):
+        """
+        Write a data block, return its size word
+        """
+        compressed = self.compress(block)
+        if len(compressed) < len(block):
+            self.f.write(compressed)
+            return len(compressed)
+        self.f.write(block)
+        return len(block) | DATA_UNCOMPRESSED
+
+    def reserve_fragment(self):
+        self.fragments.append(None)
+        return len(self.fragments) - 1
+
+    def get_id_index(self, value):
+        if value not in self.ids:
+            self.ids[value] = len(self.ids)
+        return self.ids[value]
+
+    def get_xattr_index(self, xattrs):
+        if not xattrs:
+            return INVALID_XATTR
+        if xattrs not in self.xattrs:
+            self.xattrs[xattrs] = len(self.xattrs)
+        return self.xattrs[xattrs]
+
+    def compress_file(self, host_path, size):
+        """
+        Return (sha256, [(size word, data)] of the full blocks, tail) of a file
+        """
+        digest = hashlib.sha256()
+        blocks = []
+        tail = b''
+        with open(host_path, 'rb') as f:
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+                digest.update(block)
+                if len(block) < self.block_size:
+                    tail = block
+                    break
+                if block == self.zero_block:
+                    blocks.append((0, b''))
+                    continue
+                compressed = self.compress(block)
+                if len(compressed) < len(block):
+                    blocks.append((len(compressed), compressed))
+                else:
+                    blocks.append((len(block) | DATA_UNCOMPRESSED, block))
+        return digest.hexdigest(), blocks, tail
+
+    def is_same_file(self, node, inode):
+        """
+        Return True if the file has the content of the base inode
+        """
+        host = hashlib.sha256()
+        with open(node.host_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.block_size), b''):
+                host.update(chunk)
+        base = hashlib.sha256()
+        for chunk in self.base.iter_file(inode):
+            base.update(chunk)
+        return host.digest() == base.digest()
+
+    def write_reused(self, node, inode, fragment_reuse):
+        """
+        Copy the compressed blocks of the base inode
+        """
+        # the duplicate files of the base image share their blocks
+        key = (inode.blocks_start, tuple(inode.block_sizes))
+        data_size = self.base.get_data_size(inode)
+        if not inode.block_sizes:
+            blocks_start = 0
+        elif key in self.copied_blocks:
+            blocks_start = self.copied_blocks[key]
+        else:
+            blocks_start = self.tell()
+            position = inode.blocks_start
+            while position < inode.blocks_start + data_size:
+                size = min(inode.blocks_start + data_size - position, 16 * self.block_size)
+                self.f.write(self.base.pread(position, size))
+                position += size
+            self.copied_blocks[key] = blocks_start
+
+        fragment, fragment_offset = INVALID_FRAGMENT, 0
+        if inode.fragment != INVALID_FRAGMENT:
+            if fragment_reuse.get(inode.fragment):
+                if inode.fragment not in self.copied_fragments:
+                    start, word = self.base.fragments[inode.fragment]
+                    index = self.reserve_fragment()
+                    self.fragments[index] = (self.tell(), word)
+                    self.f.write(self.base.pread(start, word & DATA_SIZE_MASK))
+                    self.copied_fragments[inode.fragment] = index
+                fragment, fragment_offset = self.copied_fragments[inode.fragment], inode.fragment_offset
+            else:
+                tail_size = inode.size - len(inode.block_sizes) * self.block_size
+                with open(node.host_path, 'rb') as f:
+                    f.seek(inode.size - tail_size)
+                    fragment, fragment_offset = self.packer.add(f.read(tail_size))
+
+        node.data = (blocks_start, list(inode.block_sizes), fragment, fragment_offset)
+        self.statistics['reused_files'] += 1
+        self.statistics['reused_bytes'] += inode.size
+
+    def write_new(self, node, digest, blocks, tail):
+        size = node.stat.st_size
+        if (size, digest) in self.duplicates:
+            node.data = self.duplicates[(size, digest)]
+            return
+
+        blocks_start = self.tell() if blocks else 0
+        for word, data in blocks:
+            self.f.write(data)
+        fragment, fragment_offset = INVALID_FRAGMENT, 0
+        if tail:
+            fragment, fragment_offset = self.packer.add(tail)
+        node.data = (blocks_start, [word for word, data in blocks], fragment, fragment_offset)
+        self.duplicates[(size, digest)] = node.data
+        self.statistics['compressed_files'] += 1
+        self.statistics['compressed_bytes'] += size
+
+    def get_fragment_reuse(self, candidates):
+        """
+        Return dictionary of base fragment to True if the unchanged files use enough of it
+        """
+        used = collections.Counter()
+        total = collections.Counter()
+        seen = set()
+        for path, inode in self.base_files.items():
+            if inode.fragment == INVALID_FRAGMENT or inode.number in seen:
+                continue
+            seen.add(inode.number)
+            tail_size = inode.size - len(inode.block_sizes) * self.block_size
+            total[inode.fragment] += tail_size
+            if path in candidates:
+                used[inode.fragment] += tail_size
+        return {fragment: used[fragment] >= total[fragment] * FRAGMENT_REUSE_RATIO for fragment in total}
+
+    def write_data(self, root, snapshot=None, priorities=None):
+        """
+        Write the data of the regular files, the files of the sort priorities first
+        """
+        self.base_files = {}
+        if self.base:
+            self.base_files = {path: inode for path, inode in self.base.walk() if inode.is_file()}
+
+        files = [node for node in iter_nodes(root) if node.type == FILE and not node.link]
+        if priorities:
+            files.sort(key=lambda node: -priorities.get(node.path, 0))
+
+        # the files with the size and mtime of the base file, the others are compressed
+        candidates = {}
+        for node in files:
+            inode = self.base_files.get(node.path)
+            if inode and inode.size == node.stat.st_size and inode.mtime == int(node.stat.st_mtime):
+                verified = snapshot and snapshot.get(node.path) == (node.stat.st_ino, node.stat.st_ctime_ns)
+                candidates[node.path] = (inode, bool(verified))
+        fragment_reuse = self.get_fragment_reuse(candidates) if self.base else {}
+
+        def process(node):
+            candidate = candidates.get(node.path)
+            if candidate and (candidate[1] or self.is_same_file(node, candidate[0])):
+                return None
+            return self.compress_file(node.host_path, node.stat.st_size)
+
+        self.packer = FragmentPacker(self)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            for node, result in iter_bounded(executor, process, files, WORKERS * 2):
+                if result is None:
+                    self.write_reused(node, candidates[node.path][0], fragment_reuse)
+                else:
+                    self.write_new(node, *result)
+        self.packer.flush()
+
+    def write_inode(self, inodes, node, directories, listing=None):
+        """
+        Write the inode of the node to the inode table
+        """
+        file_stat = node.stat
+        header = struct.pack('<HHHHII', 0, stat.S_IMODE(file_stat.st_mode),
+                self.get_id_index(file_stat.st_uid), self.get_id_index(file_stat.st_gid),
+                min(max(int(file_stat.st_mtime), 0), 0xFFFFFFFF), node.number)
+        xattr = self.get_xattr_index(node.xattrs)
+        node_type = node.type
+
+        if node_type == DIRECTORY:
+            start_block, offset, size = listing
+            parent = node.parent_number
+            nlink = 2 + directories
+            if xattr == INVALID_XATTR and size + 3 <= 0xFFFF:
+                body = struct.pack('<IIHHI', start_block, nlink, size + 3, offset, parent)
+            else:
+                node_type += EXTENDED
+                body = struct.pack('<IIIIHHI', nlink, size + 3, start_block, parent, 0, offset, xattr)
+        elif node_type == FILE:
+            blocks_start, block_sizes, fragment, fragment_offset = node.data
+            size = file_stat.st_size
+            sparse = sum(self.block_size for word in block_sizes if not word & DATA_SIZE_MASK)
+            if xattr == INVALID_XATTR and node.nlink == 1 and blocks_start <= 0xFFFFFFFF \
+                    and size <= 0xFFFFFFFF and not sparse:
+                body = struct.pack('<IIII', blocks_start, fragment, fragment_offset, size)
+            else:
+                node_type += EXTENDED
+                body = struct.pack('<QQQIIII', blocks_start, size, sparse, node.nlink, fragment,
+                        fragment_offset, xattr)
+            body += struct.pack('<%dI' % len(block_sizes), *block_sizes)
+        elif node_type == SYMLINK:
+            target = os.fsencode(os.readlink(node.host_path))
+            body = struct.pack('<II', node.nlink, len(target)) + target
+            if xattr != INVALID_XATTR:
+                node_type += EXTENDED
+                body += struct.pack('<I', xattr)
+        elif node_type in (BLOCK_DEVICE, CHARACTER_DEVICE):
+            major, minor = os.major(file_stat.st_rdev), os.minor(file_stat.st_rdev)
+            rdev = (minor & 0xFF) | (major << 8) | ((minor & ~0xFF) << 12)
+            body = struct.pack('<II', node.nlink, rdev)
+            if xattr != INVALID_XATTR:
+                node_type += EXTENDED
+                body += struct.pack('<I', xattr)
+        else:
+            body = struct.pack('<I', node.nlink)
+            if xattr != INVALID_XATTR:
+                node_type += EXTENDED
+                body += struct.pack('<I', xattr)
+
+        node.reference = inodes.reference()
+        inodes.write(struct.pack('<H', node_type) + header[2:] + body)
+
+    def write_directory(self, inodes, listings, node):
+        """
+        Write the inodes of the children, the listing and the inode of a directory
+        """
+        entries = []
+        directories = 0
+        for child in node.children:
+            target = child.link or child
+            if target.reference is None:
+                if child.type == DIRECTORY:
+                    child.parent_number = node.number
+                    self.write_directory(inodes, listings, child)
+                else:
+                    self.write_inode(inodes, target, 0)
+            if child.type == DIRECTORY:
+                directories += 1
+            entries.append((child.name, target.reference, target.number, child.type))
+
+        listing = bytearray()
+        start = count = 0
+        header_number = None
+        headers = []
+        for name, reference, number, entry_type in entries:
+            block = reference >> 16
+            if header_number is None or block != start or count == DIRECTORY_HEADER_ENTRIES \
+                    or not -32768 <= number - header_number <= 32767:
+                start, header_number, count = block, number, 0
+                headers.append(len(listing))
+                listing += struct.pack('<III', 0, start, header_number)
+            listing += struct.pack('<HhHH', reference & 0xFFFF, number - header_number, entry_type,
+                    len(name) - 1) + name
+            count += 1
+            struct.pack_into('<I', listing, headers[-1], count - 1)
+
+        start_block, offset = listings.position()
+        listings.write(bytes(listing))
+        self.write_inode(inodes, node, directories, (start_block, offset, len(listing)))
+
+    def write_lookup_table(self, data):
+        """
+        Write data as metadata blocks and their positions. Return the position of the index.
+        """
+        writer = MetadataWriter(self.compress)
+        positions = []
+        for offset in range(0, len(data), METADATA_SIZE):
+            positions.append(self.tell() + len(writer.output))
+            writer.write_block(data[offset:offset + METADATA_SIZE])
+        self.f.write(bytes(writer.output))
+        index_start = self.tell()
+        self.f.write(struct.pack('<%dQ' % len(positions), *positions))
+        return index_start
+
+    def write_xattrs(self):
+        """
+        Write the xattr tables. Return the position of the xattr id table.
+        """
+        if not self.xattrs:
+            return INVALID_BLOCK
+
+        values = MetadataWriter(self.compress)
+        ids = bytearray()
+        for xattrs in sorted(self.xattrs, key=self.xattrs.get):
+            reference = values.reference()
+            size = 0
+            for name, value in xattrs:
+                prefix = next(prefix for prefix in XATTR_PREFIXES if name.startswith(prefix))
+                key = os.fsencode(name[len(prefix):])
+                entry = struct.pack('<HH', XATTR_PREFIXES[prefix], len(key)) + key \
+                        + struct.pack('<I', len(value)) + value
+                values.write(entry)
+                size += len(entry)
+            ids += struct.pack('<QII', reference, len(xattrs), size)
+
+        xattr_table_start = self.tell()
+        self.f.write(values.finish())
+        writer = MetadataWriter(self.compress)
+        positions = []
+        for offset in range(0, len(ids), METADATA_SIZE):
+            positions.append(self.tell() + len(writer.output))
+            writer.write_block(bytes(ids[offset:offset + METADATA_SIZE]))
+        self.f.write(bytes(writer.output))
+        id_table_start = self.tell()
+        self.f.write(struct.pack('<QII', xattr_table_start, len(self.xattrs), 0))
+        self.f.write(struct.pack('<%dQ' % len(positions), *positions))
+        return id_table_start
+
+    def write_tables(self, root, inode_count):
+        inodes = MetadataWriter(self.compress)
+        listings = MetadataWriter(self.compress)
+        root.parent_number = inode_count + 1
+        self.write_directory(inodes, listings, root)
+
+        inode_table_start = self.tell()
+        self.f.write(inodes.finish())
+        directory_table_start = self.tell()
+        self.f.write(listings.finish())
+        fragment_table_start = self.write_lookup_table(b''.join(struct.pack('<QII', start, word, 0)
+                for start, word in self.fragments))
+        id_table_start = self.write_lookup_table(struct.pack('<%dI' % len(self.ids),
+                *sorted(self.ids, key=self.ids.get)))
+        xattr_id_table_start = self.write_xattrs()
+        bytes_used = self.tell()
+        if bytes_used % PADDING:
+            self.f.write(bytes(PADDING - bytes_used % PADDING))
+
+        flags = FLAG_DUPLICATES
+        if not self.xattrs:
+            flags |= FLAG_NO_XATTRS
+        if self.options_block:
+            flags |= FLAG_COMPRESSOR_OPTIONS
+        superblock = struct.pack(SUPERBLOCK_FORMAT, SQUASHFS_MAGIC, inode_count, int(time.time()),
+                self.block_size, len(self.fragments), COMPRESSION_IDS[self.compression],
+                self.block_size.bit_length() - 1, flags, len(self.ids), 4, 0, root.reference,
+                bytes_used, id_table_start, xattr_id_table_start, inode_table_start,
+                directory_table_start, fragment_table_start, INVALID_BLOCK)
+        self.f.seek(0)
+        self.f.write(superblock)
+
+
+def write_squashfs(source_directory, target_path, compression, excludes=(), base=None,
+        snapshot=None, priorities=None):
+    """
+    Create the squashfs image of source_directory. The data blocks of the
+    files unchanged from the base image are copied if it has the same
+    compressor. Return the statistics of the reused and compressed files.
+    """
+    if base and base.compression != compression:
+        logger.warning("The base image is %s compressed, its blocks are not reused for %s",
+                base.compression, compression)
+        base = None
+    block_size = base.block_size if base else DEFAULT_BLOCK_SIZE
+
+    root = scan_tree(source_directory, excludes)
+    counter = [0]
+    number_inodes(root, counter)
+
+    with open(target_path, 'w+b') as f:
+        writer = SquashfsWriter(f, compression, block_size, base)
+        writer.write_data(root, snapshot, priorities)
+        writer.write_tables(root, counter[0])
+
+    statistics = writer.statistics
+    logger.info("squashfs: %d files (%.1fMB) reused from the base image, %d files (%.1fMB) compressed",
+            statistics['reused_files'], statistics['reused_bytes'] / 1024 / 1024,
+            statistics['compressed_files'], statistics['compressed_bytes'] / 1024 / 1024)
+    return statistics
@@ -0,0 +1,94 @@
+"""
+tmpfs staging of custom-root, custom-disk and the partition images.
+When the estimated footprint fits the memory budget, the scratch files
+are kept in RAM and only the output images are written to the project
+directory. Otherwise the build falls back to the project directory.
+
+get_available_memory() - MemAvailable of /proc/meminfo
+fits_in_memory() - check the staging footprint against the budget
+prepare_staging() - mount the tmpfs and return the staging directory
+release_staging() - unmount the tmpfs
+"""
+
+import os
+
+from utilities.logger import create_logger
+from utilities.backend import get_operation
+from utilities.file_ops import delete_directory
+
+logger = create_logger(__name__)
+
+STAGING_DIRECTORY = "staging"
+# tmpfs is sized with a margin on top of the estimated footprint
+STAGING_MARGIN = 1.2
+MB = 1024 * 1024
+
+
+def get_available_memory():
+    """
+    Return available memory in bytes, or 0 if unknown
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def get_staging_size(staging_footprint):
+    return int(staging_footprint * STAGING_MARGIN)
+
+
+def fits_in_memory(staging_footprint, memory_budget):
+    """
+    Return True if the staging footprint in bytes fits the memory budget
+    in MB and the memory available now
+    """
+    if not memory_budget:
+        return False
+
+    size = get_staging_size(staging_footprint)
+    budget = min(memory_budget * MB, get_available_memory())
+    if size > budget:
+        logger.info("Staging needs %dMB, budget is %dMB. Use the project directory",
+                size // MB, budget // MB)
+        return False
+
+    return True
+
+
+def prepare_staging(project_directory, staging_footprint, memory_budget):
+    """
+    Return the directory for custom-root, custom-disk and the partition images.
+    It is a size limited tmpfs if the footprint fits the memory budget,
+    else the project directory.
+    """
+    if not fits_in_memory(staging_footprint, memory_budget):
+        return project_directory
+
+    size = get_staging_size(staging_footprint)
+    mount_point = os.path.join(project_directory, STAGING_DIRECTORY)
+    staging_directory = get_operation("mount_tmpfs")(mount_point, size)
+    if not staging_directory:
+        logger.warning("Cannot create tmpfs staging. Use the project directory")
+        return project_directory
+
+    logger.info("Stage the build in %s (%dMB tmpfs)", staging_directory, size // MB)
+    return staging_directory
+
+
+def release_staging(project_directory, staging_directory):
+    """
+    Unmount the tmpfs and free its memory
+    """
+    if staging_directory == project_directory:
+        return
+
+    if os.path.ismount(staging_directory):
+        get_operation("unmount")(staging_directory)
+
+    # the mount point or the directory in /dev/shm
+    delete_directory(staging_directory)
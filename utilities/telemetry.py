@@ -0,0 +1,186 @@
+"""
+Build telemetry. Record wall time, CPU time and I/O of every stage
+and external command. Disabled unless enable_telemetry() is called.
+
+reset_telemetry() - clear the spans between builds
+trace_stage() - decorator to record a build stage
+trace_command() - context manager to record an external command
+write_telemetry() - write JSON report and Chrome trace-event file
+"""
+
+import contextlib
+import functools
+import json
+import os
+import resource
+import time
+
+from utilities.logger import create_logger
+
+logger = create_logger(__name__)
+
+REPORT_FILE_NAME = "build-report.json"
+TRACE_FILE_NAME = "build-trace.json"
+
+_enabled = False
+_spans = []
+_depth = 0
+
+
+def enable_telemetry():
+    global _enabled
+    _enabled = True
+
+
+def reset_telemetry():
+    """
+    Forget the recorded spans, e.g. before the next build in the same process
+    """
+    del _spans[:]
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_spans():
+    return list(_spans)
+
+
+def read_proc_io():
+    """
+    Return I/O counters of this process from /proc/self/io.
+    The counters of the reaped children are included by the kernel.
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+
+    return counters
+
+
+def get_cpu_times():
+    """
+    Return user and system CPU time of this process and its reaped children
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu_user": own.ru_utime,
+        "cpu_system": own.ru_stime,
+        "children_cpu_user": children.ru_utime,
+        "children_cpu_system": children.ru_stime,
+    }
+
+
+@contextlib.contextmanager
+def trace_span(name, category="stage", **args):
+    """
+    Record the span of the block with its wall time, CPU time and I/O
+    """
+    global _depth
+    if not _enabled:
+        yield
+        return
+
+    start = time.time()
+    start_counter = time.perf_counter()
+    start_cpu = get_cpu_times()
+    start_io = read_proc_io()
+    _depth += 1
+    try:
+        yield
+    finally:
+        _depth -= 1
+        end_cpu = get_cpu_times()
+        end_io = read_proc_io()
+        span = {
+            "name": name,
+            "category": category,
+            "depth": _depth,
+            "start": start,
+            "wall": time.perf_counter() - start_counter,
+        }
+        for key in end_cpu:
+            span[key] = end_cpu[key] - start_cpu[key]
+        for key in ['rchar', 'wchar', 'read_bytes', 'write_bytes']:
+            span[key] = end_io.get(key, 0) - start_io.get(key, 0)
+        span.update(args)
+        _spans.append(span)
+        logger.debug("%s %s took %.2fs", category, name, span['wall'])
+
+
+def trace_stage(function):
+    """
+    Decorator to record a build stage
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with trace_span(function.__name__, "stage"):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def get_command_name(cmd):
+    words = cmd.split() if isinstance(cmd, str) else list(cmd)
+    words = [word for word in words if word != 'sudo']
+    return os.path.basename(words[0]) if words else 'command'
+
+
+def trace_command(cmd, name=None):
+    """
+    Context manager to record an external command
+    """
+    if not name:
+        name = get_command_name(cmd)
+    return trace_span(name, "command", cmd=cmd if isinstance(cmd, str) else ' '.join(cmd))
+
+
+def get_chrome_trace():
+    """
+    Return the spans in Chrome trace-event format.
+    Load it in chrome://tracing or https://ui.perfetto.dev
+    """
+    pid = os.getpid()
+    events = []
+    for span in _spans:
+        args = {key: value for key, value in span.items()
+                if key not in ['name', 'category', 'start', 'wall', 'depth']}
+        events.append({
+            "name": span['name'],
+            "cat": span['category'],
+            "ph": "X",
+            "ts": int(span['start'] * 1000000),
+            "dur": int(span['wall'] * 1000000),
+            "pid": pid,
+            "tid": pid,
+            "args": args,
+        })
+
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_telemetry(directory):
+    """
+    Write the JSON report and Chrome trace to the directory.
+    Return path to the report and trace.
+    """
+    report_path = os.path.join(directory, REPORT_FILE_NAME)
+    trace_path = os.path.join(directory, TRACE_FILE_NAME)
+    spans = sorted(_spans, key=lambda span: span['start'])
+
+    with open(report_path, 'w') as f:
+        json.dump({"spans": spans}, f, indent=4)
+
+    with open(trace_path, 'w') as f:
+        json.dump(get_chrome_trace(), f)
+
+    logger.info("Build report in %s", report_path)
+    logger.info("Build trace in %s", trace_path)
+    return report_path, trace_path
@@ -3,6 +3,7 @@ import json
 import subprocess
 
 from utilities.logger import create_logger
+from utilities.telemetry import trace_command
 
 logger = create_logger(__name__)
 
@@ -13,21 +14,35 @@ def run_cmd(cmd, shell=True):
     sout = subprocess.PIPE
     serr = subprocess.STDOUT
 
-    process = subprocess.Popen(cmd, shell=shell, stdout=sout, stderr=serr)
-    sout, serr = process.communicate()
+    with trace_command(cmd):
+        process = subprocess.Popen(cmd, shell=shell, stdout=sout, stderr=serr)
+        sout, serr = process.communicate()
     # combine stdout and stderr, filter None and decode
     out = ''.join([out.decode('utf-8') for out in [sout, serr] if out])
 
     return process.returncode, out
 
 
+def call_cmd(cmd, shell=True):
+    """
+    Wrapper for subprocess without capturing the output,
+    e.g. to show the progress of the command.
+    Return: return code
+    """
+    with trace_command(cmd):
+        ret = subprocess.run(cmd, shell=shell)
+
+    return ret.returncode
+
+
 def get_rootfs_size_bytes(custom_root_directory):
     """
     Calculate the size of rootfs and return in bytes.
     """
     logger.info("Calculate rootfs in %s", custom_root_directory)
     cmd = "du --block-size=1 --summarize %s | awk '{print $1}'" % custom_root_directory
-    output = subprocess.check_output(cmd, shell=True).decode("utf-8").strip()
+    with trace_command(cmd, "du"):
+        output = subprocess.check_output(cmd, shell=True).decode("utf-8").strip()
     logger.info("The rootfs size is %s bytes", output)
     return output
 
@@ -101,6 +116,24 @@ def set_apt_proxy(file_path, custom_root_directory):
             f.write(proxy)
 
 
+def add_apt_proxy(url, custom_root_directory):
+    """
+    Set the http proxy of apt to url, the other settings of
+    <custom_root_directory>/etc/apt/apt.conf.d/my_proxy are kept
+    """
+    rel_proxy_path = "etc/apt/apt.conf.d/my_proxy"
+    proxy_path = os.path.join(custom_root_directory, rel_proxy_path)
+
+    lines = []
+    if os.path.exists(proxy_path):
+        with open(proxy_path, 'r') as f:
+            lines = [line for line in f if not line.startswith('Acquire::http::proxy ')]
+    lines.append('Acquire::http::proxy "%s";\n' % url)
+
+    with open(proxy_path, 'w') as f:
+        f.writelines(lines)
+
+
 def remove_apt_proxy(custom_root_directory):
     rel_proxy_path = "etc/apt/apt.conf.d/my_proxy"
     proxy_path = os.path.join(custom_root_directory, rel_proxy_path)
@@ -108,3 +141,29 @@ def remove_apt_proxy(custom_root_directory):
     if os.path.exists(proxy_path):
         os.remove(proxy_path)
         logger.info("Removing proxy file %s", proxy_path)
+
+
+def set_apt_sources(sources, custom_root_directory):
+    """
+    Make apt in <custom_root_directory> read only the sources.list lines in
+    sources during the build, the sources of the image are not changed
+    """
+    rel_sources_path = "etc/apt/build-sources.list"
+    rel_config_path = "etc/apt/apt.conf.d/my_sources"
+
+    with open(os.path.join(custom_root_directory, rel_sources_path), 'w') as f:
+        for line in sources:
+            f.write("%s\n" % line)
+
+    os.makedirs(os.path.dirname(os.path.join(custom_root_directory, rel_config_path)), exist_ok=True)
+    with open(os.path.join(custom_root_directory, rel_config_path), 'w') as f:
+        f.write('Dir::Etc::SourceList "%s";\n' % os.path.basename(rel_sources_path))
+        f.write('Dir::Etc::SourceParts "/dev/null";\n')
+
+
+def remove_apt_sources(custom_root_directory):
+    for rel_path in ["etc/apt/build-sources.list", "etc/apt/apt.conf.d/my_sources"]:
+        file_path = os.path.join(custom_root_directory, rel_path)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            logger.info("Removing apt sources file %s", file_path)